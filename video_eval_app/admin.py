@@ -122,6 +122,15 @@ class DatasetVideoAdmin(admin.ModelAdmin):
     def has_add_permission(self, request):
         return False
 
+class VideoJobAdmin(admin.ModelAdmin):
+    list_display = ['id', 'dataset_video', 'status', 'created_at', 'finished_at']
+    list_filter = ['status']
+    exclude = ['credentials']
+    readonly_fields = ['dataset_video', 'created_by', 'status', 'error', 'location', 'started_at', 'finished_at']
+
+    def has_add_permission(self, request):
+        return False
+
 class TaskAdmin(admin.ModelAdmin):
     readonly_fields = ['project', 'segment', 'turk_hit_id', 'collected_at', 'results']
     inlines = [AssignmentInline]
@@ -166,6 +175,7 @@ admin.site.register(StoredFile, StoredFileAdmin)
 admin.site.register(Dataset, DatasetAdmin)
 admin.site.register(DatasetVideo, DatasetVideoAdmin)
 admin.site.register(Segment, SegmentAdmin)
+admin.site.register(VideoJob, VideoJobAdmin)
 admin.site.register(Project, ProjectAdmin)
 admin.site.register(Task, TaskAdmin)
 admin.site.register(Assignment, AssignmentAdmin)
@@ -2,6 +2,7 @@ import asyncio
 import atexit
 import threading
 import logging
+from collections import deque
 
 logger = logging.getLogger(__name__)
 
@@ -12,23 +13,60 @@ async def _set_result(result_future, result):
 async def _set_exception(result_future, exception):
     result_future.set_exception(exception)
 
+async def gather_or_cancel(*aws):
+    """Like `asyncio.gather`, but cancels the remaining awaitables if one of them fails"""
+    tasks = [asyncio.ensure_future(aw) for aw in aws]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key: while one is running, the
+    other callers wait for its result instead of doing the same work again.
+    Calls are only shared within an event loop.
+    """
+    def __init__(self):
+        self.calls = {}
+
+    async def __call__(self, key, func, *args, **kwargs):
+        key = (asyncio.get_running_loop(), key)
+        if (task := self.calls.get(key)) is None:
+            task = asyncio.ensure_future(func(*args, **kwargs))
+            self.calls[key] = task
+            task.add_done_callback(lambda _task: self.calls.pop(key, None))
+        # one caller giving up does not cancel the call for the others
+        return await asyncio.shield(task)
+
 class AsyncQueue:
-    def __init__(self, num_workers=1):
+    """
+    Runs coroutine functions on `num_workers` workers in a background event loop.
+
+    Work is taken from priority lanes (lowest priority value first), and
+    within a lane the owners of the queued work take turns, so that one
+    owner's backlog does not hold up everybody else's work. Queuing more
+    than `maxsize` (if set) items raises `asyncio.QueueFull`.
+    """
+    def __init__(self, num_workers=1, maxsize=0):
         self.loop = asyncio.new_event_loop()
-        self.queue = asyncio.Queue()
         self.thread = threading.Thread(target=self._start_loop, daemon=True)
         self.shutdown_event = threading.Event()
         self.num_workers = num_workers
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        # priority -> owner -> queued items, owners in turn order
+        self.lanes = {}
+        self.size = 0
+        self.wakeup = asyncio.Event()
         self.worker_tasks = []
 
-
         self.thread.start()
         for ix in range(num_workers):
-            task = asyncio.run_coroutine_threadsafe(self._worker(ix), self.loop)
-            self.worker_tasks.append(task)
-
-        # Start worker monitor
-        asyncio.run_coroutine_threadsafe(self._monitor_workers(), self.loop)
+            self._start_worker(ix)
 
         atexit.register(self.shutdown)
 
@@ -36,56 +74,95 @@ class AsyncQueue:
         asyncio.set_event_loop(self.loop)
         self.loop.run_forever()
 
+    def _start_worker(self, ix):
+        task = asyncio.run_coroutine_threadsafe(self._worker(ix), self.loop)
+        if ix < len(self.worker_tasks):
+            self.worker_tasks[ix] = task
+        else:
+            self.worker_tasks.append(task)
+        task.add_done_callback(lambda task: self._worker_done(ix, task))
+
+    def _worker_done(self, ix, task):
+        """Restart failed workers"""
+        if self.shutdown_event.is_set() or task.cancelled():
+            return
+        if x := task.exception():
+            logger.error(f"AsyncQueue worker {ix} failed: {x}")
+            logger.info(f"Restarting AsyncQueue worker {ix}")
+            self._start_worker(ix)
+
+    def _put(self, item, priority, owner):
+        with self.lock:
+            if self.maxsize and self.size >= self.maxsize:
+                raise asyncio.QueueFull()
+            self.lanes.setdefault(priority, {}).setdefault(owner, deque()).append(item)
+            self.size += 1
+        self.loop.call_soon_threadsafe(self.wakeup.set)
+
+    def _pop(self):
+        with self.lock:
+            if not self.lanes:
+                return None
+            priority = min(self.lanes)
+            owners = self.lanes[priority]
+            owner = next(iter(owners))
+            items = owners.pop(owner)
+            item = items.popleft()
+            if items:
+                # back of the line for this owner's next item
+                owners[owner] = items
+            elif not owners:
+                del self.lanes[priority]
+            self.size -= 1
+            return item
+
+    async def _get(self):
+        while (item := self._pop()) is None:
+            self.wakeup.clear()
+            await self.wakeup.wait()
+        return item
+
     async def _worker(self, ix):
         logger.info(f"AsyncQueue worker {ix} starting")
         try:
             while not self.shutdown_event.is_set():
+                func, args, kwargs, result_future = await self._get()
                 try:
-                    func, args, kwargs, result_future = await asyncio.wait_for(self.queue.get(), timeout=0.1)
-                    future_loop = result_future.get_loop()
-                    try:
-                        result = await func(*args, **kwargs)
-                        asyncio.run_coroutine_threadsafe(_set_result(result_future, result), future_loop)
-                    except Exception as x:
-                        asyncio.run_coroutine_threadsafe(_set_exception(result_future, x), future_loop)
-                    finally:
-                        self.queue.task_done()
-                except asyncio.TimeoutError:
-                    pass # just try again
+                    result = await func(*args, **kwargs)
+                    if result_future:
+                        asyncio.run_coroutine_threadsafe(_set_result(result_future, result), result_future.get_loop())
+                except Exception as x:
+                    if result_future:
+                        asyncio.run_coroutine_threadsafe(_set_exception(result_future, x), result_future.get_loop())
+                    else:
+                        logger.exception(f"AsyncQueue worker {ix}: {func.__name__} failed: {x}")
         except Exception as x:
             logger.error(f"AsyncQueue worker {ix} crashed with exception: {x}")
             raise
         finally:
             logger.info(f"AsyncQueue worker {ix} exiting")
 
-    async def _monitor_workers(self):
-        """Monitor worker tasks and restart failed ones"""
-        while not self.shutdown_event.is_set():
-            await asyncio.sleep(1.0)  # Check every second
-            
-            for ix, task in enumerate(self.worker_tasks):
-                if task.done():
-                    try:
-                        # Check if task completed with an exception
-                        task.result()  # This will raise if the task failed
-                        logger.info(f"AsyncQueue worker {ix} completed normally")
-                    except Exception as x:
-                        logger.error(f"AsyncQueue worker {ix} failed: {x}")
-                        
-                        # Restart the failed worker
-                        logger.info(f"Restarting AsyncQueue worker {ix}")
-                        new_task = asyncio.run_coroutine_threadsafe(self._worker(ix), self.loop)
-                        self.worker_tasks[ix] = new_task
-
     async def __call__(self, func, *args, **kwargs):
         result_future = asyncio.Future()
-        # await self.queue.put((func, args, kwargs, result_future))
-        self.loop.call_soon_threadsafe(self.queue.put_nowait, (func, args, kwargs, result_future))
+        self._put((func, args, kwargs, result_future), 0, None)
         result = await result_future
         return result
 
+    def submit(self, func, *args, priority=0, owner=None):
+        """Queue `func(*args)` without waiting for it to run"""
+        self._put((func, args, {}, None), priority, owner)
+
+    async def _cancel_tasks(self):
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
     def shutdown(self):
+        if self.shutdown_event.is_set():
+            return
         self.shutdown_event.set()  # Signal shutdown
+        asyncio.run_coroutine_threadsafe(self._cancel_tasks(), self.loop).result()
         self.loop.call_soon_threadsafe(self.loop.stop)  # Stop the event loop
         self.thread.join()  # Wait for the thread to finish
 
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from video_eval_app.models import StoredFile
+
+
+class Command(BaseCommand):
+    help = (
+        "Recount the references from dataset videos and segments to all stored files, "
+        "fixing the counts that have drifted (e.g. after editing rows outside the models)."
+    )
+
+    def handle(self, *args, **options):
+        repaired = StoredFile.repair_ref_counts()
+        self.stdout.write(f"Repaired {repaired} reference counts")
@@ -0,0 +1,27 @@
+import json
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from video_eval_app.tasks import vacuum
+
+
+class Command(BaseCommand):
+    help = (
+        "Delete the garbage files now, as the daily scheduled vacuum does: stored files nothing "
+        "references, files and S3 objects no stored file is in, stale uploads and temporary files."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help="Only report what would be deleted",
+        )
+        parser.add_argument(
+            '--time-budget', type=float, default=settings.VACUUM_TIME_BUDGET,
+            help="Seconds after which to stop, leaving the rest to the next run",
+        )
+
+    def handle(self, *args, dry_run, time_budget, **options):
+        report = vacuum(dry_run=dry_run, time_budget=time_budget)
+        self.stdout.write(json.dumps(report, indent=2))
@@ -0,0 +1,50 @@
+import asyncio
+import logging
+import signal
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from video_eval_app.mturk import aclose_aws_sessions
+from video_eval_app.tasks import work_video_jobs
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = (
+        "Process queued video jobs. Any number of workers can run, on any host sharing the database. "
+        "SIGINT/SIGTERM stop claiming jobs and wait for the running ones; a second signal aborts them "
+        "(they are picked up again once their lease expires)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--concurrency', type=int, default=settings.FFMPEG_CONCURRENCY,
+            help="Number of videos processed at once",
+        )
+
+    def handle(self, *args, concurrency, **options):
+        asyncio.run(self.work(concurrency))
+
+    async def work(self, concurrency):
+        loop = asyncio.get_running_loop()
+        stop_event = asyncio.Event()
+        worker = asyncio.current_task()
+
+        def stop():
+            if stop_event.is_set():
+                logger.warning("Aborting the running video jobs")
+                worker.cancel()
+            else:
+                logger.info("Finishing the running video jobs (signal again to abort them)")
+                stop_event.set()
+
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop)
+        try:
+            await work_video_jobs(stop_event, concurrency)
+        except asyncio.CancelledError:
+            pass
+        finally:
+            await aclose_aws_sessions()
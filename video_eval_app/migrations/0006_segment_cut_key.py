@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-17 23:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('video_eval_app', '0005_userprofile'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='segment',
+            name='cut_key',
+            field=models.CharField(blank=True, db_index=True, max_length=32),
+        ),
+    ]
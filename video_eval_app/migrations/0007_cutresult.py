@@ -0,0 +1,22 @@
+# Generated by Django 5.2.18 on 2026-10-17 23:38
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('video_eval_app', '0006_segment_cut_key'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CutResult',
+            fields=[
+                ('cut_key', models.CharField(max_length=32, primary_key=True, serialize=False)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('video', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='cut_results', to='video_eval_app.storedfile')),
+            ],
+        ),
+    ]
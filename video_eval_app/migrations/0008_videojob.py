@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-17 23:39
+
+import django.db.models.deletion
+import jsonfield.fields
+import uuid
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('video_eval_app', '0007_cutresult'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VideoJob',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, primary_key=True, serialize=False)),
+                ('status', models.CharField(choices=[('queued', 'Queued'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], default='queued', max_length=16)),
+                ('error', models.TextField(blank=True)),
+                ('credentials', jsonfield.fields.JSONField(blank=True, null=True)),
+                ('location', models.CharField(blank=True, max_length=255)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('started_at', models.DateTimeField(blank=True, null=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('created_by', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='video_jobs', to=settings.AUTH_USER_MODEL)),
+                ('dataset_video', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='jobs', to='video_eval_app.datasetvideo')),
+            ],
+        ),
+    ]
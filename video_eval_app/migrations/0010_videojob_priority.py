@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-17 23:43
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('video_eval_app', '0009_videojob_lease'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='videojob',
+            name='video_eval__status_c4c68a_idx',
+        ),
+        migrations.AddField(
+            model_name='videojob',
+            name='priority',
+            field=models.IntegerField(choices=[(0, 'Interactive'), (1, 'Normal'), (2, 'Bulk')], default=1),
+        ),
+        migrations.AddIndex(
+            model_name='videojob',
+            index=models.Index(fields=['status', 'priority', 'created_at'], name='video_eval__status_55d741_idx'),
+        ),
+    ]
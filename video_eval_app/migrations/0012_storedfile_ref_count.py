@@ -0,0 +1,37 @@
+# Generated by Django 5.2.18 on 2026-10-18 00:08
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def count_references(apps, schema_editor):
+    """Count the references to the existing stored files"""
+    StoredFile = apps.get_model('video_eval_app', 'StoredFile')
+    DatasetVideo = apps.get_model('video_eval_app', 'DatasetVideo')
+    Segment = apps.get_model('video_eval_app', 'Segment')
+
+    references = 0
+    for model, fields in ((DatasetVideo, ('video', 'audio', 'subtitles')), (Segment, ('video', 'subtitles'))):
+        for field in fields:
+            references = references + Coalesce(Subquery(
+                model.objects.filter(**{field: OuterRef('pk')})
+                .order_by().values(field).annotate(count=Count('pk')).values('count')
+            ), 0)
+    StoredFile.objects.update(ref_count=references)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('video_eval_app', '0011_chunkedupload'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='storedfile',
+            name='ref_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(count_references, migrations.RunPython.noop),
+    ]
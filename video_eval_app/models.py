@@ -1,12 +1,22 @@
+import asyncio
+import hashlib
+import logging
+import os
+import threading
 import uuid
-from functools import partial
-from contextlib import asynccontextmanager
-
-from django.db import models, transaction
-from django.db.models import Count, Q, Case, When, IntegerField
+from datetime import timedelta
+from collections import Counter, defaultdict
+from functools import partial, reduce
+from operator import add, or_
+from contextlib import asynccontextmanager, contextmanager
+
+from django.db import models, transaction, connection
+from django.db.models import Count, Exists, Q, F, OuterRef, Subquery, Case, When, IntegerField
+from django.db.models.functions import Coalesce, Greatest
+from django.utils import timezone
 from django.conf import settings
 from asgiref.sync import sync_to_async
-from django.db.models.signals import post_save
+from django.db.models.signals import post_delete, post_save, pre_save
 from django.dispatch import receiver
 from django.core.files.storage import default_storage
 from django.contrib.auth.models import User, Group
@@ -16,7 +26,14 @@ import jsonfield
 
 
 from .utils import secs_to_timestamp
-from .storage import delocalize_file, store_file, local_file
+from .storage import (
+    delocalize_file, store_file, stream_to_s3, adopt_s3_upload, local_file, local_files, run_file_io,
+    delete_s3_objects, delete_local_files, file_size,
+)
+from .async_queue import SingleFlight, gather_or_cancel
+from .upload_handlers import (
+    HashedFile, append_chunk, chunked_upload_lock, chunked_upload_md5, forget_chunked_upload, receive_chunk,
+)
 
 CONTENT_TYPES = {
     ".avi": "video/x-msvideo",
@@ -30,6 +47,15 @@ CONTENT_TYPES = {
     ".srt": "text/plain",
 }
 
+logger = logging.getLogger(__name__)
+
+# stores and uploads in progress, by md5
+store_flight = SingleFlight()
+
+# the most rows deleted or updated by one query, with room for its other
+# parameters within the variable limits of the databases (999 for SQLite
+# before 3.32)
+BATCH_SIZE = 900
 
 def md5_sum(file):
     md5_hash = hashlib.md5()
@@ -81,36 +107,126 @@ class StoredFile(models.Model):
     path = models.CharField(max_length=255)
     bucket = models.CharField(max_length=255, blank=True)
     key = models.CharField(max_length=255, blank=True)
+    # the references from dataset videos and segments, counted as they are saved
+    # and deleted (see `count_file_references`)
+    ref_count = models.PositiveIntegerField(default=0)
 
     @classmethod
     async def store(cls, file, subdir, session=None, location=None, created_by=None):
+        """
+        Store `file` under `subdir`, unless a file with the same contents is stored
+        already, locally or in S3. Concurrent stores of the same contents are made once.
+        """
         if not file:
             return None
 
-        name, path, md5sum = store_file(file, subdir, session, location)
-        defaults = {"name": name}
-        if created_by:
-            defaults["created_by"] = created_by
-        instance, created = await cls.objects.aget_or_create(path=path, md5sum=md5sum, defaults=defaults)
+        md5sum = getattr(file, 'md5sum', None) or await run_file_io(md5_sum, file)
+        instance = await store_flight(md5sum, cls._store, file, subdir, md5sum, session, location, created_by)
 
         # If file existed but had no owner, update it with the current user
-        if not created and created_by and instance.created_by_id is None:
+        if created_by and instance.created_by_id is None:
             instance.created_by = created_by
             await instance.asave(update_fields=['created_by'])
 
         return instance
 
+    @classmethod
+    async def _store(cls, file, subdir, md5sum, session, location, created_by):
+        instance = await cls.objects.filter(md5sum=md5sum).afirst()
+        if instance and await instance.ais_available():
+            logger.info(f"{file.name} is already stored as {instance!r}")
+            return instance
+
+        name, path, md5sum = await run_file_io(store_file, file, subdir, session, location, md5sum)
+        if instance:
+            # its local copy has gone missing
+            instance.path = path
+            await instance.asave(update_fields=['path'])
+            return instance
+        defaults = {"name": name, "path": path}
+        if created_by:
+            defaults["created_by"] = created_by
+        instance, created = await cls.objects.aget_or_create(md5sum=md5sum, defaults=defaults)
+        return instance
+
+    @classmethod
+    async def store_stream(cls, write_to, name, subdir, session, location, created_by=None):
+        """Like `store`, for contents streamed straight into S3 by `write_to(write)`, see `stream_to_s3`"""
+        path, md5sum, bucket, key = await stream_to_s3(write_to, name, subdir, session, location)
+        return await cls._stored_in_s3(name, path, md5sum, bucket, key, created_by)
+
+    @classmethod
+    async def store_s3_upload(cls, temp_key, name, subdir, session, location, created_by=None):
+        """Like `store`, for `name` uploaded straight to S3 `location` under `temp_key`, see `presign_upload`"""
+        path, md5sum, bucket, key = await adopt_s3_upload(temp_key, name, subdir, session, location)
+        return await cls._stored_in_s3(name, path, md5sum, bucket, key, created_by)
+
+    @classmethod
+    async def _stored_in_s3(cls, name, path, md5sum, bucket, key, created_by):
+        defaults = {"name": name, "path": path, "bucket": bucket, "key": key}
+        if created_by:
+            defaults["created_by"] = created_by
+        instance, created = await cls.objects.aget_or_create(md5sum=md5sum, defaults=defaults)
+        if not instance.is_s3_file:
+            # it was only stored locally so far
+            await sync_to_async(default_storage.delete)(instance.path)
+            instance.bucket, instance.key = bucket, key
+            await instance.asave(update_fields=['bucket', 'key'])
+        return instance
+
+    @classmethod
+    async def aget_reusable(cls, md5sum, user, dataset):
+        """
+        The stored file with `md5sum` that `user` may add to `dataset` without
+        uploading it again, if any: one of theirs, or one already in `dataset`
+        """
+        instance = await cls.objects.filter(
+            Q(created_by=user)
+            | Q(dataset_video_videos__dataset=dataset)
+            | Q(dataset_video_audios__dataset=dataset)
+            | Q(dataset_video_subtitles__dataset=dataset),
+            md5sum=md5sum.lower(),
+        ).afirst()
+        if instance and await instance.ais_available():
+            return instance
+        return None
+
+    async def ais_available(self):
+        """Whether the contents are still in S3 or on local disk"""
+        return self.is_s3_file or await sync_to_async(default_storage.exists)(self.path)
+
     async def delocalize(self, session, location):
-        if result := await delocalize_file(self.path, session, location):
+        if self.is_s3_file:
+            return self
+        if result := await store_flight(('delocalize', self.md5sum), self._delocalize, session, location):
             self.bucket, self.key = result
-            await self.asave()
+        elif session and location:
+            # no local copy: another instance may have uploaded it already
+            await self.arefresh_from_db(fields=['bucket', 'key'])
         return self
 
+    async def _delocalize(self, session, location):
+        if result := await delocalize_file(self.path, session, location):
+            bucket, key = result
+            await type(self).objects.filter(pk=self.pk).aupdate(bucket=bucket, key=key)
+        return result
+
     @asynccontextmanager
     async def local(self, session=None):
-        async with local_file(self.path, self.bucket, self.key, session) as name:
+        async with local_file(self.path, self.bucket, self.key, session, self.md5sum) as name:
             yield name
 
+    @staticmethod
+    @asynccontextmanager
+    async def local_all(stored_files, session=None):
+        """Make all `stored_files` (which may include `None`) local at once"""
+        files = [
+            stored_file and (stored_file.path, stored_file.bucket, stored_file.key, stored_file.md5sum)
+            for stored_file in stored_files
+        ]
+        async with local_files(files, session) as names:
+            yield names
+
     @property
     def url(self):
         if self.bucket:
@@ -138,30 +254,23 @@ class StoredFile(models.Model):
         """Returns True if file is stored in S3"""
         return bool(self.bucket and self.key)
 
-    def get_reference_count(self):
-        """Count how many entities reference this file in a single query"""
-        # Count all references in one query using conditional aggregation
-        result = self.__class__.objects.filter(pk=self.pk).aggregate(
-            dataset_video_count=Count('dataset_video_videos', distinct=True) +
-                               Count('dataset_video_audios', distinct=True) +
-                               Count('dataset_video_subtitles', distinct=True),
-            segment_count=Count('segment_videos', distinct=True) +
-                         Count('segment_subtitles', distinct=True)
-        )
+    async def asize(self, session=None):
+        """The size of the file, wherever it is stored (see `file_size`)"""
+        return await file_size(self.path, self.bucket, self.key, session)
 
-        return result['dataset_video_count'] + result['segment_count']
+    def get_reference_count(self):
+        """How many dataset videos and segments reference this file"""
+        return type(self).objects.values_list('ref_count', flat=True).get(pk=self.pk)
 
     async def aget_reference_count(self):
         """Async version of get_reference_count"""
-        result = await self.__class__.objects.filter(pk=self.pk).aaggregate(
-            dataset_video_count=Count('dataset_video_videos', distinct=True) +
-                               Count('dataset_video_audios', distinct=True) +
-                               Count('dataset_video_subtitles', distinct=True),
-            segment_count=Count('segment_videos', distinct=True) +
-                         Count('segment_subtitles', distinct=True)
-        )
+        return await type(self).objects.values_list('ref_count', flat=True).aget(pk=self.pk)
 
-        return result['dataset_video_count'] + result['segment_count']
+    @classmethod
+    def repair_ref_counts(cls):
+        """Recount the references to all files in one pass; returns how many counts were off"""
+        references = counted_references()
+        return cls.objects.exclude(ref_count=references).update(ref_count=references)
 
     def can_be_deleted(self):
         """Returns True if this is the last reference to the file"""
@@ -185,45 +294,81 @@ class StoredFile(models.Model):
         """Returns uploader's username for error messages"""
         return self.created_by.username if self.created_by else "Unknown"
 
-    async def delete_local_file(self):
-        """Delete the local file if it exists"""
-        if not self.is_s3_file:
-            import os
+    def deletion_failure(self, error):
+        """Describes the failure to delete this file, for `safe_delete_with_files`"""
+        return {
+            'file': self,
+            'error': error,
+            'location': self.get_s3_location() or self.path,
+            'owner': self.get_owner_name(),
+        }
 
-            @sync_to_async
-            def delete_file():
-                full_path = os.path.join(settings.MEDIA_ROOT, self.path)
-                if os.path.exists(full_path):
-                    os.unlink(full_path)
-                    return True
-                return False
+    @classmethod
+    async def adelete_with_contents(cls, stored_files, session=None):
+        """
+        Delete the contents of `stored_files`, from S3 (in batches, if there is
+        a `session`) or local disk, then the records of those that are gone;
+        returns the failures, see `deletion_failure`
+        """
+        s3_keys = defaultdict(list)
+        local_paths = []
+        errors = {}
+        for stored_file in stored_files:
+            if not stored_file.is_s3_file:
+                local_paths.append(stored_file.path)
+            elif session:
+                s3_keys[stored_file.bucket].append(stored_file.key)
+            else:
+                # kept, not to lose track of the object
+                errors[stored_file.bucket, stored_file.key] = "AWS credentials required to delete S3 file"
 
-            return await delete_file()
-        return False
+        for path, error in (await run_file_io(delete_local_files, local_paths)).items():
+            errors[None, path] = error
+        for bucket, bucket_errors in zip(s3_keys, await gather_or_cancel(*(
+            delete_s3_objects(session, bucket, keys) for bucket, keys in s3_keys.items()
+        ))):
+            for key, error in bucket_errors.items():
+                errors[bucket, key] = error
 
-    async def delete_s3_file(self, session):
-        """Delete the S3 file if it exists"""
-        if self.is_s3_file:
-            async with session.client('s3') as s3:
-                try:
-                    await s3.delete_object(Bucket=self.bucket, Key=self.key)
-                    return True
-                except Exception as x:
-                    location = self.get_s3_location()
-                    owner = self.get_owner_name()
-                    raise RuntimeError(f"Failed to delete S3 file {location} (uploaded by {owner}): {x}")
-        return False
-
-    async def try_delete_file(self, session=None):
-        """Attempt to delete the physical file, return success status and error message"""
-        try:
-            if self.is_s3_file and session:
-                success = await self.delete_s3_file(session)
+        failed_files = []
+        deleted = []
+        for stored_file in stored_files:
+            if stored_file.is_s3_file:
+                error = errors.get((stored_file.bucket, stored_file.key))
+            else:
+                error = errors.get((None, stored_file.path))
+            if error:
+                failed_files.append(stored_file.deletion_failure(error))
             else:
-                success = await self.delete_local_file()
-            return success, None
-        except Exception as x:
-            return False, str(x)
+                deleted.append(stored_file.pk)
+
+        @sync_to_async
+        @transaction.atomic
+        def delete_rows():
+            with batched_ref_counts():
+                for ix in range(0, len(deleted), BATCH_SIZE):
+                    cls.objects.filter(pk__in=deleted[ix:ix + BATCH_SIZE]).delete()
+
+        await delete_rows()
+        return failed_files
+
+class ReferencesFiles(models.Model):
+    """
+    A model referencing stored files by `file_fields`, whose `ref_count`s are
+    adjusted in the transaction saving or deleting it
+    """
+    file_fields = ()
+
+    class Meta:
+        abstract = True
+
+    def file_ids(self):
+        return [getattr(self, f'{field}_id') for field in self.file_fields]
+
+    def save(self, *args, **kwargs):
+        # post_save is sent after the row is saved, outside its transaction
+        with transaction.atomic():
+            super().save(*args, **kwargs)
 
 class Dataset(models.Model):
     name = models.CharField(max_length=255)
@@ -249,27 +394,7 @@ class Dataset(models.Model):
         Safely delete dataset and all associated files.
         Returns (success, error_message, failed_files)
         """
-        from django.db import transaction
-
-        try:
-            # Delegate deletion to each DatasetVideo
-            async for dataset_video in self.dataset_videos.all():
-                success, error, failed_files = await dataset_video.safe_delete_with_files(session)
-                if not success:
-                    return False, error, failed_files
-
-            # All DatasetVideos deleted successfully, now delete this dataset
-            @sync_to_async
-            @transaction.atomic
-            def delete_dataset():
-                return self.delete()
-
-            await delete_dataset()
-
-            return True, None, []
-
-        except Exception as x:
-            return False, f"Failed to delete dataset: {x}", []
+        return await delete_with_files('dataset', session, datasets=Dataset.objects.filter(pk=self.pk))
 
     def has_nonowned_files(self, user):
         """
@@ -295,7 +420,7 @@ class Dataset(models.Model):
             models.Index(fields=["token"]),
         ]
 
-class DatasetVideo(models.Model):
+class DatasetVideo(ReferencesFiles):
     # TODO: rename to Video (also, dataset_videos -> videos)
     dataset = models.ForeignKey(Dataset, on_delete=models.CASCADE, related_name='dataset_videos')
     video = models.ForeignKey(StoredFile, on_delete=models.CASCADE, related_name='dataset_video_videos')
@@ -305,6 +430,8 @@ class DatasetVideo(models.Model):
     cuts = jsonfield.JSONField(default=list, blank=True)
     is_cut = models.BooleanField(default=False)
 
+    file_fields = ('video', 'audio', 'subtitles')
+
     def __str__(self):
         return self.name
 
@@ -316,63 +443,7 @@ class DatasetVideo(models.Model):
         Safely delete dataset video and all associated files.
         Returns (success, error_message, failed_files)
         """
-        from django.db import transaction
-
-        failed_files = []
-
-        try:
-            # Delegate deletion to each Segment
-            async for segment in self.segments.all():
-                success, error, segment_failed_files = await segment.safe_delete_with_files(session)
-                if not success:
-                    return False, error, segment_failed_files
-
-            # All segments deleted successfully, now handle own files using async operations
-            files_to_check = []
-            if self.video_id:
-                video_file = await StoredFile.objects.aget(pk=self.video_id)
-                files_to_check.append(video_file)
-            if self.audio_id:
-                audio_file = await StoredFile.objects.aget(pk=self.audio_id)
-                files_to_check.append(audio_file)
-            if self.subtitles_id:
-                subtitles_file = await StoredFile.objects.aget(pk=self.subtitles_id)
-                files_to_check.append(subtitles_file)
-
-            # Try to delete files that will become orphaned
-            for stored_file in files_to_check:
-                if await stored_file.acan_be_deleted():
-                    success, error = await stored_file.try_delete_file(session)
-                    if not success:
-                        failed_files.append({
-                            'file': stored_file,
-                            'error': error,
-                            'location': stored_file.get_s3_location() or stored_file.path,
-                            'owner': stored_file.get_owner_name()
-                        })
-                    else:
-                        # Physical file deleted successfully, now delete the database record
-                        await stored_file.adelete()
-
-            # If any file deletions failed, abort
-            if failed_files:
-                error_msg = "Cannot delete dataset video: failed to delete files:\n"
-                for failed in failed_files:
-                    error_msg += f"- {failed['location']} (uploaded by {failed['owner']}): {failed['error']}\n"
-                return False, error_msg, failed_files
-
-            # All file deletions succeeded, now delete this dataset video
-            @sync_to_async
-            @transaction.atomic
-            def delete_dataset_video():
-                return self.delete()
-
-            await delete_dataset_video()
-
-            return True, None, []
-
-        except Exception as x:
-            return False, f"Failed to delete dataset video: {x}", failed_files
+        return await delete_with_files('dataset video', session, dataset_videos=DatasetVideo.objects.filter(pk=self.pk))
 
     def has_nonowned_files(self, user):
         """
@@ -398,13 +469,17 @@ class DatasetVideo(models.Model):
 #     async_task('video_eval_app.tasks.cut_dataset_video', instance)
 
 
-class Segment(models.Model):
+class Segment(ReferencesFiles):
     video = models.ForeignKey(StoredFile, on_delete=models.CASCADE, related_name='segment_videos')
     subtitles = models.ForeignKey(StoredFile, on_delete=models.SET_NULL, related_name='segment_subtitles', null=True)
     created_at = models.DateTimeField(auto_now_add=True)
     dataset_video = models.ForeignKey(DatasetVideo, on_delete=models.CASCADE, related_name='segments')
     start = models.FloatField()
     end = models.FloatField(null=True)
+    # identifies the sources, bounds and encoder settings the video was cut with
+    cut_key = models.CharField(max_length=32, blank=True, db_index=True)
+
+    file_fields = ('video', 'subtitles')
 
     @property
     def start_ts(self):
@@ -425,54 +500,7 @@ class Segment(models.Model):
         Safely delete segment and all associated files.
         Returns (success, error_message, failed_files)
         """
-        from django.db import transaction
-
-        failed_files = []
-
-        try:
-            # Collect files from this Segment using async operations
-            files_to_check = []
-            if self.video_id:
-                video_file = await StoredFile.objects.aget(pk=self.video_id)
-                files_to_check.append(video_file)
-            if self.subtitles_id:
-                subtitles_file = await StoredFile.objects.aget(pk=self.subtitles_id)
-                files_to_check.append(subtitles_file)
-
-            # Try to delete files that will become orphaned
-            for stored_file in files_to_check:
-                if await stored_file.acan_be_deleted():
-                    success, error = await stored_file.try_delete_file(session)
-                    if not success:
-                        failed_files.append({
-                            'file': stored_file,
-                            'error': error,
-                            'location': stored_file.get_s3_location() or stored_file.path,
-                            'owner': stored_file.get_owner_name()
-                        })
-                    else:
-                        # Physical file deleted successfully, now delete the database record
-                        await stored_file.adelete()
-
-            # If any file deletions failed, abort
-            if failed_files:
-                error_msg = "Cannot delete segment: failed to delete files:\n"
-                for failed in failed_files:
-                    error_msg += f"- {failed['location']} (uploaded by {failed['owner']}): {failed['error']}\n"
-                return False, error_msg, failed_files
-
-            # All file deletions succeeded, now delete this segment
-            @sync_to_async
-            @transaction.atomic
-            def delete_segment():
-                return self.delete()
-
-            await delete_segment()
-
-            return True, None, []
-
-        except Exception as x:
-            return False, f"Failed to delete segment: {x}", failed_files
+        return await delete_with_files('segment', session, segments=Segment.objects.filter(pk=self.pk))
 
     def has_nonowned_files(self, user):
         """
@@ -487,6 +515,361 @@ class Segment(models.Model):
 
         return count > 0
 
+def referenced_by(queryset):
+    """Whether a row of `queryset` references the outer `StoredFile`"""
+    return reduce(or_, (Exists(queryset.filter(**{field: OuterRef('pk')})) for field in queryset.model.file_fields))
+
+def counted_references():
+    """How many dataset videos and segments reference the outer `StoredFile`"""
+    return reduce(add, (
+        Coalesce(Subquery(
+            model.objects.filter(**{field: OuterRef('pk')})
+            .order_by().values(field).annotate(count=Count('pk')).values('count')
+        ), 0)
+        for model in (DatasetVideo, Segment)
+        for field in model.file_fields
+    ))
+
+# ref count deltas by md5sum, while adjusting them in batch (see `batched_ref_counts`)
+_ref_counts = threading.local()
+
+def adjust_ref_counts(deltas):
+    """Add `deltas` (by md5sum) to the ref counts of the files"""
+    pending = getattr(_ref_counts, 'pending', None)
+    if pending is not None:
+        pending.update(deltas)
+        return
+    md5sums_by_delta = defaultdict(list)
+    for md5sum, delta in deltas.items():
+        if md5sum and delta:
+            md5sums_by_delta[delta].append(md5sum)
+    for delta, md5sums in md5sums_by_delta.items():
+        for ix in range(0, len(md5sums), BATCH_SIZE):
+            StoredFile.objects.filter(pk__in=md5sums[ix:ix + BATCH_SIZE]).update(
+                ref_count=Greatest(F('ref_count') + delta, 0),
+            )
+
+@contextmanager
+def batched_ref_counts():
+    """Adjust the ref counts once, in a few queries, for all the rows saved or deleted within"""
+    if getattr(_ref_counts, 'pending', None) is not None:
+        yield
+        return
+    _ref_counts.pending = Counter()
+    try:
+        yield
+        deltas, _ref_counts.pending = _ref_counts.pending, None
+        adjust_ref_counts(deltas)
+    finally:
+        _ref_counts.pending = None
+
+@receiver(pre_save, sender=DatasetVideo)
+@receiver(pre_save, sender=Segment)
+def remember_file_references(sender, instance, update_fields, **kwargs):
+    if update_fields is not None and not set(update_fields) & {
+        name for field in instance.file_fields for name in (field, f'{field}_id')
+    }:
+        instance._saved_file_ids = None
+    elif instance._state.adding:
+        instance._saved_file_ids = []
+    else:
+        saved = sender.objects.filter(pk=instance.pk).values_list(
+            *(f'{field}_id' for field in instance.file_fields)
+        ).first()
+        instance._saved_file_ids = list(saved or [])
+
+@receiver(post_save, sender=DatasetVideo)
+@receiver(post_save, sender=Segment)
+def count_file_references(sender, instance, **kwargs):
+    saved_file_ids = instance.__dict__.pop('_saved_file_ids', None)
+    if saved_file_ids is None:
+        return
+    deltas = Counter(instance.file_ids())
+    deltas.subtract(saved_file_ids)
+    adjust_ref_counts(deltas)
+
+@receiver(post_delete, sender=DatasetVideo)
+@receiver(post_delete, sender=Segment)
+def uncount_file_references(sender, instance, **kwargs):
+    deltas = Counter()
+    deltas.subtract(instance.file_ids())
+    adjust_ref_counts(deltas)
+
+async def delete_with_files(what, session=None, datasets=None, dataset_videos=None, segments=None):
+    """
+    Delete the `datasets`, `dataset_videos` and `segments` (querysets), with
+    everything in them and the stored files nothing else references, in a few
+    queries and batched S3 requests. If some files cannot be deleted, they are
+    kept, and so is what they are in (the other files are gone already).
+    Returns (success, error_message, failed_files)
+    """
+    datasets = datasets if datasets is not None else Dataset.objects.none()
+    dataset_videos = DatasetVideo.objects.filter(
+        Q(pk__in=(dataset_videos if dataset_videos is not None else DatasetVideo.objects.none()).values('pk'))
+        | Q(dataset__in=datasets.values('pk'))
+    )
+    segments = Segment.objects.filter(
+        Q(pk__in=(segments if segments is not None else Segment.objects.none()).values('pk'))
+        | Q(dataset_video__in=dataset_videos.values('pk'))
+    )
+    orphans = StoredFile.objects.filter(
+        referenced_by(segments) | referenced_by(dataset_videos)
+    ).exclude(
+        referenced_by(Segment.objects.exclude(pk__in=segments.values('pk')))
+        | referenced_by(DatasetVideo.objects.exclude(pk__in=dataset_videos.values('pk')))
+    ).select_related('created_by')
+
+    failed_files = []
+    try:
+        stored_files = [stored_file async for stored_file in orphans]
+        failed_files = await StoredFile.adelete_with_contents(stored_files, session)
+        if failed_files:
+            error_msg = f"Cannot delete {what}: failed to delete files:\n"
+            for failed in failed_files:
+                error_msg += f"- {failed['location']} (uploaded by {failed['owner']}): {failed['error']}\n"
+            return False, error_msg, failed_files
+
+        @sync_to_async
+        @transaction.atomic
+        def delete_rows():
+            with batched_ref_counts():
+                segments.delete()
+                dataset_videos.delete()
+                datasets.delete()
+
+        await delete_rows()
+        logger.info(f"Deleted {what} and {len(stored_files)} files")
+        return True, None, []
+
+    except Exception as x:
+        return False, f"Failed to delete {what}: {x}", failed_files
+
+class CutResult(models.Model):
+    """The video cut from given sources and bounds with a given encoder profile, see `Segment.cut_key`"""
+    cut_key = models.CharField(max_length=32, primary_key=True)
+    video = models.ForeignKey(StoredFile, on_delete=models.CASCADE, related_name='cut_results')
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __repr__(self):
+        return f'<CutResult {self.cut_key}: {self.video_id}>'
+
+class VideoJob(models.Model):
+    """Background processing (cutting and moving to S3) of an uploaded `DatasetVideo`"""
+    class Status(models.TextChoices):
+        QUEUED = 'queued', 'Queued'
+        RUNNING = 'running', 'Running'
+        DONE = 'done', 'Done'
+        FAILED = 'failed', 'Failed'
+
+    class Priority(models.IntegerChoices):
+        # lower values are processed first
+        INTERACTIVE = 0, 'Interactive'
+        NORMAL = 1, 'Normal'
+        BULK = 2, 'Bulk'
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4)
+    dataset_video = models.ForeignKey(DatasetVideo, on_delete=models.CASCADE, related_name='jobs')
+    created_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, related_name='video_jobs')
+    status = models.CharField(max_length=16, choices=Status.choices, default=Status.QUEUED)
+    priority = models.IntegerField(choices=Priority.choices, default=Priority.NORMAL)
+    error = models.TextField(blank=True)
+    # AWS credentials and S3 location to upload to; cleared once the job has finished
+    credentials = jsonfield.JSONField(null=True, blank=True)
+    location = models.CharField(max_length=255, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    # a running job belongs to `leased_by` until its lease expires, unless renewed;
+    # `attempts` counts the claims, and tells apart the leases of successive workers
+    leased_by = models.CharField(max_length=255, blank=True)
+    lease_expires_at = models.DateTimeField(null=True, blank=True, db_index=True)
+    attempts = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'priority', 'created_at']),
+        ]
+
+    def __repr__(self):
+        return f'<VideoJob {self.pk}: {self.status}>'
+
+    @classmethod
+    def claimable(cls):
+        """Queued jobs, and running jobs whose worker has stopped renewing their lease"""
+        return cls.objects.filter(
+            Q(status=cls.Status.QUEUED) |
+            Q(status=cls.Status.RUNNING, lease_expires_at__lt=timezone.now(), attempts__lt=settings.VIDEO_JOB_MAX_ATTEMPTS)
+        )
+
+    @classmethod
+    def claim(cls, worker_id, job_id=None):
+        """
+        Lease a claimable job (or job `job_id`) to `worker_id`, returns it or `None`.
+        Jobs are taken by priority, then from the users with the fewest running
+        jobs (so that one user's bulk upload does not hold up the others), then
+        oldest first.
+        """
+        running_for_user = cls.objects.filter(
+            created_by=OuterRef('created_by'), status=cls.Status.RUNNING,
+        ).values('created_by').annotate(count=Count('pk')).values('count')
+        candidates = cls.claimable().annotate(
+            running_for_user=Coalesce(Subquery(running_for_user), 0),
+        ).order_by('priority', 'running_for_user', 'created_at')
+        if job_id:
+            candidates = candidates.filter(pk=job_id)
+        with transaction.atomic():
+            if connection.features.has_select_for_update_skip_locked:
+                candidates = candidates.select_for_update(skip_locked=True)
+            for job in candidates[:10]:
+                # compare-and-set on `attempts`: where rows cannot be locked (SQLite),
+                # only one of the workers racing for the job gets to update it
+                now = timezone.now()
+                claimed = cls.objects.filter(pk=job.pk, attempts=job.attempts).update(
+                    status=cls.Status.RUNNING,
+                    leased_by=worker_id,
+                    lease_expires_at=now + timedelta(seconds=settings.VIDEO_JOB_LEASE),
+                    attempts=F('attempts') + 1,
+                    started_at=now,
+                )
+                if claimed:
+                    return cls.objects.select_related(
+                        'dataset_video__video', 'dataset_video__audio', 'dataset_video__subtitles',
+                    ).get(pk=job.pk)
+        return None
+
+    @classmethod
+    async def aclaim(cls, worker_id, job_id=None):
+        """Async version of claim"""
+        return await sync_to_async(cls.claim)(worker_id, job_id)
+
+    @classmethod
+    async def acheck_capacity(cls, user=None):
+        """Raise `asyncio.QueueFull` if no more jobs should be queued (for `user`)"""
+        queued = cls.objects.filter(status=cls.Status.QUEUED)
+        if settings.VIDEO_JOB_QUEUE_LIMIT and await queued.acount() >= settings.VIDEO_JOB_QUEUE_LIMIT:
+            raise asyncio.QueueFull("Too many videos are waiting to be processed")
+        if user and settings.VIDEO_JOB_USER_QUEUE_LIMIT:
+            if await queued.filter(created_by=user).acount() >= settings.VIDEO_JOB_USER_QUEUE_LIMIT:
+                raise asyncio.QueueFull("Too many of your videos are waiting to be processed")
+
+    def leased(self):
+        """This job, as long as it is still leased by the worker that claimed it"""
+        return type(self).objects.filter(
+            pk=self.pk, status=self.Status.RUNNING, leased_by=self.leased_by, attempts=self.attempts,
+        )
+
+    async def arenew_lease(self):
+        """Extend the lease, returns `False` if it has been lost to another worker"""
+        lease_expires_at = timezone.now() + timedelta(seconds=settings.VIDEO_JOB_LEASE)
+        return await self.leased().aupdate(lease_expires_at=lease_expires_at) > 0
+
+    async def afinish(self, status, error=''):
+        """Record the outcome of the job, unless its lease has been lost to another worker"""
+        self.status = status
+        self.error = error
+        return await self.leased().aupdate(
+            status=status,
+            error=error,
+            credentials=None,
+            finished_at=timezone.now(),
+            lease_expires_at=None,
+        ) > 0
+
+    @classmethod
+    async def afail_abandoned(cls):
+        """Give up on the jobs whose workers died `VIDEO_JOB_MAX_ATTEMPTS` times"""
+        return await cls.objects.filter(
+            status=cls.Status.RUNNING,
+            lease_expires_at__lt=timezone.now(),
+            attempts__gte=settings.VIDEO_JOB_MAX_ATTEMPTS,
+        ).aupdate(
+            status=cls.Status.FAILED,
+            error="The job was abandoned by its workers too many times",
+            credentials=None,
+            finished_at=timezone.now(),
+            lease_expires_at=None,
+        )
+
+    def status_data(self):
+        return {
+            "job_id": str(self.pk),
+            "dataset_video_id": self.dataset_video_id,
+            "status": self.status,
+            "error": self.error,
+            "created_at": self.created_at and self.created_at.isoformat(),
+            "started_at": self.started_at and self.started_at.isoformat(),
+            "finished_at": self.finished_at and self.finished_at.isoformat(),
+        }
+
+class ChunkedUpload(models.Model):
+    """
+    A video uploaded through the API in parts, each PUT at the current `offset`,
+    which a dropped connection can resume; see `views.chunked_upload`
+    """
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4)
+    dataset = models.ForeignKey(Dataset, on_delete=models.CASCADE, related_name='chunked_uploads')
+    created_by = models.ForeignKey(User, on_delete=models.CASCADE, related_name='chunked_uploads')
+    name = models.CharField(max_length=255)
+    size = models.BigIntegerField()
+    # bytes received so far, the parts are contiguous
+    offset = models.BigIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __repr__(self):
+        return f'<ChunkedUpload {self.pk}: {self.offset}/{self.size}>'
+
+    @property
+    def path(self):
+        """The parts received so far, in MEDIA_ROOT/tmp so that `store_file` can move them into place"""
+        return default_storage.path(os.path.join('tmp', 'uploads', f'{self.pk}.part'))
+
+    @property
+    def complete(self):
+        return self.offset == self.size
+
+    def status_data(self):
+        return {
+            "upload_id": str(self.pk),
+            "offset": self.offset,
+            "size": self.size,
+        }
+
+    async def aappend(self, start, stream, length):
+        """
+        Write up to `length` bytes of `stream` at `start`, which has to be the current offset.
+        Returns the number of bytes written, fewer if `stream` ended early, or `None`
+        if the offset has moved on in the meantime.
+        The part is received into a file of its own, and only then written into the
+        upload under its lock: a part sent again while the first one is still
+        arriving cannot write over what has been received since.
+        """
+        if start != self.offset:
+            return None
+        chunk_path, written = await run_file_io(receive_chunk, self.path, stream, length)
+        try:
+            async with chunked_upload_lock(self.path):
+                await self.arefresh_from_db(fields=['offset'])
+                if self.offset != start:
+                    return None
+                await run_file_io(append_chunk, self.pk, self.path, start, chunk_path)
+                self.offset = start + written
+                await type(self).objects.filter(pk=self.pk).aupdate(offset=self.offset, updated_at=timezone.now())
+        finally:
+            await run_file_io(os.unlink, chunk_path)
+        return written
+
+    async def aassemble(self):
+        """The complete upload, as a file `StoredFile.store` can move into place"""
+        md5 = await run_file_io(chunked_upload_md5, self.pk, self.path, self.offset)
+        return HashedFile(self.path, self.name, md5.hexdigest())
+
+    async def adiscard(self):
+        forget_chunked_upload(self.pk)
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        await self.adelete()
+
 class Project(models.Model):
     class WorkerIdentity(models.IntegerChoices):
         ANONYMOUS = 0, 'Anonymous'
@@ -1,15 +1,21 @@
 from icecream import ic
 
+import asyncio
+import hashlib
 import re
 import json
 import copy
+import threading
+import weakref
 from contextlib import asynccontextmanager
+from datetime import datetime, timezone
 
 
 from django.conf import settings
 from django.template.loader import render_to_string
 from django.apps import apps
 import aioboto3
+from aiobotocore.config import AioConfig
 import xmltodict
 
 from .utils import convert_answers
@@ -21,16 +27,143 @@ _title_case_re = re.compile(r'(?<!^)(?=[A-Z])')
 
 
 
+# credentials identifying a session, see `credentials_fingerprint`
+SESSION_CREDENTIALS = ('AccessKeyId', 'SecretAccessKey', 'SessionToken', 'RegionName', 'ProfileName')
+
+
+class AwsSession:
+    """
+    An aioboto3 session for one set of credentials, shared by the whole process
+    (see `make_aws_session`). Its S3 clients are kept open, one per event loop,
+    so that their connections (up to `S3_MAX_POOL_CONNECTIONS`) are kept alive
+    and reused by all storage calls; other clients are made as usual.
+    The clients of a loop are closed when it shuts down its async generators,
+    as `asyncio.run` does (and so `async_to_sync`, which runs each call in a
+    new loop when serving by WSGI).
+    """
+    def __init__(self, credentials, expires_at=None):
+        self.session = aioboto3.Session(
+            aws_access_key_id=credentials.get('AccessKeyId'),
+            aws_secret_access_key=credentials.get('SecretAccessKey'),
+            aws_session_token=credentials.get('SessionToken'),
+            region_name=credentials.get('RegionName'),
+            profile_name=credentials.get('ProfileName'),
+        )
+        self.expires_at = expires_at
+        # event loop -> {client arguments: (client context, task entering it)}
+        self.s3_clients = weakref.WeakKeyDictionary()
+        # event loop -> async generator closing its clients at its shutdown
+        self.closers = weakref.WeakKeyDictionary()
+
+    @property
+    def expired(self):
+        return self.expires_at is not None and self.expires_at <= datetime.now(timezone.utc)
+
+    def client(self, service_name, **kwargs):
+        if service_name != 's3':
+            return self.session.client(service_name, **kwargs)
+        return self._s3_client(kwargs)
+
+    @asynccontextmanager
+    async def _s3_client(self, kwargs):
+        loop = asyncio.get_running_loop()
+        if loop not in self.s3_clients:
+            # loops that were closed without shutting down their async generators
+            for closed_loop in [closed_loop for closed_loop in self.s3_clients if closed_loop.is_closed()]:
+                del self.s3_clients[closed_loop]
+                self.closers.pop(closed_loop, None)
+            self.s3_clients[loop] = {}
+            closer = self.closers[loop] = self._close_at_shutdown()
+            await anext(closer)
+        clients = self.s3_clients[loop]
+        key = tuple(sorted(kwargs.items()))
+        if key not in clients:
+            config = AioConfig(
+                max_pool_connections=settings.S3_MAX_POOL_CONNECTIONS,
+                tcp_keepalive=True,
+            )
+            context = self.session.client('s3', config=config, **kwargs)
+            clients[key] = (context, asyncio.ensure_future(context.__aenter__()))
+        _context, entering = clients[key]
+        try:
+            client = await asyncio.shield(entering)
+        except Exception:
+            clients.pop(key, None)
+            raise
+        # left open for the next caller
+        yield client
+
+    async def aclose(self):
+        """Close the S3 clients of the current event loop"""
+        loop = asyncio.get_running_loop()
+        if closer := self.closers.pop(loop, None):
+            await closer.aclose()
+        await close_s3_clients(self.s3_clients.pop(loop, {}))
+
+    async def _close_at_shutdown(self):
+        """Async generator, started once per event loop, closing its S3 clients when it shuts down"""
+        try:
+            yield
+        finally:
+            loop = asyncio.get_running_loop()
+            # the generator refers to the loop, which must not be kept alive
+            self.closers.pop(loop, None)
+            await close_s3_clients(self.s3_clients.pop(loop, {}))
+
+    def close_soon(self):
+        """Close the S3 clients of all event loops, from any thread"""
+        for loop in list(self.s3_clients):
+            if not loop.is_closed():
+                loop.call_soon_threadsafe(lambda loop=loop: loop.create_task(self.aclose()))
+
+
+async def close_s3_clients(clients):
+    while clients:
+        _key, (context, entering) = clients.popitem()
+        if entering.done() and not entering.exception():
+            await context.__aexit__(None, None, None)
+
+
+# shared sessions, by credentials fingerprint
+_aws_sessions = {}
+_aws_sessions_lock = threading.Lock()
+
+def credentials_fingerprint(credentials):
+    data = json.dumps([credentials.get(name) for name in SESSION_CREDENTIALS])
+    return hashlib.sha256(data.encode()).hexdigest()
+
+def credentials_expiration(credentials):
+    expiration = credentials.get('Expiration')
+    if isinstance(expiration, str):
+        expiration = datetime.fromisoformat(expiration)
+    if expiration and expiration.tzinfo is None:
+        expiration = expiration.replace(tzinfo=timezone.utc)
+    return expiration
+
 def make_aws_session(credentials):
-    session = aioboto3.Session(
-        aws_access_key_id=credentials.get('AccessKeyId'),
-        aws_secret_access_key=credentials.get('SecretAccessKey'),
-        aws_session_token=credentials.get('SessionToken'),
-        region_name=credentials.get('RegionName'),
-        profile_name=credentials.get('ProfileName'),
-    )
+    """
+    The session for `credentials`, shared with every other user of the same
+    credentials until they expire (`Expiration`), when its clients are closed
+    """
+    fingerprint = credentials_fingerprint(credentials)
+    with _aws_sessions_lock:
+        for key, session in list(_aws_sessions.items()):
+            if session.expired:
+                del _aws_sessions[key]
+                session.close_soon()
+        session = _aws_sessions.get(fingerprint)
+        if session is None:
+            session = AwsSession(credentials, credentials_expiration(credentials))
+            _aws_sessions[fingerprint] = session
     return session
 
+async def aclose_aws_sessions():
+    """Close the S3 clients the shared sessions opened in the current event loop"""
+    with _aws_sessions_lock:
+        sessions = list(_aws_sessions.values())
+    for session in sessions:
+        await session.aclose()
+
 
 class MTurk:
     statuses = {
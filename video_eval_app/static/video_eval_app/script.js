@@ -17,3 +17,53 @@ function highlightOnClick(el) {
   el.addEventListener('mousedown', checkIfSelected)
   el.addEventListener('click', selectContents)
 }
+
+// a job whose progress has not been updated for this long might be stuck
+const PROGRESS_STALLED_SECS = 60
+
+function formatDuration(secs) {
+  const minutes = Math.floor(secs / 60)
+  const seconds = String(secs % 60).padStart(2, '0')
+  return `${minutes}:${seconds}`
+}
+function describeProgress(progress) {
+  if (!progress) return 'Queued...'
+  switch (progress.status) {
+    case 'cutting': {
+      let text = `Cutting ${progress.segments_done}/${progress.segments}`
+      if (progress.speed) text += ` at ${progress.speed.toFixed(1)}x`
+      if (progress.eta !== null) text += `, ${formatDuration(progress.eta)} left`
+      if (Date.now() / 1000 - progress.updated_at > PROGRESS_STALLED_SECS) text += ' (stalled?)'
+      return text
+    }
+    case 'storing':
+      return 'Storing...'
+    case 'done':
+      return 'Done, reload to see it'
+    case 'failed':
+      return `Failed: ${progress.error}`
+  }
+}
+// elements with `data-progress-url` (the progress stream) show the progress
+// of the video `data-progress-video`, or else of the dataset `data-progress-dataset`;
+// the datasets of the page are followed through a single stream, as browsers
+// only open a few connections to a server at once
+function followProgress() {
+  const els = document.querySelectorAll('[data-progress-url]')
+  if (!els.length) return
+  const url = new URL(els[0].dataset.progressUrl, location.href)
+  for (const datasetId of new Set(Array.from(els, el => el.dataset.progressDataset))) {
+    url.searchParams.append('dataset', datasetId)
+  }
+  const source = new EventSource(url)
+  source.addEventListener('message', evt => {
+    const data = JSON.parse(evt.data)
+    for (const el of els) {
+      const videoId = el.dataset.progressVideo
+      const progress = videoId ? data.videos[videoId] : data.datasets[el.dataset.progressDataset]
+      el.querySelector('.progress-text').textContent = describeProgress(progress)
+    }
+  })
+  source.addEventListener('end', () => source.close())
+}
+document.addEventListener('DOMContentLoaded', followProgress)
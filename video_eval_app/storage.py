@@ -1,11 +1,19 @@
 from django.template.defaultfilters import default
 from icecream import ic # XXX: remove later
 
+import asyncio
 import hashlib
+import logging
 import os
+import re
 import uuid
 import shutil
+import threading
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import asynccontextmanager
+from functools import partial
 from tempfile import NamedTemporaryFile
 
 from django.conf import settings
@@ -16,9 +24,12 @@ import jsonfield
 from django.core.files.storage import default_storage
 import botocore
 import boto3
+from boto3.s3.transfer import TransferConfig
 
 from .mturk import make_aws_session
+from .async_queue import gather_or_cancel
 
+logger = logging.getLogger(__name__)
 
 CONTENT_TYPES = {
     ".mp4": "video/mp4",
@@ -31,6 +42,25 @@ CONTENT_TYPES = {
 }
 
 
+_file_io_executor = None
+_file_io_executor_lock = threading.Lock()
+
+def file_io_executor():
+    """The thread pool, of `FILE_IO_THREADS` threads, running the blocking file I/O of the event loops"""
+    global _file_io_executor
+    with _file_io_executor_lock:
+        if _file_io_executor is None:
+            _file_io_executor = ThreadPoolExecutor(max_workers=settings.FILE_IO_THREADS, thread_name_prefix='file-io')
+        return _file_io_executor
+
+async def run_file_io(func, *args, **kwargs):
+    """
+    Run blocking file I/O (copying, hashing, which releases the GIL, parsing)
+    in `file_io_executor`, so that it does not hold up the event loop
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(file_io_executor(), partial(func, *args, **kwargs))
+
 def md5_sum(file):
     md5_hash = hashlib.md5()
     for chunk in file.chunks():
@@ -38,19 +68,44 @@ def md5_sum(file):
     h = md5_hash.hexdigest()
     return h
 
+# read buffer of `md5_path`, large enough to make few system calls
+MD5_BUFFER_SIZE = 8 * 1024 * 1024
+
+def md5_path(path):
+    """The md5 of the file at `path`, read into one reused buffer"""
+    md5_hash = hashlib.md5()
+    buffer = bytearray(MD5_BUFFER_SIZE)
+    view = memoryview(buffer)
+    with open(path, 'rb', buffering=0) as f:
+        while size := f.readinto(buffer):
+            md5_hash.update(view[:size])
+    return md5_hash.hexdigest()
+
 def md5_file_name(name, h):
     _, ext = os.path.splitext(name)
     return os.path.join(h[0], h[1], h + ext.lower())
 
-def store_file(file, subdir, session, location):
+def store_file(file, subdir, session, location, md5sum=None):
+    """Write `file` under `subdir`, named after its md5 (`md5sum`, if it is known already)"""
+    if hasattr(file, 'md5sum'):
+        # already hashed, and on disk in MEDIA_ROOT/tmp (uploaded by `HashingFileUploadHandler`,
+        # or written by ffmpeg): renamed into place, without copying
+        md5sum = file.md5sum
+        path = os.path.join(subdir, md5_file_name(file.name, md5sum))
+        real_path = default_storage.path(path)
+        os.makedirs(os.path.dirname(real_path), exist_ok=True)
+        shutil.move(file.temporary_file_path(), real_path)
+        return file.name, path, md5sum
+
     temp_dir = default_storage.path('tmp')
     os.makedirs(temp_dir, exist_ok=True)
     with NamedTemporaryFile(delete=False, dir=temp_dir) as temp_file:
-        md5_hash = hashlib.md5()
+        md5_hash = None if md5sum else hashlib.md5()
         for chunk in file.chunks():
             temp_file.write(chunk)
-            md5_hash.update(chunk)
-        h = md5_hash.hexdigest()
+            if md5_hash:
+                md5_hash.update(chunk)
+        h = md5sum or md5_hash.hexdigest()
     
     path = os.path.join(subdir, md5_file_name(file.name, h))
     real_path = default_storage.path(path)
@@ -66,6 +121,196 @@ def store_file(file, subdir, session, location):
     
     return file.name, path, h
 
+# the size of the reads of `read_file_range`
+FILE_RANGE_CHUNK_SIZE = 256 * 1024
+
+def read_file_range(name, start, length):
+    """Yield the `length` bytes of file `name` from `start`, read in chunks as they are sent"""
+    with open(name, 'rb') as f:
+        f.seek(start)
+        while length > 0 and (data := f.read(min(length, FILE_RANGE_CHUNK_SIZE))):
+            length -= len(data)
+            yield data
+
+def s3_location_key(path, location):
+    """The bucket and key under which `path` is stored in S3 `location` (`bucket/dir`)"""
+    bucket, *dir_list = location.split('/', 1)
+    if dir_list:
+        dir_key = dir_list[0]
+    else:
+        dir_key = ""
+    key = f"{dir_key}/{path}" if dir_key else path
+    return bucket, key
+
+def transfer_config():
+    """How S3 uploads and downloads are split into parts, see the `S3_MULTIPART_*` settings"""
+    return TransferConfig(
+        multipart_threshold=settings.S3_MULTIPART_THRESHOLD,
+        multipart_chunksize=settings.S3_MULTIPART_PART_SIZE,
+        max_concurrency=settings.S3_TRANSFER_CONCURRENCY,
+    )
+
+class TransferBudget:
+    """
+    Limits the S3 transfers of an event loop (see `transfer_budget`): at most
+    `S3_MAX_TRANSFERS` files at once, sharing `S3_MAX_BANDWIDTH` bytes per second
+    """
+    def __init__(self):
+        self.slots = asyncio.Semaphore(settings.S3_MAX_TRANSFERS)
+        self.allowance = 0
+        self.updated_at = time.monotonic()
+
+    async def throttle(self, size):
+        """Wait until `size` more bytes fit in the bandwidth"""
+        bandwidth = settings.S3_MAX_BANDWIDTH
+        if not bandwidth:
+            return
+        # a token bucket holding up to a second of bandwidth, which transfers may overdraw
+        now = time.monotonic()
+        self.allowance = min(bandwidth, self.allowance + (now - self.updated_at) * bandwidth) - size
+        self.updated_at = now
+        if self.allowance < 0:
+            await asyncio.sleep(-self.allowance / bandwidth)
+
+_transfer_budgets = weakref.WeakKeyDictionary()
+
+def transfer_budget():
+    """The `TransferBudget` of the current event loop"""
+    loop = asyncio.get_running_loop()
+    if loop not in _transfer_budgets:
+        _transfer_budgets[loop] = TransferBudget()
+    return _transfer_budgets[loop]
+
+class ThrottledFile:
+    """A file read or written through `run_file_io`, at the pace of a `TransferBudget`"""
+    def __init__(self, file, budget):
+        self.file = file
+        self.budget = budget
+        self.size = 0
+
+    async def read(self, size=-1):
+        data = await run_file_io(self.file.read, size)
+        self.size += len(data)
+        await self.budget.throttle(len(data))
+        return data
+
+    async def seek(self, offset, whence=0):
+        return await run_file_io(self.file.seek, offset, whence)
+
+    async def write(self, data):
+        await self.budget.throttle(len(data))
+        self.size += len(data)
+        return await run_file_io(self.file.write, data)
+
+def log_transfer(action, url, size, seconds):
+    rate = size / max(seconds, 1e-6)
+    logger.info(
+        f"{action} {url}: {size / 1024 / 1024:.1f} MB in {seconds:.2f}s "
+        f"({rate / 1024 / 1024:.1f} MB/s, {rate * 8 / 1e9:.2f} Gbit/s)"
+    )
+
+async def upload_to_s3(s3, file_name, bucket, key, extra_args=None):
+    """Upload `file_name` in parallel parts, within the transfer budget"""
+    budget = transfer_budget()
+    async with budget.slots:
+        started = time.monotonic()
+        with open(file_name, 'rb') as f:
+            file = ThrottledFile(f, budget)
+            await s3.upload_fileobj(file, bucket, key, ExtraArgs=extra_args, Config=transfer_config())
+        log_transfer("Uploaded", f"s3://{bucket}/{key}", file.size, time.monotonic() - started)
+
+async def download_from_s3(s3, bucket, key, file_name):
+    """Download to `file_name` in parallel parts, within the transfer budget"""
+    budget = transfer_budget()
+    async with budget.slots:
+        started = time.monotonic()
+        with open(file_name, 'wb') as f:
+            file = ThrottledFile(f, budget)
+            await s3.download_fileobj(bucket, key, file, Config=transfer_config())
+        log_transfer("Downloaded", f"s3://{bucket}/{key}", file.size, time.monotonic() - started)
+
+# the most keys a DeleteObjects request takes
+S3_DELETE_BATCH_SIZE = 1000
+
+async def file_size(path, bucket, key, session):
+    """The size of a stored file, local or in S3; `None` if it is in S3 and there is no `session`"""
+    if bucket and key:
+        if not session:
+            return None
+        async with session.client('s3') as s3:
+            head = await s3.head_object(Bucket=bucket, Key=key)
+        return head['ContentLength']
+    return await run_file_io(os.path.getsize, default_storage.path(path))
+
+async def delete_s3_objects(session, bucket, keys):
+    """
+    Delete `keys` from `bucket` by DeleteObjects requests, up to
+    `S3_DELETE_CONCURRENCY` at once; returns the errors by key
+    """
+    errors = {}
+    slots = asyncio.Semaphore(settings.S3_DELETE_CONCURRENCY)
+
+    async def delete_batch(s3, batch):
+        async with slots:
+            try:
+                response = await s3.delete_objects(Bucket=bucket, Delete={
+                    'Objects': [{'Key': key} for key in batch],
+                    'Quiet': True,
+                })
+            except Exception as x:
+                logger.error(f"Failed to delete {len(batch)} objects from bucket {bucket}: {x}")
+                errors.update((key, str(x)) for key in batch)
+                return
+        for error in response.get('Errors', []):
+            errors[error['Key']] = f"{error.get('Code')}: {error.get('Message')}"
+
+    async with session.client('s3') as s3:
+        await gather_or_cancel(*(
+            delete_batch(s3, keys[ix:ix + S3_DELETE_BATCH_SIZE])
+            for ix in range(0, len(keys), S3_DELETE_BATCH_SIZE)
+        ))
+    return errors
+
+def delete_local_files(paths):
+    """Delete `paths` (in MEDIA_ROOT), if they exist; returns the errors by path"""
+    errors = {}
+    for path in paths:
+        try:
+            os.unlink(default_storage.path(path))
+        except FileNotFoundError:
+            pass
+        except OSError as x:
+            errors[path] = str(x)
+    return errors
+
+def scan_files(top, cutoff):
+    """
+    Yield `(name, size)` of the files under directory `top` (by `os.scandir`,
+    recursively) last modified before `cutoff`, a timestamp
+    """
+    try:
+        entries = os.scandir(top)
+    except FileNotFoundError:
+        return
+    with entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                yield from scan_files(entry.path, cutoff)
+            elif entry.is_file(follow_symlinks=False):
+                stat = entry.stat(follow_symlinks=False)
+                if stat.st_mtime < cutoff:
+                    yield entry.path, stat.st_size
+
+async def list_s3_objects(s3, bucket, prefix):
+    """Yield the objects under `prefix` in `bucket` by pages of up to 1000, following ListObjectsV2 pagination"""
+    kwargs = {'Bucket': bucket, 'Prefix': prefix}
+    while True:
+        response = await s3.list_objects_v2(**kwargs)
+        yield response.get('Contents', [])
+        if not response.get('IsTruncated'):
+            return
+        kwargs['ContinuationToken'] = response['NextContinuationToken']
+
 async def delocalize_file(path, session, location):
     if not (session and location):
         return None
@@ -77,12 +322,7 @@ async def delocalize_file(path, session, location):
     _, ext = os.path.splitext(path)
     content_type = CONTENT_TYPES.get(ext)
 
-    bucket, *dir_list = location.split('/', 1)
-    if dir_list:
-        dir_key = dir_list[0]
-    else:
-        dir_key = ""
-    key = f"{dir_key}/{path}" if dir_key else path
+    bucket, key = s3_location_key(path, location)
 
     async with session.client('s3') as s3:
         try:
@@ -95,7 +335,7 @@ async def delocalize_file(path, session, location):
                 'ContentType': content_type,
             }
             try:
-                await s3.upload_file(real_path, bucket, key, ExtraArgs=extra_args)
+                await upload_to_s3(s3, real_path, bucket, key, extra_args)
             except boto3.exceptions.S3UploadFailedError as e:
                 logger.error(f"S3 upload failed for {key} to bucket {bucket}: {str(e)}")
                 # Clean up local file since upload failed
@@ -111,15 +351,278 @@ async def delocalize_file(path, session, location):
     os.unlink(real_path)
     return bucket, key
 
+async def stream_to_s3(write_to, name, subdir, session, location):
+    """
+    Upload the bytes that `write_to(write)` passes to `await write(data)` to S3
+    `location`, without touching local disk: they are hashed on the way and sent
+    as a multipart upload (in parts of `S3_MULTIPART_PART_SIZE`) under a temporary
+    key, which is then renamed, by a server-side copy, to the path under `subdir`
+    named after their md5. Returns `(path, md5sum, bucket, key)`.
+    """
+    _, ext = os.path.splitext(name)
+    content_type = CONTENT_TYPES.get(ext.lower(), 'application/octet-stream')
+    bucket, temp_key = s3_location_key(f"tmp/{uuid.uuid4().hex}{ext.lower()}", location)
+    md5_hash = hashlib.md5()
+    buffer = bytearray()
+    parts = []
+    budget = transfer_budget()
+    size = 0
+    started = time.monotonic()
+
+    async with session.client('s3') as s3:
+        upload = await s3.create_multipart_upload(Bucket=bucket, Key=temp_key, ContentType=content_type)
+        upload_id = upload['UploadId']
+
+        async def upload_part():
+            part_number = len(parts) + 1
+            response = await s3.upload_part(
+                Bucket=bucket, Key=temp_key, UploadId=upload_id, PartNumber=part_number, Body=bytes(buffer),
+            )
+            parts.append({'ETag': response['ETag'], 'PartNumber': part_number})
+            buffer.clear()
+
+        async def write(data):
+            nonlocal size
+            await budget.throttle(len(data))
+            md5_hash.update(data)
+            buffer.extend(data)
+            size += len(data)
+            # waiting for the part to be uploaded holds up the writer, so at most a part is buffered
+            if len(buffer) >= settings.S3_MULTIPART_PART_SIZE:
+                await upload_part()
+
+        try:
+            await write_to(write)
+            if buffer or not parts:
+                await upload_part()
+            await s3.complete_multipart_upload(
+                Bucket=bucket, Key=temp_key, UploadId=upload_id, MultipartUpload={'Parts': parts},
+            )
+        except BaseException:
+            await s3.abort_multipart_upload(Bucket=bucket, Key=temp_key, UploadId=upload_id)
+            raise
+
+        md5sum = md5_hash.hexdigest()
+        path = os.path.join(subdir, md5_file_name(name, md5sum))
+        _, key = s3_location_key(path, location)
+        # a single copy is limited to 5 GB, which is plenty for a segment
+        await rename_s3_object(s3, bucket, temp_key, key, content_type)
+    log_transfer(f"Streamed {name} in {len(parts)} part(s) to", f"s3://{bucket}/{key}", size, time.monotonic() - started)
+    return path, md5sum, bucket, key
+
+async def rename_s3_object(s3, bucket, temp_key, key, content_type):
+    """Make the object at `temp_key` (of up to 5 GB) a public one at `key`, by a server-side copy"""
+    try:
+        await s3.copy_object(
+            Bucket=bucket,
+            Key=key,
+            CopySource={'Bucket': bucket, 'Key': temp_key},
+            ACL='public-read',
+            ContentType=content_type,
+            MetadataDirective='REPLACE',
+        )
+    finally:
+        await s3.delete_object(Bucket=bucket, Key=temp_key)
+
+def direct_upload_key(name, location):
+    """A new temporary key in S3 `location` for a client to upload `name` to, see `presign_upload`"""
+    _, ext = os.path.splitext(name)
+    return s3_location_key(f"tmp/uploads/{uuid.uuid4().hex}{ext.lower()}", location)
+
+async def presign_upload(session, bucket, key, name):
+    """
+    The `url` and form `fields` with which a client can POST `name` (of up to
+    `S3_DIRECT_UPLOAD_MAX_SIZE`) straight to `key`, within `S3_DIRECT_UPLOAD_EXPIRES`
+    """
+    _, ext = os.path.splitext(name)
+    content_type = CONTENT_TYPES.get(ext.lower(), 'application/octet-stream')
+    async with session.client('s3') as s3:
+        return await s3.generate_presigned_post(
+            Bucket=bucket,
+            Key=key,
+            Fields={'Content-Type': content_type},
+            Conditions=[
+                {'Content-Type': content_type},
+                ['content-length-range', 1, settings.S3_DIRECT_UPLOAD_MAX_SIZE],
+            ],
+            ExpiresIn=settings.S3_DIRECT_UPLOAD_EXPIRES,
+        )
+
+MD5_ETAG_RE = re.compile(r'"?([0-9a-f]{32})"?$')
+
+def etag_md5(head):
+    """The md5 of an S3 object from its `head_object`, if its ETag is that (single part, not encrypted by KMS or the client)"""
+    if head.get('ServerSideEncryption') == 'aws:kms' or head.get('SSECustomerAlgorithm'):
+        return None
+    match = MD5_ETAG_RE.match(head.get('ETag', ''))
+    return match and match.group(1)
+
+async def adopt_s3_upload(temp_key, name, subdir, session, location):
+    """
+    Move the object uploaded straight to `temp_key` (see `presign_upload`) to the
+    path under `subdir` named after its md5: its ETag, or else hashed while
+    streamed from S3. Returns `(path, md5sum, bucket, key)`, like `stream_to_s3`.
+    """
+    _, ext = os.path.splitext(name)
+    content_type = CONTENT_TYPES.get(ext.lower(), 'application/octet-stream')
+    bucket, _ = s3_location_key('', location)
+    async with session.client('s3') as s3:
+        head = await s3.head_object(Bucket=bucket, Key=temp_key)
+        if not (md5sum := etag_md5(head)):
+            budget = transfer_budget()
+            async with budget.slots:
+                md5_hash = hashlib.md5()
+                response = await s3.get_object(Bucket=bucket, Key=temp_key)
+                async with response['Body'] as body:
+                    while data := await body.read(settings.S3_MULTIPART_PART_SIZE):
+                        await budget.throttle(len(data))
+                        md5_hash.update(data)
+                md5sum = md5_hash.hexdigest()
+        path = os.path.join(subdir, md5_file_name(name, md5sum))
+        _, key = s3_location_key(path, location)
+        await rename_s3_object(s3, bucket, temp_key, key, content_type)
+    logger.info(f"Moved the upload of {name} from s3://{bucket}/{temp_key} to {key}")
+    return path, md5sum, bucket, key
+
+class LocalFileCache:
+    """
+    Size-bounded on-disk cache of files downloaded from S3, keyed by md5sum.
+
+    Entries are downloaded under a temporary name and renamed into place, so
+    processes filling the same entry at once never see a partial file. Each
+    user gets its own hard link to the entry, so that evicting the least
+    recently used entries never pulls a file from under a running ffmpeg.
+    """
+    FILL_PREFIX = '.fill-'
+    STALE_FILL_AGE = 24 * 60 * 60
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def directory(self):
+        return str(settings.LOCAL_CACHE_DIR or default_storage.path('cache'))
+
+    @property
+    def enabled(self):
+        return settings.LOCAL_CACHE_MAX_BYTES > 0
+
+    def entry_path(self, name, md5sum):
+        return os.path.join(self.directory, md5_file_name(name, md5sum))
+
+    def link(self, source, temp_name):
+        """Replace `temp_name` with a link to `source`, marking it as recently used"""
+        link_name = f"{temp_name}.link"
+        try:
+            os.link(source, link_name)
+        except FileNotFoundError:
+            raise
+        except OSError:
+            # e.g. the cache is on another filesystem
+            shutil.copyfile(source, link_name)
+        os.replace(link_name, temp_name)
+        os.utime(temp_name)
+
+    async def fetch(self, name, md5sum, download, temp_name):
+        """
+        Make the file `md5sum` available as `temp_name`, from the cache if
+        possible, otherwise calling `download(file_name)` to fill it first
+        """
+        entry = self.entry_path(name, md5sum)
+        try:
+            await run_file_io(self.link, entry, temp_name)
+        except FileNotFoundError:
+            self.misses += 1
+        else:
+            self.hits += 1
+            logger.debug(f"Local cache hit for {name} ({self.hits} hits, {self.misses} misses)")
+            return
+        logger.debug(f"Local cache miss for {name} ({self.hits} hits, {self.misses} misses)")
+
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        with NamedTemporaryFile(dir=os.path.dirname(entry), prefix=self.FILL_PREFIX, delete=False) as fill:
+            pass
+        try:
+            await download(fill.name)
+            await run_file_io(self.link, fill.name, temp_name)
+            if os.path.getsize(fill.name) <= settings.LOCAL_CACHE_MAX_BYTES:
+                os.replace(fill.name, entry)
+        finally:
+            if os.path.exists(fill.name):
+                os.unlink(fill.name)
+        await run_file_io(self.evict)
+
+    def evict(self):
+        """Delete the least recently used entries until the cache fits its budget"""
+        entries = []
+        now = time.time()
+        for dir_path, _, file_names in os.walk(self.directory):
+            for file_name in file_names:
+                path = os.path.join(dir_path, file_name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                if file_name.startswith(self.FILL_PREFIX):
+                    # left over by a process that died while downloading
+                    if now - stat.st_mtime > self.STALE_FILL_AGE:
+                        os.unlink(path)
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= settings.LOCAL_CACHE_MAX_BYTES:
+                break
+            try:
+                os.unlink(path)
+                logger.debug(f"Evicted {path} from the local cache")
+            except FileNotFoundError:
+                pass
+            total -= size
+
+local_cache = LocalFileCache()
+
 @asynccontextmanager
-async def local_file(path, bucket, key, session):
-    if bucket:
-        temp_dir = default_storage.path('tmp')
+async def local_files(files, session):
+    """
+    Make `files`, a list of `(path, bucket, key, md5sum)` (or `None`),
+    available locally, downloading those stored on S3 concurrently (or
+    serving them from the local cache). Yields the list of local file names
+    (or `None`); downloaded copies are deleted afterwards.
+    """
+    temp_dir = default_storage.path('tmp')
+    temp_names = []
+
+    async def materialize(file):
+        if file is None:
+            return None
+        path, bucket, key, md5sum = file
+        if not bucket:
+            return default_storage.path(path)
         os.makedirs(temp_dir, exist_ok=True)
-        with NamedTemporaryFile(dir=temp_dir) as temp_file:
-            temp_file.close()
+        with NamedTemporaryFile(dir=temp_dir, delete=False) as temp_file:
+            temp_names.append(temp_file.name)
+
+        async def download(file_name):
             async with session.client('s3') as s3:
-                await s3.download_file(bucket, key, temp_file.name)
-            yield temp_file.name
-    else:
-        yield default_storage.path(path)
+                await download_from_s3(s3, bucket, key, file_name)
+
+        if md5sum and local_cache.enabled:
+            await local_cache.fetch(path, md5sum, download, temp_file.name)
+        else:
+            await download(temp_file.name)
+        return temp_file.name
+
+    try:
+        yield await gather_or_cancel(*(materialize(file) for file in files))
+    finally:
+        for temp_name in temp_names:
+            if os.path.exists(temp_name):
+                os.unlink(temp_name)
+
+@asynccontextmanager
+async def local_file(path, bucket, key, session, md5sum=None):
+    async with local_files([(path, bucket, key, md5sum)], session) as (name,):
+        yield name
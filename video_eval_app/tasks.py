@@ -1,4 +1,5 @@
 from json import load
+import json
 from django.contrib.auth.decorators import sync_to_async
 
 from hashlib import md5
@@ -9,82 +10,534 @@ import logging
 import copy
 import os
 import asyncio
-from contextlib import nullcontext
+import random
+import threading
+import weakref
+import socket
+import time
+from datetime import timedelta
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, asynccontextmanager, ExitStack
 
 from ffmpeg.asyncio import FFmpeg # https://github.com/jonghwanhyeon/python-ffmpeg
 from django.conf import settings
-from django.core.files import File
+from django.core.cache import caches
+from django.utils import timezone
+from django.core.files import File, locks
 from django.core.files.storage import default_storage
 from webvtt import WebVTT
 
-from .models import Segment, DatasetVideo, Assignment, Worker, StoredFile
+from .models import (
+    Segment, DatasetVideo, Assignment, Worker, StoredFile, CutResult, VideoJob, ChunkedUpload,
+    BATCH_SIZE, referenced_by,
+)
 from django.contrib.auth.models import User
 from .utils import secs_to_timestamp, timestamp_to_secs, load_subtitles
-from .mturk import MTurk, make_aws_session
+from .mturk import MTurk, make_aws_session, aclose_aws_sessions
+from .async_queue import gather_or_cancel
+from .storage import (
+    md5_path, md5_sum, run_file_io, scan_files, list_s3_objects, s3_location_key,
+    delete_s3_objects, delete_local_files,
+)
+from .upload_handlers import HashedFile, forget_chunked_upload
 
 
 logger = logging.getLogger(__name__)
 
 
 
-async def cut_video(video, audio, start, end, temp_mp4):
-    t_opt = { "t": end - start } if end else {}
-    out_map = ['0:v', '1:a'] if audio else ['0']
+def get_cut_bounds(cut):
+    start = cut[0]
+    end = cut[1] if len(cut) > 1 else None
+    return start, end
+
+
+# bump when a change to the cutting code changes the encoded segments
+ENCODER_VERSION = 1
+
+def get_encoder_profile(stream_to_s3=False):
+    """The settings that determine how segments are encoded (see `FFMPEG_STREAM_TO_S3`)"""
+    if stream_to_s3:
+        # fragmented MP4, always re-encoded
+        return {
+            'version': ENCODER_VERSION,
+            'seek': settings.FFMPEG_SEEK_MODE,
+            'smart_cut': False,
+            'stream_to_s3': True,
+        }
+    return {
+        'version': ENCODER_VERSION,
+        'seek': settings.FFMPEG_SEEK_MODE,
+        'smart_cut': settings.FFMPEG_SMART_CUT,
+    }
+
+def get_cut_key(video_md5, audio_md5, start, end, stream_to_s3=False):
+    """Identify the segment cut from the given sources and bounds with the current encoder profile"""
+    data = [video_md5, audio_md5, float(start), end and float(end), get_encoder_profile(stream_to_s3)]
+    return md5(json.dumps(data, sort_keys=True).encode()).hexdigest()
+
+
+@contextmanager
+def temp_file_name(suffix):
+    """Reserve a unique file name in MEDIA_ROOT/tmp; remove the file afterwards"""
+    temp_dir = default_storage.path('tmp')
+    os.makedirs(temp_dir, exist_ok=True)
+    with NamedTemporaryFile(dir=temp_dir, suffix=suffix, delete=False) as temp_file:
+        pass
+    try:
+        yield temp_file.name
+    finally:
+        if os.path.exists(temp_file.name):
+            os.unlink(temp_file.name)
+
+
+def plan_passes(cuts):
+    """
+    Split cuts into groups that can each be encoded by one ffmpeg run.
+    Cuts are grouped by start time, so that each run can seek to its own part
+    of the source, and there are enough groups to keep `FFMPEG_CONCURRENCY`
+    ffmpeg processes busy.
+    """
+    num_passes = min(len(cuts), settings.FFMPEG_CONCURRENCY)
+    max_outputs = -(-len(cuts) // num_passes)
+    if settings.FFMPEG_MAX_OUTPUTS_PER_PASS:
+        max_outputs = min(max_outputs, settings.FFMPEG_MAX_OUTPUTS_PER_PASS)
+    indices = sorted(range(len(cuts)), key=lambda ix: cuts[ix][0])
+    return [indices[ix:ix + max_outputs] for ix in range(0, len(indices), max_outputs)]
+
+
+def ffmpeg_threads():
+    """
+    The threads of each ffmpeg process: an even share of `FFMPEG_THREADS`
+    among the `FFMPEG_CONCURRENCY` slots, so that they never add up to more
+    """
+    return max(1, settings.FFMPEG_THREADS // settings.FFMPEG_CONCURRENCY)
+
+
+# The ffmpeg slots of each event loop, gating its waiters before the host-wide lock
+_local_ffmpeg_slots = weakref.WeakKeyDictionary()
+
+def local_ffmpeg_slots():
+    loop = asyncio.get_running_loop()
+    if loop not in _local_ffmpeg_slots:
+        _local_ffmpeg_slots[loop] = asyncio.Semaphore(settings.FFMPEG_CONCURRENCY)
+    return _local_ffmpeg_slots[loop]
+
+
+_ffmpeg_slot_executor = None
+_ffmpeg_slot_executor_lock = threading.Lock()
 
-    ffmpeg = FFmpeg()
+def ffmpeg_slot_executor():
+    """The threads waiting for the host-wide ffmpeg slots, apart from `run_file_io`"""
+    global _ffmpeg_slot_executor
+    with _ffmpeg_slot_executor_lock:
+        if _ffmpeg_slot_executor is None:
+            _ffmpeg_slot_executor = ThreadPoolExecutor(
+                max_workers=settings.FFMPEG_CONCURRENCY, thread_name_prefix='ffmpeg-slot')
+        return _ffmpeg_slot_executor
+
+
+def lock_ffmpeg_slot():
+    """
+    Lock the file of a free ffmpeg slot of this host and return it, blocking
+    on one of them while other processes hold them all
+    """
+    os.makedirs(settings.FFMPEG_SLOTS_DIR, exist_ok=True)
+    names = [os.path.join(settings.FFMPEG_SLOTS_DIR, f'{ix}.lock') for ix in range(settings.FFMPEG_CONCURRENCY)]
+    for name in names:
+        f = open(name, 'ab')
+        if locks.lock(f, locks.LOCK_EX | locks.LOCK_NB):
+            return f
+        f.close()
+    f = open(random.choice(names), 'ab')
+    locks.lock(f, locks.LOCK_EX)
+    return f
+
+
+@asynccontextmanager
+async def ffmpeg_slot():
+    """
+    Wait for one of the `FFMPEG_CONCURRENCY` ffmpeg slots of this host, held
+    as a lock on a file in `FFMPEG_SLOTS_DIR`, so that the limit holds across
+    event loops and processes (e.g. the web process and `video_worker`).
+    Yields the number of threads for the ffmpeg process.
+    """
+    async with local_ffmpeg_slots():
+        locking = asyncio.get_running_loop().run_in_executor(ffmpeg_slot_executor(), lock_ffmpeg_slot)
+        try:
+            slot_file = await asyncio.shield(locking)
+        except asyncio.CancelledError:
+            # the lock is still taken in its thread: release it once it is
+            locking.add_done_callback(lambda locking: locking.exception() or locking.result().close())
+            raise
+        try:
+            yield ffmpeg_threads()
+        finally:
+            slot_file.close()
+
+
+def cut_ffmpeg(video, audio, cuts, output_names, seek=None, encode_opts=None, output_opts=None, threads=None):
+    """The ffmpeg run of `cut_video_segments`, with `output_opts` added to every output"""
+    seek = seek or settings.FFMPEG_SEEK_MODE
+    threads = threads or settings.FFMPEG_THREADS
+    if seek == "input":
+        base = min(start for start, _end in cuts)
+        in_opts = { "ss": base } if base else {}
+    else:
+        base = 0
+        in_opts = {}
+    in_opts["threads"] = threads
+
+    ffmpeg = FFmpeg().option('y')
     ffmpeg = ffmpeg.input(
         video,
+        **in_opts,
     )
     copy_opts = {
-        'c:v': 'libx264'
+        'c:v': 'libx264',
+        'threads': threads,
+        **(encode_opts or {}),
+        **(output_opts or {}),
     }
     if audio:
         ffmpeg = ffmpeg.input(
             audio,
+            **in_opts,
         )
         copy_opts['c:a'] = 'aac'
         out_map = ['0:v', '1:a']
     else:
         out_map = ['0']
-    ffmpeg = ffmpeg.output(
-        temp_mp4.name,
-        map=out_map,
-        ss=start,
-        **t_opt,
-        **copy_opts
-    )
+    for (start, end), output_name in zip(cuts, output_names):
+        t_opt = { "t": end - start } if end else {}
+        ss_opt = { "ss": start - base } if start > base else {}
+        ffmpeg = ffmpeg.output(
+            output_name,
+            map=out_map,
+            **ss_opt,
+            **t_opt,
+            **copy_opts
+        )
     # import shlex; print(' '.join(shlex.quote(arg) for arg in ffmpeg.arguments))
+    return ffmpeg
+
+
+async def cut_video_segments(video, audio, cuts, output_names, seek=None, encode_opts=None, on_progress=None):
+    """
+    Cut all `cuts` (a list of `(start, end)` pairs) out of `video` (and `audio`)
+    in a single ffmpeg run: the source is decoded once, and every decoded frame
+    is handed to the outputs whose time window contains it.
+
+    With `seek="input"` (the default, see `FFMPEG_SEEK_MODE`), the inputs are
+    seeked to the earliest cut start: ffmpeg jumps to the preceding keyframe
+    and decodes only the frames from there on, discarding those before the
+    requested time, so the cut is still frame-accurate. With `seek="output"`,
+    every frame from the beginning of the file is decoded and thrown away.
+
+    `encode_opts` are added to the options of every output, and `on_progress`
+    is called with the `ffmpeg.Progress` events of the run.
+    """
+    def ffmpeg(threads):
+        return cut_ffmpeg(video, audio, cuts, output_names, seek, encode_opts, threads=threads)
+    # each output gets the time budget a separate ffmpeg run would have had
+    await run_ffmpeg(ffmpeg, output_names, settings.FFMPEG_TIMEOUT * len(cuts), on_progress)
+
+
+async def run_ffmpeg(ffmpeg, output_names, timeout, on_progress=None):
+    """
+    Execute `ffmpeg` once one of the `FFMPEG_CONCURRENCY` slots is free, check
+    that it wrote all `output_names`, and clean them up if not. `ffmpeg` may
+    also be a function building it for the number of threads it may use.
+    """
     try:
         # Execute with configurable timeout
-        await asyncio.wait_for(ffmpeg.execute(), timeout=settings.FFMPEG_TIMEOUT)
-        
-        # Verify output file was created and has reasonable size
-        if not os.path.exists(temp_mp4.name):
-            raise RuntimeError("FFmpeg completed but output file was not created")
-        
-        file_size = os.path.getsize(temp_mp4.name)
-        if file_size == 0:
-            raise RuntimeError("FFmpeg produced empty output file")
-        
-        logger.info(f"FFmpeg success: created {file_size} byte file")
-        
+        async with ffmpeg_slot() as threads:
+            if not isinstance(ffmpeg, FFmpeg):
+                ffmpeg = ffmpeg(threads)
+            if on_progress:
+                ffmpeg.on("progress", on_progress)
+            await asyncio.wait_for(ffmpeg.execute(), timeout=timeout)
+
+        # Verify output files were created and have reasonable size
+        total_size = 0
+        for output_name in output_names:
+            if not os.path.exists(output_name):
+                raise RuntimeError("FFmpeg completed but output file was not created")
+
+            file_size = os.path.getsize(output_name)
+            if file_size == 0:
+                raise RuntimeError("FFmpeg produced empty output file")
+            total_size += file_size
+
+        logger.info(f"FFmpeg success: created {len(output_names)} file(s), {total_size} bytes")
+
     except asyncio.TimeoutError:
-        logger.error(f"FFmpeg timeout after {settings.FFMPEG_TIMEOUT} seconds")
-        raise RuntimeError(f"Video processing timeout after {settings.FFMPEG_TIMEOUT} seconds")
-    
+        logger.error(f"FFmpeg timeout after {timeout} seconds")
+        raise RuntimeError(f"Video processing timeout after {timeout} seconds")
+
     except Exception as e:
         logger.error(f"FFmpeg failed: {str(e)}")
         # Clean up partial output
-        if os.path.exists(temp_mp4.name):
-            os.unlink(temp_mp4.name)
+        for output_name in output_names:
+            if os.path.exists(output_name):
+                os.unlink(output_name)
         raise RuntimeError(f"Video processing failed: {str(e)}")
 
+
+# MP4 that can be written to a pipe: fragments, with the moov box first
+FRAGMENTED_MP4_OPTS = {
+    'f': 'mp4',
+    'movflags': 'frag_keyframe+empty_moov+default_base_moof',
+}
+
+async def stream_ffmpeg(ffmpeg, write, timeout):
+    """
+    Execute `ffmpeg`, which writes its output to the standard output, once one
+    of the `FFMPEG_CONCURRENCY` slots is free, passing the output to `await write(data)`
+    as it comes: ffmpeg waits for `write`, so the output is not held in memory.
+    `ffmpeg` may also be a function building it, as for `run_ffmpeg`.
+    """
+    async with ffmpeg_slot() as threads:
+        if not isinstance(ffmpeg, FFmpeg):
+            ffmpeg = ffmpeg(threads)
+        process = await asyncio.create_subprocess_exec(
+            *ffmpeg.arguments,
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+
+        async def read_stdout():
+            size = 0
+            while data := await process.stdout.read(1024 * 1024):
+                await write(data)
+                size += len(data)
+            return size
+
+        try:
+            size, stderr, _ = await asyncio.wait_for(asyncio.gather(
+                read_stdout(), process.stderr.read(), process.wait(),
+            ), timeout=timeout)
+        except asyncio.TimeoutError:
+            logger.error(f"FFmpeg timeout after {timeout} seconds")
+            raise RuntimeError(f"Video processing timeout after {timeout} seconds")
+        finally:
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
+    if process.returncode:
+        error = stderr.decode(errors='replace').strip().splitlines()[-1:] or ['']
+        logger.error(f"FFmpeg failed: {error[0]}")
+        raise RuntimeError(f"Video processing failed: {error[0]}")
+    if not size:
+        raise RuntimeError("FFmpeg produced empty output")
+    logger.info(f"FFmpeg success: streamed {size} bytes")
+
+
+# x264 names of the H.264 profiles reported by ffprobe
+X264_PROFILES = {
+    'Constrained Baseline': 'baseline',
+    'Baseline': 'baseline',
+    'Main': 'main',
+    'High': 'high',
+    'High 10': 'high10',
+    'High 4:2:2': 'high422',
+    'High 4:4:4 Predictive': 'high444',
+}
+
+
+async def probe_media(path):
+    ffprobe = FFmpeg(executable="ffprobe").input(
+        path,
+        print_format="json",
+        show_format=None,
+        show_streams=None,
+    )
+    return json.loads(await ffprobe.execute())
+
+
+async def probe_video_packets(path):
+    """
+    Return `(time, is_keyframe)` for each packet of the first video stream
+    of `path`, in decoding order
+    """
+    ffprobe = FFmpeg(executable="ffprobe").input(
+        path,
+        select_streams="v:0",
+        show_entries="packet=pts_time,flags",
+        print_format="csv=p=0",
+    )
+    output = await ffprobe.execute()
+    packets = []
+    for line in output.decode().splitlines():
+        pts_time, _, flags = line.partition(',')
+        if pts_time and pts_time != 'N/A':
+            packets.append((float(pts_time), 'K' in flags))
+    return packets
+
+
+async def probe_smart_cut(video):
+    """
+    Check whether `video` can be cut without re-encoding, i.e.
+    whether its video is H.264 in MP4 with closed GOPs. Returns the
+    information needed by `smart_cut_video`, or `None` if the source has to
+    be fully re-encoded.
+    """
+    try:
+        probe = await probe_media(video)
+        packets = await probe_video_packets(video)
+    except Exception as x:
+        logger.warning(f"Smart cut: could not probe {video}: {x}")
+        return None
+
+    if 'mp4' not in probe['format']['format_name'].split(','):
+        return None
+    video_streams = [stream for stream in probe['streams'] if stream['codec_type'] == 'video']
+    if len(video_streams) != 1:
+        return None
+    video_stream = video_streams[0]
+    if video_stream['codec_name'] != 'h264' or video_stream.get('profile') not in X264_PROFILES:
+        return None
+
+    # frames shown before a keyframe but decoded after it (open GOP)
+    # would be lost when copying starts at that keyframe
+    keyframe_time = None
+    for time, is_keyframe in packets:
+        if is_keyframe:
+            keyframe_time = time
+        elif keyframe_time is not None and time < keyframe_time:
+            return None
+
+    # the partial GOPs at the ends of each cut are re-encoded to match the stream-copied rest
+    encode_opts = {
+        'profile:v': X264_PROFILES[video_stream['profile']],
+        'pix_fmt': video_stream['pix_fmt'],
+    }
+
+    start_time = float(probe['format'].get('start_time') or 0)
+    return {
+        'frame_times': sorted(time - start_time for time, _is_keyframe in packets),
+        'keyframes': sorted(time - start_time for time, is_keyframe in packets if is_keyframe),
+        'encode_opts': encode_opts,
+    }
+
+
+async def copy_video_stream(video, start, end, output_name, frames=None):
+    """
+    Stream-copy `start`-`end` of the video stream of `video`. `start` must be
+    a keyframe, and `frames` (the number of frames in the range) must be given
+    if `end` is, as a stream copy cannot stop exactly at a time.
+    """
+    t_opt = { "t": end - start, "frames:v": frames } if end else {}
+    in_opts = { "ss": start } if start else {}
+    ffmpeg = FFmpeg().option('y')
+    ffmpeg = ffmpeg.input(video, **in_opts)
+    ffmpeg = ffmpeg.output(
+        output_name,
+        map='0:v',
+        c='copy',
+        **t_opt,
+    )
+    await run_ffmpeg(ffmpeg, [output_name], settings.FFMPEG_TIMEOUT)
+
+
+async def join_video_parts(part_names, audio, start, end, output_name):
+    """
+    Concatenate the video-only MP4 `part_names`, adding the `start`-`end` audio
+    of `audio`. The H.264 parameter sets of the parts are kept in-band, so they
+    may differ between parts.
+    """
+    t_opt = { "t": end - start } if end else {}
+    in_opts = { "ss": start } if start else {}
+    with temp_file_name(".txt") as list_name:
+        with open(list_name, 'w') as w:
+            for part_name in part_names:
+                w.write(f"file '{part_name}'\n")
+        ffmpeg = FFmpeg().option('y')
+        ffmpeg = ffmpeg.input(list_name, f='concat', safe=0, auto_convert=1)
+        ffmpeg = ffmpeg.input(audio, **in_opts)
+        ffmpeg = ffmpeg.output(
+            output_name,
+            map=['0:v', '1:a?'],
+            **{'c:v': 'copy', 'c:a': 'aac'},
+            movflags='+faststart',
+            **t_opt,
+        )
+        await run_ffmpeg(ffmpeg, [output_name], settings.FFMPEG_TIMEOUT)
+
+
+async def smart_cut_video(video, audio, start, end, output_name, smart_cut, on_progress=None):
+    """
+    Cut `start`-`end` of `video` (and `audio`) by stream-copying the whole GOPs
+    inside the cut, and re-encoding only the partial GOPs at its head and tail.
+    Audio is cheap to encode, and is re-encoded in full. `smart_cut` comes from
+    `probe_smart_cut`. Falls back to a full re-encode if there is no whole GOP
+    inside the cut, or if anything fails.
+    """
+    # tolerate the rounding of the times printed by ffprobe
+    epsilon = 0.001
+    keyframes = smart_cut['keyframes']
+    copy_start = next((keyframe for keyframe in keyframes if keyframe >= start - epsilon), None)
+    if end:
+        copy_end = next((keyframe for keyframe in reversed(keyframes) if keyframe <= end + epsilon), None)
+    else:
+        copy_end = None
+    if copy_start is None or (end and (copy_end is None or copy_end <= copy_start)):
+        await cut_video_segments(video, audio, [(start, end)], [output_name], on_progress=on_progress)
+        return
+
+    encode_opts = {
+        **smart_cut['encode_opts'],
+        'an': None,
+    }
+    try:
+        with ExitStack() as stack:
+            part_names = []
+            if copy_start - start >= epsilon:
+                head_name = stack.enter_context(temp_file_name(".mp4"))
+                await cut_video_segments(
+                    video, None, [(start, copy_start)], [head_name],
+                    seek="input", encode_opts=encode_opts, on_progress=on_progress,
+                )
+                part_names.append(head_name)
+
+            copy_name = stack.enter_context(temp_file_name(".mp4"))
+            frames = end and sum(
+                1 for time in smart_cut['frame_times']
+                if copy_start - epsilon <= time < copy_end - epsilon
+            )
+            await copy_video_stream(video, copy_start, copy_end, copy_name, frames)
+            part_names.append(copy_name)
+
+            if end and end - copy_end >= epsilon:
+                tail_name = stack.enter_context(temp_file_name(".mp4"))
+                await cut_video_segments(
+                    video, None, [(copy_end, end)], [tail_name],
+                    seek="input", encode_opts=encode_opts, on_progress=on_progress,
+                )
+                part_names.append(tail_name)
+
+            await join_video_parts(part_names, audio or video, start, end, output_name)
+    except Exception as x:
+        logger.warning(f"Smart cut of {video} ({start}-{end}) failed, re-encoding: {x}")
+        await cut_video_segments(video, audio, [(start, end)], [output_name], on_progress=on_progress)
+
+
+async def cut_video(video, audio, start, end, temp_mp4, seek=None, smart=None):
+    if smart is None:
+        smart = settings.FFMPEG_SMART_CUT
+    smart_cut = smart and await probe_smart_cut(video)
+    if smart_cut:
+        await smart_cut_video(video, audio, start, end, temp_mp4.name, smart_cut)
+    else:
+        await cut_video_segments(video, audio, [(start, end)], [temp_mp4.name], seek=seek)
     # file_path = Path(temp_mp4.name).relative_to(settings.MEDIA_ROOT)
     file = File(file=open(temp_mp4.name, 'rb'), name="dummy.mp4")
     return file
 
 
-def cut_subtitles(all_subs, start, end, temp_vtt):
+def cut_subtitles(all_subs, start, end, temp_vtt=None):
     if all_subs is None:
         return None
     subs = WebVTT()
@@ -96,79 +549,345 @@ def cut_subtitles(all_subs, start, end, temp_vtt):
     file = File(file=BytesIO(subs.content.encode()), name="dummy.vtt")
     return file
 
-async def cut_dataset_video(dataset_video, session, location):
+def progress_key(dataset_video_id):
+    return f"video_progress:{dataset_video_id}"
+
+def get_progress(dataset_video_ids):
+    """The progress of processing the given dataset videos, by id (only those that have started)"""
+    keys = {progress_key(dataset_video_id): dataset_video_id for dataset_video_id in dataset_video_ids}
+    return {keys[key]: progress for key, progress in caches['video_progress'].get_many(keys).items()}
+
+
+class VideoProgress:
+    """
+    Progress of processing a dataset video, kept in the `video_progress` cache
+    (at most every `VIDEO_PROGRESS_INTERVAL` seconds) for the progress stream.
+    The ffmpeg progress (media time written and speed) is kept per pass, and
+    the remaining time is estimated from the time taken by the segments done.
+    """
+    def __init__(self, dataset_video):
+        self.key = progress_key(dataset_video.pk)
+        self.status = 'cutting'
+        self.error = ''
+        self.segments = 0
+        self.segments_done = 0
+        self.passes = {}
+        self.started_at = time.monotonic()
+        self.saved_at = 0
+
+    def pass_progress(self, pass_ix):
+        """Handler for the progress events of ffmpeg pass `pass_ix`"""
+        def on_progress(progress):
+            self.passes[pass_ix] = {
+                'out_time': progress.time.total_seconds(),
+                'speed': progress.speed,
+                'fps': progress.fps,
+            }
+            self.save()
+        return on_progress
+
+    def pass_done(self, pass_ix):
+        self.passes.pop(pass_ix, None)
+
+    def segment_done(self):
+        self.segments_done += 1
+        self.save(force=True)
+
+    def set_status(self, status, error=''):
+        self.status = status
+        self.error = error
+        self.passes = {}
+        self.save(force=True)
+
+    def data(self):
+        elapsed = time.monotonic() - self.started_at
+        eta = None
+        if self.status == 'cutting' and self.segments_done:
+            eta = round(elapsed / self.segments_done * (self.segments - self.segments_done))
+        return {
+            'status': self.status,
+            'error': self.error,
+            'segments': self.segments,
+            'segments_done': self.segments_done,
+            'passes': list(self.passes.values()),
+            'speed': sum(ffmpeg_pass['speed'] for ffmpeg_pass in self.passes.values()),
+            'elapsed': round(elapsed),
+            'eta': eta,
+            'updated_at': time.time(),
+        }
+
+    def save(self, force=False):
+        now = time.monotonic()
+        if not force and now - self.saved_at < settings.VIDEO_PROGRESS_INTERVAL:
+            return
+        self.saved_at = now
+        caches['video_progress'].set(self.key, self.data(), timeout=24 * 60 * 60)
+
+
+async def store_segment_subtitles(subtitles, start, end, session, location, source_owner):
+    seg_subtitles = await run_file_io(cut_subtitles, subtitles, start, end)
+    subs_file = await StoredFile.store(seg_subtitles, "subs_files", session, location, created_by=source_owner)
+    if seg_subtitles:
+        seg_subtitles.close()
+    if subs_file:
+        await subs_file.delocalize(session, location)
+    return subs_file
+
+async def store_cut_result(mp4_name, cut_key, session, location, source_owner):
+    """Store a cut segment video, and remember it for identical cuts of the same sources"""
+    # hashed where ffmpeg wrote it, and moved into place
+    mp4_file = HashedFile(mp4_name, "dummy.mp4", await run_file_io(md5_path, mp4_name))
+    video_file = await StoredFile.store(mp4_file, "video_files", session, location, created_by=source_owner)
+    await video_file.delocalize(session, location)
+    await CutResult.objects.aupdate_or_create(cut_key=cut_key, defaults={'video': video_file})
+    return video_file
+
+async def stream_cut_result(video, audio, start, end, cut_key, session, location, source_owner):
+    """Like `store_cut_result`, encoding the cut straight into S3 (see `FFMPEG_STREAM_TO_S3`)"""
+    async def write_to(write):
+        def ffmpeg(threads):
+            return cut_ffmpeg(video, audio, [(start, end)], ['pipe:1'], output_opts=FRAGMENTED_MP4_OPTS, threads=threads)
+        await stream_ffmpeg(ffmpeg, write, settings.FFMPEG_TIMEOUT)
+    video_file = await StoredFile.store_stream(write_to, "dummy.mp4", "video_files", session, location, created_by=source_owner)
+    await CutResult.objects.aupdate_or_create(cut_key=cut_key, defaults={'video': video_file})
+    return video_file
+
+async def store_segment(dataset_video, video_file, subtitles, start, end, cut_key, session, location, source_owner):
+    subs_file = await store_segment_subtitles(subtitles, start, end, session, location, source_owner)
+    await Segment.objects.acreate(
+        dataset_video=dataset_video,
+        video=video_file,
+        start=start,
+        end=end,
+        subtitles=subs_file,
+        cut_key=cut_key,
+    )
+
+async def update_segment_subtitles(segment, subtitles, session, location, source_owner):
+    """Re-slice the subtitles of a segment that is kept, in case they have changed"""
+    seg_subtitles = await run_file_io(cut_subtitles, subtitles, segment.start, segment.end)
+    subtitles_id = seg_subtitles and await run_file_io(md5_sum, seg_subtitles)
+    if subtitles_id == segment.subtitles_id:
+        return
+    subs_file = await store_segment_subtitles(subtitles, segment.start, segment.end, session, location, source_owner)
+    segment.subtitles = subs_file
+    await segment.asave(update_fields=['subtitles'])
+
+
+async def cut_dataset_video(dataset_video, session, location, progress=None):
     def load_dependents():
         dataset_video.video
         dataset_video.audio
         dataset_video.subtitles
     await sync_to_async(load_dependents)()
-    temp_dir = default_storage.path('tmp')
-    os.makedirs(temp_dir, exist_ok=True)
-    await dataset_video.segments.all().adelete()
-    subtitles_context = dataset_video.subtitles.local(session) if dataset_video.subtitles else nullcontext()
-    subtitles_path_ctx = dataset_video.subtitles.local(session) if dataset_video.subtitles else nullcontext()
-    async with subtitles_path_ctx as subtitles_path:
-        subtitles = load_subtitles(subtitles_path)
-    cuts = dataset_video.cuts or [[0]]
+    cuts = [get_cut_bounds(cut) for cut in dataset_video.cuts or [[0]]]
+    stream_to_s3 = bool(settings.FFMPEG_STREAM_TO_S3 and session and location)
+    cut_keys = [get_cut_key(dataset_video.video_id, dataset_video.audio_id, start, end, stream_to_s3) for start, end in cuts]
+
+    # segments of unchanged cuts are kept, the others are deleted
+    # and only the new (or changed) cuts are encoded
+    segments_by_key = {}
+    async for segment in dataset_video.segments.all():
+        segments_by_key.setdefault(segment.cut_key, []).append(segment)
+    kept_segments = []
+    new_cuts = []
+    for ix, cut_key in enumerate(cut_keys):
+        if segments_by_key.get(cut_key):
+            kept_segments.append(segments_by_key[cut_key].pop())
+        else:
+            new_cuts.append(ix)
+    stale_ids = [segment.pk for segments in segments_by_key.values() for segment in segments]
+    if stale_ids:
+        await Segment.objects.filter(pk__in=stale_ids).adelete()
+
+    # cuts made before (e.g. of the same sources in another dataset) are not encoded again
+    cut_results = CutResult.objects.filter(cut_key__in=[cut_keys[ix] for ix in new_cuts]).select_related('video')
+    cut_videos = {cut_result.cut_key: cut_result.video async for cut_result in cut_results}
+    reused_cuts = [ix for ix in new_cuts if cut_keys[ix] in cut_videos]
+    new_cuts = [ix for ix in new_cuts if cut_keys[ix] not in cut_videos]
+    logger.info(
+        f"Cutting {len(new_cuts)} of {len(cuts)} segments of {dataset_video!r}, "
+        f"reusing {len(reused_cuts)}, deleted {len(stale_ids)}"
+    )
+
+    progress = progress or VideoProgress(dataset_video)
+    progress.segments = len(new_cuts)
+    progress.save(force=True)
 
     # Get the owner from the source video file to inherit ownership
     source_owner = await User.objects.aget(id=dataset_video.video.created_by_id) if dataset_video.video.created_by_id else None
-    for cut in cuts:
-        start = cut[0]
-        end = cut[1] if len(cut) > 1 else None
-
-        temp_mp4 = NamedTemporaryFile(
-            dir=temp_dir,
-            suffix=".mp4",
-            delete=True,
-        )
-        temp_vtt = NamedTemporaryFile(
-            dir=temp_dir,
-            suffix=".vtt",
-            delete=True,
-        )
-        video_path_ctx = dataset_video.video.local(session)
-        audio_path_ctx = dataset_video.audio.local(session) if dataset_video.audio else nullcontext()
-        with temp_mp4, temp_vtt:
-            temp_mp4.close()
-            temp_vtt.close()
-
-            async with video_path_ctx as video_path, audio_path_ctx as audio_path:
-                mp4_file = await cut_video(video_path, audio_path, start, end, temp_mp4)
-            seg_subtitles = cut_subtitles(subtitles, start, end, temp_vtt)
-            video_file = await StoredFile.store(mp4_file, "video_files", session, location, created_by=source_owner)
-            mp4_file.close()
-            subs_file = await StoredFile.store(seg_subtitles, "subs_files", session, location, created_by=source_owner)
-            if seg_subtitles:
-                seg_subtitles.close()
-            await video_file.delocalize(session, location)
-            if subs_file:
-                await subs_file.delocalize(session, location)
-
-            await Segment.objects.acreate(
-                dataset_video=dataset_video,
-                video=video_file,
-                start=start,
-                end=end,
-                subtitles=subs_file,
-            )
+
+    async def cut_pass(pass_ix, cut_indices):
+        cut_indices = [new_cuts[ix] for ix in cut_indices]
+        pass_cuts = [cuts[ix] for ix in cut_indices]
+        if stream_to_s3:
+            # one ffmpeg run per cut, as each writes to its own pipe
+            for ix, (start, end) in zip(cut_indices, pass_cuts):
+                video_file = await stream_cut_result(video_path, audio_path, start, end, cut_keys[ix], session, location, source_owner)
+                await store_segment(dataset_video, video_file, subtitles, start, end, cut_keys[ix], session, location, source_owner)
+                progress.segment_done()
+            progress.pass_done(pass_ix)
+            return
+        on_progress = progress.pass_progress(pass_ix)
+        with ExitStack() as stack:
+            mp4_names = [stack.enter_context(temp_file_name(".mp4")) for _ in pass_cuts]
+            if smart_cut:
+                for (start, end), mp4_name in zip(pass_cuts, mp4_names):
+                    await smart_cut_video(video_path, audio_path, start, end, mp4_name, smart_cut, on_progress)
+            else:
+                await cut_video_segments(video_path, audio_path, pass_cuts, mp4_names, on_progress=on_progress)
+            progress.pass_done(pass_ix)
+
+            async def store_cut(ix, mp4_name):
+                video_file = await store_cut_result(mp4_name, cut_keys[ix], session, location, source_owner)
+                await store_segment(dataset_video, video_file, subtitles, *cuts[ix], cut_keys[ix], session, location, source_owner)
+                progress.segment_done()
+
+            # stored (and uploaded) in parallel, while the other passes are still encoding
+            await gather_or_cancel(*(store_cut(ix, mp4_name) for ix, mp4_name in zip(cut_indices, mp4_names)))
+
+    async def store_reused_cut(ix, subtitles):
+        # the earlier cut may have been kept locally, while this one is wanted in S3
+        video_file = await cut_videos[cut_keys[ix]].delocalize(session, location)
+        await store_segment(dataset_video, video_file, subtitles, *cuts[ix], cut_keys[ix], session, location, source_owner)
+
+    # the sources are fetched once (concurrently, if on S3), and shared by all cuts;
+    # the video and audio are not needed when no cut has to be encoded
+    source_files = [dataset_video.video, dataset_video.audio] if new_cuts else [None, None]
+    source_files.append(dataset_video.subtitles)
+    async with StoredFile.local_all(source_files, session) as (video_path, audio_path, subtitles_path):
+        subtitles = await run_file_io(load_subtitles, subtitles_path)
+        await gather_or_cancel(*(
+            update_segment_subtitles(segment, subtitles, session, location, source_owner)
+            for segment in kept_segments
+        ), *(
+            store_reused_cut(ix, subtitles) for ix in reused_cuts
+        ))
+        if new_cuts:
+            smart_cut = not stream_to_s3 and settings.FFMPEG_SMART_CUT and await probe_smart_cut(video_path)
+            new_bounds = [cuts[ix] for ix in new_cuts]
+            await gather_or_cancel(*(
+                cut_pass(pass_ix, cut_indices) for pass_ix, cut_indices in enumerate(plan_passes(new_bounds))
+            ))
 
 
 
 async def cut_and_delocalize_video(dataset_video, session, location):
-    # cut_video
-    await cut_dataset_video(dataset_video, session, location)
+    progress = VideoProgress(dataset_video)
+    try:
+        # cut_video
+        await cut_dataset_video(dataset_video, session, location, progress)
+
+        # save video to storage
+        progress.set_status('storing')
+        await dataset_video.video.delocalize(session, location)
+        await dataset_video.video.asave()
+        if dataset_video.audio:
+            await dataset_video.audio.delocalize(session, location)
+        if dataset_video.subtitles:
+            await dataset_video.subtitles.delocalize(session, location)
+        # save dataset video to DB
+        dataset_video.is_cut = True
+        await dataset_video.asave()
+    except Exception as x:
+        progress.set_status('failed', str(x))
+        raise
+    progress.set_status('done')
+
+
+def get_worker_id():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class LeaseLostError(RuntimeError):
+    pass
+
+
+@asynccontextmanager
+async def hold_lease(job):
+    """Keep renewing the lease of `job`; abort the block if it is lost to another worker"""
+    body = asyncio.current_task()
+    lost = False
+
+    async def heartbeat():
+        nonlocal lost
+        while True:
+            await asyncio.sleep(settings.VIDEO_JOB_HEARTBEAT)
+            if not await job.arenew_lease():
+                lost = True
+                body.cancel()
+                return
+
+    heartbeat_task = asyncio.create_task(heartbeat())
+    try:
+        yield
+    except asyncio.CancelledError:
+        if lost:
+            if hasattr(body, 'uncancel'):  # Python 3.11+
+                body.uncancel()
+            raise LeaseLostError(f"{job!r} has been claimed by another worker")
+        raise
+    finally:
+        heartbeat_task.cancel()
+
+
+async def process_video_job(job):
+    """Process the video of a claimed `VideoJob`, recording how it went"""
+    try:
+        async with hold_lease(job):
+            session = job.credentials and make_aws_session(job.credentials)
+            await cut_and_delocalize_video(job.dataset_video, session, job.location or None)
+    except LeaseLostError as x:
+        logger.warning(str(x))
+        return
+    except Exception as x:
+        logger.exception(f"{job!r} failed: {x}")
+        await job.afinish(VideoJob.Status.FAILED, str(x))
+    else:
+        await job.afinish(VideoJob.Status.DONE)
+
 
-    # save video to storage
-    await dataset_video.video.delocalize(session, location)
-    await dataset_video.video.asave()
-    if dataset_video.audio:
-        await dataset_video.audio.delocalize(session, location)
-    if dataset_video.subtitles:
-        await dataset_video.subtitles.delocalize(session, location)
-    # save dataset video to DB
-    dataset_video.is_cut = True
-    await dataset_video.asave()
+async def run_video_job(job_id):
+    """Process the `VideoJob` job_id, unless another worker has claimed it already"""
+    if job := await VideoJob.aclaim(get_worker_id(), job_id):
+        await process_video_job(job)
+
+
+async def work_video_jobs(stop_event, concurrency=None):
+    """
+    Claim and process video jobs, `concurrency` at a time, until `stop_event`
+    is set; then stop claiming and wait for the running jobs to finish.
+    """
+    worker_id = get_worker_id()
+    slots = asyncio.Semaphore(concurrency or settings.FFMPEG_CONCURRENCY)
+    running = set()
+
+    def job_done(task):
+        running.discard(task)
+        slots.release()
+
+    logger.info(f"Video worker {worker_id} started")
+    while not stop_event.is_set():
+        await slots.acquire()
+        job = None
+        if not stop_event.is_set():
+            if failed := await VideoJob.afail_abandoned():
+                logger.warning(f"Gave up on {failed} abandoned video jobs")
+            job = await VideoJob.aclaim(worker_id)
+        if job is None:
+            slots.release()
+            try:
+                await asyncio.wait_for(stop_event.wait(), settings.VIDEO_JOB_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            continue
+        logger.info(f"Video worker {worker_id} claimed {job!r} (attempt {job.attempts})")
+        task = asyncio.create_task(process_video_job(job))
+        running.add(task)
+        task.add_done_callback(job_done)
+
+    logger.info(f"Video worker {worker_id} stopping, waiting for {len(running)} jobs")
+    await asyncio.gather(*running, return_exceptions=True)
 
 
 async def post_project_to_mturk(project, tasks, mturk):
@@ -217,5 +936,173 @@ async def get_assignments_from_mturk(project, turk_credentials):
         )
 
 
-def vacuum():
-    pass # TODO: implement
+# the directories of MEDIA_ROOT (and of the S3 locations) stored files are written to
+STORED_FILE_DIRS = ('video_files', 'audio_files', 'subs_files')
+
+class Vacuum:
+    """
+    A mark-and-sweep of the files nothing refers to, see `vacuum`. Each sweep
+    goes by batches of up to `BATCH_SIZE` rows, files or S3 objects, and
+    stops at the first one past the time budget.
+    """
+    def __init__(self, dry_run, time_budget, session=None):
+        self.dry_run = dry_run
+        self.session = session
+        self.deadline = time.monotonic() + time_budget
+        self.cutoff = timezone.now() - timedelta(seconds=settings.VACUUM_GRACE_PERIOD)
+        # the parts of the discarded chunked uploads, not to count them again as temporary files
+        self.discarded_parts = set()
+        self.report = {
+            'dry_run': dry_run,
+            'complete': True,
+            'stored_files': 0,
+            'chunked_uploads': 0,
+            'local_files': 0,
+            'temp_files': 0,
+            's3_objects': 0,
+            'bytes': 0,
+            'errors': [],
+        }
+
+    def out_of_time(self):
+        if time.monotonic() > self.deadline:
+            self.report['complete'] = False
+            return True
+        return False
+
+    async def run(self):
+        await self.sweep_stored_files()
+        await self.sweep_local_files()
+        await self.sweep_chunked_uploads()
+        await self.sweep_temp_files()
+        for location in settings.VACUUM_S3_LOCATIONS:
+            if self.session:
+                await self.sweep_s3_objects(location)
+        return self.report
+
+    async def sweep_stored_files(self):
+        """Delete the stored files no dataset video or segment references"""
+        orphans = StoredFile.objects.filter(ref_count=0, created_at__lt=self.cutoff).exclude(
+            # in case the counts have drifted
+            referenced_by(DatasetVideo.objects.all()) | referenced_by(Segment.objects.all())
+        ).select_related('created_by').order_by('pk')
+        if not self.session:
+            # they would be forgotten, but stay in S3
+            orphans = orphans.filter(bucket='')
+        last_pk = ''
+        while not self.out_of_time():
+            stored_files = [stored_file async for stored_file in orphans.filter(pk__gt=last_pk)[:BATCH_SIZE]]
+            if not stored_files:
+                break
+            last_pk = stored_files[-1].pk
+            failed_files = []
+            if not self.dry_run:
+                failed_files = await StoredFile.adelete_with_contents(stored_files, self.session)
+            self.report['stored_files'] += len(stored_files) - len(failed_files)
+            self.report['errors'] += [f"{failed['location']}: {failed['error']}" for failed in failed_files]
+
+    async def sweep_local_files(self):
+        """Delete the files in `STORED_FILE_DIRS` no local stored file is written to"""
+        media_root = default_storage.path('')
+        cutoff = self.cutoff.timestamp()
+        for subdir in STORED_FILE_DIRS:
+            files = scan_files(default_storage.path(subdir), cutoff)
+            while not self.out_of_time():
+                batch = await run_file_io(lambda: list(islice(files, BATCH_SIZE)))
+                if not batch:
+                    break
+                sizes = {os.path.relpath(name, media_root): size for name, size in batch}
+                stored = StoredFile.objects.filter(path__in=sizes, bucket='').values_list('path', flat=True)
+                live = {path async for path in stored}
+                await self.delete_files('local_files', {path: size for path, size in sizes.items() if path not in live})
+
+    async def sweep_chunked_uploads(self):
+        """Discard the chunked uploads that have not been resumed within the grace period"""
+        stale = ChunkedUpload.objects.filter(updated_at__lt=self.cutoff).order_by('pk')
+        last_pk = None
+        while not self.out_of_time():
+            batch = stale.filter(pk__gt=last_pk) if last_pk else stale
+            uploads = [upload async for upload in batch[:BATCH_SIZE]]
+            if not uploads:
+                break
+            last_pk = uploads[-1].pk
+            self.report['chunked_uploads'] += len(uploads)
+            self.discarded_parts.update(upload.path for upload in uploads)
+            if not self.dry_run:
+                for upload in uploads:
+                    forget_chunked_upload(upload.pk)
+                await run_file_io(delete_local_files, [upload.path for upload in uploads])
+                await ChunkedUpload.objects.filter(pk__in=[upload.pk for upload in uploads]).adelete()
+
+    async def sweep_temp_files(self):
+        """Delete the files abandoned in MEDIA_ROOT/tmp (by crashed cuts, stores and uploads)"""
+        media_root = default_storage.path('')
+        files = scan_files(default_storage.path('tmp'), self.cutoff.timestamp())
+        while not self.out_of_time():
+            batch = await run_file_io(lambda: list(islice(files, BATCH_SIZE)))
+            if not batch:
+                break
+            await self.delete_files('temp_files', {
+                os.path.relpath(name, media_root): size
+                for name, size in batch if name not in self.discarded_parts
+            })
+
+    async def sweep_s3_objects(self, location):
+        """Delete the objects of S3 `location` no stored file is in, and the temporary ones of `stream_to_s3`"""
+        for subdir in STORED_FILE_DIRS + ('tmp',):
+            bucket, prefix = s3_location_key(f'{subdir}/', location)
+            async with self.session.client('s3') as s3:
+                async for objects in list_s3_objects(s3, bucket, prefix):
+                    sizes = {obj['Key']: obj['Size'] for obj in objects if obj['LastModified'] < self.cutoff}
+                    live = set()
+                    if subdir != 'tmp':
+                        stored = StoredFile.objects.filter(bucket=bucket, key__in=sizes).values_list('key', flat=True)
+                        live = {key async for key in stored}
+                    garbage = {key: size for key, size in sizes.items() if key not in live}
+                    errors = {}
+                    if garbage and not self.dry_run:
+                        errors = await delete_s3_objects(self.session, bucket, list(garbage))
+                    self.count('s3_objects', garbage, errors, f's3://{bucket}/')
+                    if self.out_of_time():
+                        return
+
+    async def delete_files(self, kind, sizes):
+        """Delete the local files of `sizes` (by path), and count them under `kind`"""
+        errors = {}
+        if sizes and not self.dry_run:
+            errors = await run_file_io(delete_local_files, list(sizes))
+        self.count(kind, sizes, errors)
+
+    def count(self, kind, sizes, errors, prefix=''):
+        self.report[kind] += len(sizes) - len(errors)
+        self.report['bytes'] += sum(size for name, size in sizes.items() if name not in errors)
+        self.report['errors'] += [f"{prefix}{name}: {error}" for name, error in errors.items()]
+
+
+async def avacuum(dry_run=False, time_budget=None):
+    """Async version of vacuum"""
+    session = None
+    if settings.VACUUM_AWS_CREDENTIALS:
+        session = make_aws_session(settings.VACUUM_AWS_CREDENTIALS)
+    started = time.monotonic()
+    report = await Vacuum(dry_run, time_budget or settings.VACUUM_TIME_BUDGET, session).run()
+    report['seconds'] = round(time.monotonic() - started, 3)
+    logger.info(f"Vacuum{' (dry run)' if dry_run else ''}: {report}")
+    return report
+
+
+def vacuum(dry_run=False, time_budget=None):
+    """
+    Delete the garbage files once they are `VACUUM_GRACE_PERIOD` old: stored files
+    nothing references, files in MEDIA_ROOT and objects in `VACUUM_S3_LOCATIONS`
+    no stored file is in, stale chunked uploads and abandoned temporary files.
+    Scheduled daily (see migration 0001); returns a summary of what was (or,
+    with `dry_run`, would be) deleted.
+    """
+    async def run():
+        try:
+            return await avacuum(dry_run, time_budget)
+        finally:
+            await aclose_aws_sessions()
+
+    return asyncio.run(run())
@@ -1,3 +1,1696 @@
-from django.test import TestCase
+import asyncio
+import gc
+import glob
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+import warnings
+from io import BytesIO, StringIO
+from functools import partial
+from datetime import datetime, timedelta, timezone as dt_timezone
+from unittest import mock, skipUnless
+from concurrent.futures import ThreadPoolExecutor
 
-# Create your tests here.
+from asgiref.sync import async_to_sync, sync_to_async
+from django.conf import settings
+import botocore
+from django.contrib.auth.models import User
+from django.core.files import File, locks
+from django.core.management import call_command
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
+from django.test import AsyncClient, SimpleTestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from guardian.shortcuts import assign_perm
+
+from .models import ChunkedUpload, CutResult, Dataset, DatasetVideo, Segment, StoredFile, VideoJob, batched_ref_counts
+from .storage import local_cache, upload_to_s3
+from . import mturk, storage, tasks, views
+from .async_queue import AsyncQueue
+from .upload_handlers import forget_chunked_upload
+from .tasks import cut_dataset_video, cut_video_segments, probe_smart_cut, smart_cut_video
+
+
+HAS_FFMPEG = shutil.which('ffmpeg') is not None
+HAS_FFPROBE = shutil.which('ffprobe') is not None
+
+# keeps the video progress of the jobs run by the tests in memory
+TEST_CACHES = {
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+    'video_progress': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'video_progress'},
+}
+
+
+def make_test_video(path, duration=12, rate=25, gop=50):
+    """Encode a synthetic H.264/AAC source with a frame counter burned in"""
+    subprocess.run([
+        'ffmpeg', '-y', '-loglevel', 'error',
+        '-f', 'lavfi', '-i', f'testsrc=duration={duration}:size=160x120:rate={rate}',
+        '-f', 'lavfi', '-i', f'sine=frequency=440:duration={duration}',
+        '-c:v', 'libx264', '-g', str(gop), '-pix_fmt', 'yuv420p',
+        '-c:a', 'aac', '-shortest', path,
+    ], check=True)
+
+
+def make_numbered_video(path, duration=12):
+    """Encode a source in which every frame is a flat gray whose level identifies the frame number"""
+    subprocess.run([
+        'ffmpeg', '-y', '-loglevel', 'error',
+        '-f', 'lavfi', '-i', f"color=s=160x120:r=25:d={duration},format=yuv420p,geq=lum='16+mod(N*37\\,200)':cb=128:cr=128",
+        '-f', 'lavfi', '-i', f'sine=frequency=440:duration={duration}',
+        '-c:v', 'libx264', '-g', '50', '-x264-params', 'scenecut=0',
+        '-c:a', 'aac', '-shortest', path,
+    ], check=True)
+
+
+def frame_number_level(number):
+    """The mean gray level of frame `number` of a `make_numbered_video` source"""
+    # decoding to gray expands the 16-235 luma range to 0-255
+    return (number * 37) % 200 * 255 / 219
+
+
+def decode_frames(path, width=160, height=120):
+    """Return the decoded grayscale frames of `path`"""
+    raw = subprocess.run([
+        'ffmpeg', '-loglevel', 'error', '-i', path,
+        '-f', 'rawvideo', '-pix_fmt', 'gray', '-',
+    ], check=True, capture_output=True).stdout
+    frame_size = width * height
+    return [raw[ix:ix + frame_size] for ix in range(0, len(raw), frame_size)]
+
+
+def count_files(root):
+    return sum(len(files) for _dir, _dirs, files in os.walk(root))
+
+
+async def join_chunks(chunks):
+    return b''.join([chunk async for chunk in chunks])
+
+
+def frame_difference(a, b):
+    return sum(abs(x - y) for x, y in zip(a, b)) / len(a)
+
+
+class FakeS3Client:
+    """Serves S3 objects from a local directory, counting the transferred bytes"""
+    def __init__(self, session):
+        self.session = session
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+    async def download_fileobj(self, bucket, key, fileobj, Config=None):
+        self.session.active_downloads += 1
+        self.session.max_active_downloads = max(self.session.max_active_downloads, self.session.active_downloads)
+        try:
+            await asyncio.sleep(0.01)
+            with open(os.path.join(self.session.root, bucket, key), 'rb') as f:
+                while data := f.read(Config.multipart_chunksize):
+                    await fileobj.seek(f.tell() - len(data))
+                    await fileobj.write(data)
+                    self.session.bytes_downloaded += len(data)
+        finally:
+            self.session.active_downloads -= 1
+
+    async def head_object(self, Bucket, Key):
+        self.session.requests.append(('head_object', Key))
+        path = os.path.join(self.session.root, Bucket, Key)
+        if not os.path.exists(path):
+            raise botocore.exceptions.ClientError({'Error': {'Code': '404'}}, 'HeadObject')
+        with open(path, 'rb') as f:
+            etag = hashlib.md5(f.read()).hexdigest()
+        if self.session.multipart_etags:
+            etag = f'{etag}-2'
+        return {'ETag': f'"{etag}"', 'ContentLength': os.path.getsize(path)}
+
+    async def get_object(self, Bucket, Key):
+        self.session.requests.append(('get_object', Key))
+        return {'Body': FakeS3Body(os.path.join(self.session.root, Bucket, Key))}
+
+    async def generate_presigned_post(self, Bucket, Key, Fields=None, Conditions=None, ExpiresIn=3600):
+        return {'url': f'https://{Bucket}.s3.amazonaws.com/', 'fields': {**(Fields or {}), 'key': Key, 'policy': 'policy'}}
+
+    async def get_bucket_cors(self, Bucket):
+        return {'CORSRules': settings.S3_CORS_RULES}
+
+    async def upload_fileobj(self, fileobj, bucket, key, ExtraArgs=None, Config=None):
+        self.session.requests.append(('upload_fileobj', key))
+        self.session.active_uploads += 1
+        self.session.max_active_uploads = max(self.session.max_active_uploads, self.session.active_uploads)
+        try:
+            await asyncio.sleep(0.01)
+            path = os.path.join(self.session.root, bucket, key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as f:
+                while data := await fileobj.read(Config.multipart_chunksize):
+                    f.write(data)
+        finally:
+            self.session.active_uploads -= 1
+
+    async def create_multipart_upload(self, Bucket, Key, **kwargs):
+        upload_id = str(len(self.session.multipart_uploads))
+        self.session.multipart_uploads[upload_id] = {}
+        return {'UploadId': upload_id}
+
+    async def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        self.session.requests.append(('upload_part', Key))
+        self.session.multipart_uploads[UploadId][PartNumber] = Body
+        return {'ETag': hashlib.md5(Body).hexdigest()}
+
+    async def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        parts = self.session.multipart_uploads.pop(UploadId)
+        path = os.path.join(self.session.root, Bucket, Key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            for part in MultipartUpload['Parts']:
+                f.write(parts[part['PartNumber']])
+
+    async def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.session.multipart_uploads.pop(UploadId)
+
+    async def copy_object(self, Bucket, Key, CopySource, **kwargs):
+        path = os.path.join(self.session.root, Bucket, Key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        shutil.copyfile(os.path.join(self.session.root, CopySource['Bucket'], CopySource['Key']), path)
+
+    async def delete_object(self, Bucket, Key):
+        os.unlink(os.path.join(self.session.root, Bucket, Key))
+
+    async def list_objects_v2(self, Bucket, Prefix, ContinuationToken=None):
+        self.session.requests.append(('list_objects_v2', Prefix))
+        bucket_dir = os.path.join(self.session.root, Bucket)
+        keys = sorted(
+            os.path.relpath(os.path.join(dir_name, name), bucket_dir)
+            for dir_name, _dirs, names in os.walk(bucket_dir) for name in names
+        )
+        # like S3, a listing continues after the last key of the previous page
+        keys = [key for key in keys if key.startswith(Prefix) and key > (ContinuationToken or '')]
+        page = keys[:self.session.list_page_size]
+        response = {'IsTruncated': len(keys) > len(page), 'Contents': [{
+            'Key': key,
+            'Size': os.path.getsize(os.path.join(bucket_dir, key)),
+            'LastModified': datetime.fromtimestamp(os.path.getmtime(os.path.join(bucket_dir, key)), dt_timezone.utc),
+        } for key in page]}
+        if response['IsTruncated']:
+            response['NextContinuationToken'] = page[-1]
+        return response
+
+    async def delete_objects(self, Bucket, Delete):
+        self.session.requests.append(('delete_objects', len(Delete['Objects'])))
+        errors = []
+        for obj in Delete['Objects']:
+            if obj['Key'] in self.session.undeletable:
+                errors.append({'Key': obj['Key'], 'Code': 'AccessDenied', 'Message': 'Access Denied'})
+            else:
+                os.unlink(os.path.join(self.session.root, Bucket, obj['Key']))
+        return {'Errors': errors} if errors else {}
+
+
+class FakeS3Body:
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.file.close()
+
+    async def read(self, size):
+        return self.file.read(size)
+
+
+class FakeS3Session:
+    def __init__(self, root):
+        self.root = root
+        self.requests = []
+        self.undeletable = set()
+        self.list_page_size = 1000
+        self.multipart_etags = False
+        self.multipart_uploads = {}
+        self.bytes_downloaded = 0
+        self.active_downloads = 0
+        self.max_active_downloads = 0
+        self.active_uploads = 0
+        self.max_active_uploads = 0
+
+    def client(self, service_name, **kwargs):
+        return FakeS3Client(self)
+
+
+class AsyncQueueTests(SimpleTestCase):
+    def test_priorities_and_owners_take_turns(self):
+        queue = AsyncQueue(num_workers=1, maxsize=6)
+        self.addCleanup(queue.shutdown)
+        started = threading.Event()
+        gate = threading.Event()
+        all_done = threading.Event()
+        done = []
+
+        async def work(name):
+            if name == 'gate':
+                started.set()
+                await asyncio.to_thread(gate.wait)
+            else:
+                done.append(name)
+                if len(done) == 5:
+                    all_done.set()
+
+        queue.submit(work, 'gate')
+        self.assertTrue(started.wait(5))
+        for name, priority, owner in [
+            ('a1', 2, 'a'), ('a2', 2, 'a'), ('a3', 2, 'a'), ('b1', 2, 'b'), ('i1', 0, 'a'), ('n1', 1, 'b'),
+        ]:
+            queue.submit(work, name, priority=priority, owner=owner)
+        with self.assertRaises(asyncio.QueueFull):
+            queue.submit(work, 'b2', priority=2, owner='b')
+        gate.set()
+        self.assertTrue(all_done.wait(5))
+        self.assertEqual(done[:5], ['i1', 'n1', 'a1', 'b1', 'a2'])
+
+
+class AwsSessionPoolTests(SimpleTestCase):
+    credentials = {'AccessKeyId': 'key', 'SecretAccessKey': 'secret', 'SessionToken': 'token'}
+
+    def setUp(self):
+        mturk._aws_sessions.clear()
+        self.addCleanup(mturk._aws_sessions.clear)
+
+    def test_sessions_are_shared_until_their_credentials_expire(self):
+        session = mturk.make_aws_session({**self.credentials, 'Location': 'bucket/dir'})
+        self.assertIs(mturk.make_aws_session(self.credentials), session)
+        self.assertIsNot(mturk.make_aws_session({**self.credentials, 'SessionToken': 'other'}), session)
+
+        expired = {**self.credentials, 'AccessKeyId': 'old', 'Expiration': (timezone.now() - timedelta(minutes=1)).isoformat()}
+        expired_session = mturk.make_aws_session(expired)
+        self.assertIsNot(mturk.make_aws_session(expired), expired_session)
+
+    async def test_s3_clients_are_kept_open_and_reused(self):
+        session = mturk.make_aws_session(self.credentials)
+        entered = []
+        exited = []
+
+        class ClientContext:
+            async def __aenter__(self):
+                await asyncio.sleep(0.01)
+                entered.append(self)
+                return self
+
+            async def __aexit__(self, *exc_info):
+                exited.append(self)
+
+        with mock.patch.object(session.session, 'client', side_effect=lambda *args, **kwargs: ClientContext()) as client:
+            async def use():
+                async with session.client('s3') as s3:
+                    return s3
+            clients = await asyncio.gather(use(), use(), use())
+            self.assertEqual(len(set(clients)), 1)
+            self.assertEqual(len(entered), 1)
+            self.assertEqual(client.call_args.kwargs['config'].max_pool_connections, settings.S3_MAX_POOL_CONNECTIONS)
+            self.assertEqual(exited, [])
+
+            await mturk.aclose_aws_sessions()
+            self.assertEqual(exited, entered)
+            await use()
+            self.assertEqual(len(entered), 2)
+            await mturk.aclose_aws_sessions()
+
+    def test_s3_clients_are_closed_with_their_event_loop(self):
+        session = mturk.make_aws_session(self.credentials)
+        contexts = []
+
+        class ClientContext:
+            entered = exited = False
+
+            async def __aenter__(self):
+                self.entered = True
+                return self
+
+            async def __aexit__(self, *exc_info):
+                self.exited = True
+
+        def client(*args, **kwargs):
+            contexts.append(ClientContext())
+            return contexts[-1]
+
+        @async_to_sync
+        async def use():
+            async with session.client('s3') as s3:
+                async with session.client('s3') as again:
+                    self.assertIs(again, s3)
+
+        # as under WSGI, where each async view runs in an event loop of its own
+        with mock.patch.object(session.session, 'client', side_effect=client):
+            for _ in range(5):
+                use()
+        self.assertEqual(len(contexts), 5)
+        self.assertTrue(all(context.entered and context.exited for context in contexts))
+        gc.collect()
+        self.assertEqual(len(session.s3_clients), 0)
+        self.assertEqual(len(session.closers), 0)
+
+
+class FfmpegSlotTests(SimpleTestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        self.settings = override_settings(FFMPEG_SLOTS_DIR=self.temp_dir, FFMPEG_CONCURRENCY=2, FFMPEG_THREADS=8)
+        self.settings.enable()
+        self.addCleanup(self.settings.disable)
+
+    def test_cuts_are_planned_in_passes_by_start(self):
+        cuts = [(5, 6), (0, 1), (3, 4), (1, 2), (4, 5), (2, 3)]
+        self.assertEqual(tasks.plan_passes(cuts), [[1, 3, 5], [2, 4, 0]])
+        self.assertEqual(tasks.plan_passes(cuts[:1]), [[0]])
+        with override_settings(FFMPEG_MAX_OUTPUTS_PER_PASS=2):
+            self.assertEqual(tasks.plan_passes(cuts), [[1, 3], [5, 2], [4, 0]])
+
+    def test_ffmpeg_runs_are_capped_across_event_loops(self):
+        lock = threading.Lock()
+        running = []
+        runs = []
+
+        class FakeFFmpeg:
+            def __init__(self, output_name, threads):
+                self.output_name = output_name
+                self.threads = threads
+
+            async def execute(self):
+                with lock:
+                    running.append(self)
+                    runs.append((len(running), self.threads))
+                await asyncio.sleep(0.1)
+                with lock:
+                    running.remove(self)
+                with open(self.output_name, 'wb') as f:
+                    f.write(b'mp4')
+
+        def run_loop(loop_ix):
+            names = [os.path.join(self.temp_dir, f'{loop_ix}-{ix}.mp4') for ix in range(2)]
+            async def run_all():
+                await asyncio.gather(*(
+                    tasks.run_ffmpeg(partial(FakeFFmpeg, name), [name], 10) for name in names
+                ))
+            asyncio.run(run_all())
+
+        # e.g. the web process and a video worker
+        threads = [threading.Thread(target=run_loop, args=(loop_ix,)) for loop_ix in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(runs), 6)
+        self.assertEqual(max(concurrent for concurrent, _threads in runs), 2)
+        self.assertEqual({threads for _concurrent, threads in runs}, {4})
+
+    async def test_threads_of_running_ffmpegs_add_up_to_at_most_ffmpeg_threads(self):
+        async with tasks.ffmpeg_slot() as threads, tasks.ffmpeg_slot() as other_threads:
+            self.assertLessEqual(threads + other_threads, 8)
+        async with tasks.ffmpeg_slot() as threads:
+            self.assertLessEqual(threads, 8)
+
+    async def test_waiting_for_a_slot_does_not_poll_the_lock_files(self):
+        async def take_slot():
+            async with tasks.ffmpeg_slot():
+                pass
+
+        with mock.patch.object(tasks, 'lock_ffmpeg_slot', side_effect=tasks.lock_ffmpeg_slot) as lock_slot:
+            async with tasks.ffmpeg_slot(), tasks.ffmpeg_slot():
+                waiting = asyncio.create_task(take_slot())
+                await asyncio.sleep(0.2)
+                self.assertFalse(waiting.done())
+                self.assertEqual(lock_slot.call_count, 2)
+            await asyncio.wait_for(waiting, 5)
+        self.assertEqual(lock_slot.call_count, 3)
+
+    async def test_cancelled_waiter_does_not_keep_a_slot(self):
+        # another process holds every slot
+        held = [open(os.path.join(self.temp_dir, f'{ix}.lock'), 'ab') for ix in range(2)]
+        for f in held:
+            locks.lock(f, locks.LOCK_EX)
+        waiting = asyncio.create_task(tasks.ffmpeg_slot().__aenter__())
+        await asyncio.sleep(0.1)
+        waiting.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await waiting
+        for f in held:
+            f.close()
+        async def take_slots():
+            async with tasks.ffmpeg_slot(), tasks.ffmpeg_slot():
+                pass
+        await asyncio.wait_for(take_slots(), 5)
+
+
+@skipUnless(HAS_FFMPEG, "ffmpeg is not installed")
+class CutVideoSegmentsTests(SimpleTestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        self.source = os.path.join(self.temp_dir, 'source.mp4')
+        make_numbered_video(self.source)
+
+    async def test_one_pass_writes_every_segment(self):
+        cuts = [(0, 1.5), (2.36, 4.8), (7.04, 9.52), (10.2, None)]
+        names = [os.path.join(self.temp_dir, f'segment-{ix}.mp4') for ix in range(len(cuts))]
+        with override_settings(MEDIA_ROOT=self.temp_dir), \
+                mock.patch.object(tasks.FFmpeg, 'execute', autospec=True, side_effect=tasks.FFmpeg.execute) as execute:
+            await cut_video_segments(self.source, None, cuts, names)
+        self.assertEqual(execute.call_count, 1)
+        for (start, end), name in zip(cuts, names):
+            frames = decode_frames(name)
+            first, last = round(start * 25), round((end or 12) * 25) - 1
+            self.assertEqual(len(frames), last - first + 1)
+            for number, frame in ((first, frames[0]), (last, frames[-1])):
+                self.assertAlmostEqual(sum(frame) / len(frame), frame_number_level(number), delta=5)
+
+
+@skipUnless(HAS_FFMPEG, "ffmpeg is not installed")
+class CutVideoSeekTests(SimpleTestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        self.source = os.path.join(self.temp_dir, 'source.mp4')
+        make_test_video(self.source)
+
+    async def cut(self, cuts, seek):
+        names = [os.path.join(self.temp_dir, f'{seek}-{ix}.mp4') for ix in range(len(cuts))]
+        with override_settings(MEDIA_ROOT=self.temp_dir):
+            await cut_video_segments(self.source, None, cuts, names, seek=seek)
+        return [decode_frames(name) for name in names]
+
+    async def test_input_seek_matches_output_seek(self):
+        # cut starts both on and between keyframes (every 2s)
+        cuts = [(0, 1.5), (2.36, 4.8), (7.04, 9.52), (10.2, None)]
+        output_seeked = await self.cut(cuts, "output")
+        input_seeked = await self.cut(cuts, "input")
+        for expected, actual in zip(output_seeked, input_seeked):
+            self.assertEqual(len(expected), len(actual))
+            # the first and last frames must be the same frames, not their neighbours
+            self.assertLess(
+                frame_difference(expected[0], actual[0]),
+                frame_difference(expected[0], expected[1]) / 2,
+            )
+            self.assertLess(
+                frame_difference(expected[-1], actual[-1]),
+                frame_difference(expected[-1], expected[-2]) / 2,
+            )
+
+
+@skipUnless(HAS_FFMPEG and HAS_FFPROBE, "ffmpeg is not installed")
+class SmartCutTests(SimpleTestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        self.source = os.path.join(self.temp_dir, 'source.mp4')
+        make_numbered_video(self.source)
+
+    def assertFrameNumber(self, frame, number):
+        self.assertAlmostEqual(sum(frame) / len(frame), frame_number_level(number), delta=5)
+
+    async def test_smart_cut_is_frame_accurate(self):
+        output_name = os.path.join(self.temp_dir, 'smart.mp4')
+        with override_settings(MEDIA_ROOT=self.temp_dir):
+            smart_cut = await probe_smart_cut(self.source)
+            self.assertEqual(smart_cut['keyframes'], [0, 2, 4, 6, 8, 10])
+            # partial GOPs at both ends, two whole GOPs copied in between
+            with self.assertNoLogs('video_eval_app.tasks', 'WARNING'):
+                await smart_cut_video(self.source, None, 2.36, 6.52, output_name, smart_cut)
+        frames = decode_frames(output_name)
+        self.assertEqual(len(frames), 104)
+        for ix, frame in enumerate(frames):
+            self.assertFrameNumber(frame, 59 + ix)
+
+
+class TransferBudgetTests(SimpleTestCase):
+    @override_settings(S3_MAX_BANDWIDTH=2 * 1024 * 1024, S3_MULTIPART_PART_SIZE=256 * 1024)
+    async def test_transfers_share_the_bandwidth(self):
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        session = FakeS3Session(os.path.join(temp_dir, 's3'))
+        names = []
+        for i in range(2):
+            names.append(os.path.join(temp_dir, f'{i}.bin'))
+            with open(names[-1], 'wb') as f:
+                f.write(os.urandom(1024 * 1024))
+
+        started = time.monotonic()
+        async with session.client('s3') as s3:
+            await asyncio.gather(*[upload_to_s3(s3, name, 'bucket', os.path.basename(name)) for name in names])
+        # 2 MB at 2 MB/s, starting with an empty allowance
+        self.assertGreater(time.monotonic() - started, 0.9)
+        self.assertEqual(session.max_active_uploads, 2)
+        for name in names:
+            with open(name, 'rb') as f, open(os.path.join(session.root, 'bucket', os.path.basename(name)), 'rb') as g:
+                self.assertEqual(f.read(), g.read())
+
+
+class LocalFileCacheTests(SimpleTestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        self.session = FakeS3Session(os.path.join(self.temp_dir, 's3'))
+        os.makedirs(os.path.join(self.session.root, 'bucket'))
+        self.files = {}
+        for name in 'abc':
+            with open(os.path.join(self.session.root, 'bucket', name), 'wb') as f:
+                f.write(name.encode() * 100)
+            self.files[name] = StoredFile(md5sum=name * 32, path=f'files/{name}.bin', bucket='bucket', key=name)
+
+    async def read(self, name):
+        async with self.files[name].local(self.session) as local_name:
+            with open(local_name, 'rb') as f:
+                return f.read()
+
+    @override_settings(LOCAL_CACHE_MAX_BYTES=250)
+    async def test_cache_hits_and_evicts_least_recently_used(self):
+        hits, misses = local_cache.hits, local_cache.misses
+        with override_settings(MEDIA_ROOT=self.temp_dir):
+            for name in 'abac':
+                self.assertEqual(await self.read(name), name.encode() * 100)
+            self.assertEqual(self.session.bytes_downloaded, 300)
+            self.assertEqual((local_cache.hits - hits, local_cache.misses - misses), (1, 3))
+            # "b" was the least recently used when "c" was added
+            await self.read('a')
+            await self.read('c')
+            self.assertEqual(self.session.bytes_downloaded, 300)
+            await self.read('b')
+            self.assertEqual(self.session.bytes_downloaded, 400)
+        self.assertEqual(os.listdir(os.path.join(self.temp_dir, 'tmp')), [])
+
+
+@skipUnless(HAS_FFMPEG, "ffmpeg is not installed")
+class StoredFileDedupTests(TransactionTestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        self.settings = override_settings(MEDIA_ROOT=self.temp_dir)
+        self.settings.enable()
+        self.addCleanup(self.settings.disable)
+        self.session = FakeS3Session(os.path.join(self.temp_dir, 's3'))
+
+    async def test_same_contents_are_stored_once(self):
+        from . import models
+        with mock.patch.object(models, 'store_file', wraps=models.store_file) as store_file:
+            stored = await asyncio.gather(*[
+                StoredFile.store(File(BytesIO(b'WEBVTT\n'), name=f'{i}.vtt'), 'subs_files') for i in range(3)
+            ])
+            self.assertEqual(store_file.call_count, 1)
+            self.assertEqual({instance.pk for instance in stored}, {hashlib.md5(b'WEBVTT\n').hexdigest()})
+
+            await StoredFile.store(File(BytesIO(b'WEBVTT\n'), name='again.vtt'), 'subs_files')
+            self.assertEqual(store_file.call_count, 1)
+
+            # its local copy has gone missing, so it is written again
+            os.unlink(os.path.join(self.temp_dir, stored[0].path))
+            await StoredFile.store(File(BytesIO(b'WEBVTT\n'), name='again.vtt'), 'subs_files')
+            self.assertEqual(store_file.call_count, 2)
+            self.assertTrue(os.path.exists(os.path.join(self.temp_dir, stored[0].path)))
+
+    async def test_file_in_s3_is_neither_written_nor_uploaded_again(self):
+        stored = await StoredFile.store(File(BytesIO(b'WEBVTT\n'), name='a.vtt'), 'subs_files')
+        # concurrent uploads of the same file, from separate instances
+        copies = [await StoredFile.objects.aget(pk=stored.pk) for _ in range(2)]
+        await asyncio.gather(*[copy.delocalize(self.session, 'bucket/dir') for copy in copies])
+        self.assertEqual(self.session.requests, [('head_object', f'dir/{stored.path}'), ('upload_fileobj', f'dir/{stored.path}')])
+        self.assertEqual({(copy.bucket, copy.key) for copy in copies}, {('bucket', f'dir/{stored.path}')})
+
+        # a stale instance learns it has been uploaded from the database
+        await stored.delocalize(self.session, 'bucket/dir')
+        again = await StoredFile.store(File(BytesIO(b'WEBVTT\n'), name='b.vtt'), 'subs_files')
+        await again.delocalize(self.session, 'bucket/dir')
+        self.assertEqual(len(self.session.requests), 2)
+        self.assertEqual(stored.key, f'dir/{stored.path}')
+        self.assertFalse(os.path.exists(os.path.join(self.temp_dir, stored.path)))
+
+    async def test_cut_result_is_moved_into_place(self):
+        with tasks.temp_file_name('.mp4') as mp4_name:
+            content = os.urandom(3 * 1024 * 1024 + 1)
+            with open(mp4_name, 'wb') as f:
+                f.write(content)
+            inode = os.stat(mp4_name).st_ino
+            video_file = await tasks.store_cut_result(mp4_name, 'k' * 32, None, None, None)
+            self.assertFalse(os.path.exists(mp4_name))
+        self.assertEqual(video_file.md5sum, hashlib.md5(content).hexdigest())
+        # renamed, not written again
+        self.assertEqual(os.stat(os.path.join(self.temp_dir, video_file.path)).st_ino, inode)
+        self.assertEqual((await CutResult.objects.aget(cut_key='k' * 32)).video_id, video_file.md5sum)
+
+
+class DeleteWithFilesTests(TransactionTestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        self.settings = override_settings(MEDIA_ROOT=self.temp_dir)
+        self.settings.enable()
+        self.addCleanup(self.settings.disable)
+        self.session = FakeS3Session(os.path.join(self.temp_dir, 's3'))
+
+    async def make_file(self, name, in_s3=False):
+        stored_file = await StoredFile.store(File(BytesIO(name.encode()), name=name), 'files', created_by=self.user)
+        if in_s3:
+            await stored_file.delocalize(self.session, 'bucket')
+        return stored_file
+
+    async def make_dataset(self, name, segments):
+        self.user, _ = await User.objects.aget_or_create(username='uploader')
+        dataset = await Dataset.objects.acreate(name=name, created_by=self.user)
+        for ix in range(2):
+            dataset_video = await DatasetVideo.objects.acreate(
+                dataset=dataset, video=await self.make_file(f'{name}-{ix}.mp4', in_s3=True),
+                subtitles=await self.make_file(f'{name}-{ix}.vtt'), name=f'video {ix}',
+            )
+            for start in range(segments):
+                await Segment.objects.acreate(
+                    dataset_video=dataset_video, start=start, end=start + 1,
+                    video=await self.make_file(f'{name}-{ix}-{start}.mp4', in_s3=True),
+                    subtitles=await self.make_file('shared.vtt'),
+                )
+        return dataset
+
+    def s3_exists(self, stored_file):
+        return os.path.exists(os.path.join(self.session.root, stored_file.bucket, stored_file.key))
+
+    async def test_files_are_deleted_in_batches(self):
+        kept = await self.make_dataset('kept', 1)
+        for segments in (1, 20):
+            dataset = await self.make_dataset(f'dataset{segments}', segments)
+            self.session.requests.clear()
+            # the queries are made by the thread of sync_to_async
+            queries = CaptureQueriesContext(connection)
+            await sync_to_async(queries.__enter__)()
+            self.assertEqual(await dataset.safe_delete_with_files(self.session), (True, None, []))
+            await sync_to_async(queries.__exit__)(None, None, None)
+            # as many queries and requests whatever the number of segments
+            if segments == 1:
+                num_queries = await sync_to_async(len)(queries)
+            self.assertEqual(await sync_to_async(len)(queries), num_queries)
+            self.assertEqual(self.session.requests, [('delete_objects', 2 + 2 * segments)])
+            self.assertFalse(await Dataset.objects.filter(pk=dataset.pk).aexists())
+
+        # the files of the other dataset are kept, those only in the deleted ones are gone
+        self.assertEqual(await Segment.objects.acount(), 2)
+        self.assertEqual(await StoredFile.objects.acount(), 2 + 2 + 2 + 1)
+        shared = await StoredFile.objects.aget(name='shared.vtt')
+        self.assertTrue(os.path.exists(os.path.join(self.temp_dir, shared.path)))
+        self.assertEqual(count_files(os.path.join(self.temp_dir, 'files')), 2 + 1)
+        self.assertEqual(count_files(os.path.join(self.session.root, 'bucket', 'files')), 2 + 2)
+
+        # the last reference to the shared subtitles goes with the last segment
+        segment = await Segment.objects.afirst()
+        self.assertEqual(await segment.safe_delete_with_files(self.session), (True, None, []))
+        self.assertTrue(await StoredFile.objects.filter(pk=shared.pk).aexists())
+        success, error, failed_files = await kept.safe_delete_with_files(self.session)
+        self.assertTrue(success)
+        self.assertFalse(await StoredFile.objects.aexists())
+
+    async def test_files_failing_to_delete_are_reported_and_kept(self):
+        dataset = await self.make_dataset('dataset', 2)
+        dataset_video = await dataset.dataset_videos.select_related('video').afirst()
+        self.session.undeletable.add(dataset_video.video.key)
+
+        success, error, failed_files = await dataset.safe_delete_with_files(self.session)
+        self.assertFalse(success)
+        self.assertEqual([failed['file'].pk for failed in failed_files], [dataset_video.video_id])
+        self.assertEqual(error, (
+            "Cannot delete dataset: failed to delete files:\n"
+            f"- s3://bucket/{dataset_video.video.key} (uploaded by uploader): AccessDenied: Access Denied\n"
+        ))
+        # the file is kept with what it is in, the others are gone
+        self.assertTrue(self.s3_exists(dataset_video.video))
+        self.assertEqual([video.pk async for video in DatasetVideo.objects.all()], [dataset_video.pk])
+        self.assertEqual(await StoredFile.objects.acount(), 1)
+
+    async def test_s3_files_are_kept_without_credentials(self):
+        dataset = await self.make_dataset('dataset', 1)
+        s3_files = [stored_file async for stored_file in StoredFile.objects.exclude(bucket='')]
+        self.session.requests.clear()
+
+        success, error, failed_files = await dataset.safe_delete_with_files(None)
+        self.assertFalse(success)
+        self.assertEqual(sorted(failed['file'].pk for failed in failed_files), sorted(stored_file.pk for stored_file in s3_files))
+        self.assertIn("AWS credentials required to delete S3 file", error)
+        for stored_file in s3_files:
+            self.assertTrue(self.s3_exists(stored_file))
+            self.assertTrue(await StoredFile.objects.filter(pk=stored_file.pk).aexists())
+        self.assertEqual(self.session.requests, [])
+        # the local files nothing else is in are gone
+        self.assertFalse(await StoredFile.objects.filter(bucket='').aexists())
+
+
+class RefCountTests(TransactionTestCase):
+    def ref_counts(self):
+        return dict(StoredFile.objects.values_list('md5sum', 'ref_count'))
+
+    def test_ref_counts_follow_saves_and_deletes(self):
+        video, subtitles, other = (StoredFile.objects.create(md5sum=str(ix) * 32, path=f'{ix}') for ix in range(3))
+        dataset = Dataset.objects.create(name='dataset')
+        dataset_video = DatasetVideo.objects.create(dataset=dataset, video=video, subtitles=subtitles, name='video')
+        segments = [
+            Segment.objects.create(dataset_video=dataset_video, start=start, video=video, subtitles=subtitles)
+            for start in range(3)
+        ]
+        self.assertEqual(self.ref_counts(), {video.pk: 4, subtitles.pk: 4, other.pk: 0})
+
+        segments[0].subtitles = other
+        segments[0].save()
+        segments[1].start = 10
+        with CaptureQueriesContext(connection) as queries:
+            segments[1].save(update_fields=['start'])
+        # no lookup of the files it referenced
+        self.assertEqual([query['sql'] for query in queries if 'SELECT' in query['sql']], [])
+        segments[2].delete()
+        self.assertEqual(self.ref_counts(), {video.pk: 3, subtitles.pk: 2, other.pk: 1})
+        with self.assertNumQueries(1):
+            self.assertFalse(subtitles.can_be_deleted())
+        self.assertTrue(other.can_be_deleted())
+
+        # deleted subtitles are unset
+        other.delete()
+        subtitles.delete()
+        self.assertEqual(self.ref_counts(), {video.pk: 3})
+
+        with CaptureQueriesContext(connection) as queries, batched_ref_counts():
+            dataset.delete()
+        self.assertEqual(len([query for query in queries if 'UPDATE "video_eval_app_storedfile"' in query['sql']]), 1)
+        self.assertEqual(self.ref_counts(), {video.pk: 0})
+
+    def test_repair_recounts_all_files(self):
+        stored_files = [StoredFile.objects.create(md5sum=str(ix) * 32, path=f'{ix}') for ix in range(3)]
+        dataset = Dataset.objects.create(name='dataset')
+        for stored_file in stored_files[:2]:
+            DatasetVideo.objects.create(dataset=dataset, video=stored_file, subtitles=stored_files[2], name='video')
+        StoredFile.objects.update(ref_count=7)
+        StoredFile.objects.filter(pk=stored_files[0].pk).update(ref_count=1)
+
+        out = StringIO()
+        call_command('repair_ref_counts', stdout=out)
+        self.assertEqual(out.getvalue(), "Repaired 2 reference counts\n")
+        self.assertEqual(self.ref_counts(), {stored_files[0].pk: 1, stored_files[1].pk: 1, stored_files[2].pk: 2})
+
+
+@override_settings(VACUUM_GRACE_PERIOD=3600, VACUUM_S3_LOCATIONS=['bucket/dir'], VACUUM_AWS_CREDENTIALS={'AccessKeyId': 'key'})
+class VacuumTests(TransactionTestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        self.settings = override_settings(MEDIA_ROOT=self.temp_dir)
+        self.settings.enable()
+        self.addCleanup(self.settings.disable)
+        self.session = FakeS3Session(os.path.join(self.temp_dir, 's3'))
+        self.session.list_page_size = 2
+        patch = mock.patch.object(tasks, 'make_aws_session', return_value=self.session)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def make_file(self, path, old=True):
+        path = os.path.join(self.temp_dir, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(b'x' * 10)
+        if old:
+            os.utime(path, (time.time() - 7200, time.time() - 7200))
+        return path
+
+    async def make_stored_file(self, name, in_s3=False, referenced=False):
+        stored_file = await StoredFile.store(File(BytesIO(name.encode()), name=name), 'video_files')
+        if in_s3:
+            await stored_file.delocalize(self.session, 'bucket/dir')
+        if referenced:
+            dataset = await Dataset.objects.acreate(name=name)
+            await DatasetVideo.objects.acreate(dataset=dataset, video=stored_file, name=name)
+        await StoredFile.objects.filter(pk=stored_file.pk).aupdate(created_at=timezone.now() - timedelta(hours=2))
+        return stored_file
+
+    async def test_garbage_is_swept_after_the_grace_period(self):
+        live = await self.make_stored_file('live.mp4', referenced=True)
+        live_s3 = await self.make_stored_file('live-s3.mp4', in_s3=True, referenced=True)
+        orphan = await self.make_stored_file('orphan.mp4')
+        orphan_s3 = await self.make_stored_file('orphan-s3.mp4', in_s3=True)
+        # a file being stored right now
+        await StoredFile.objects.acreate(md5sum='f' * 32, path='video_files/new.mp4')
+        stray_files = [self.make_file('video_files/stray.mp4'), self.make_file('tmp/crashed.mp4')]
+        fresh_files = [self.make_file('video_files/new.mp4', old=False), self.make_file('tmp/cutting.mp4', old=False)]
+        stray_objects = [self.make_file(f's3/bucket/dir/video_files/stray{ix}.mp4') for ix in range(3)]
+        stray_objects.append(self.make_file('s3/bucket/dir/tmp/streamed.mp4'))
+        for path in glob.glob(os.path.join(self.temp_dir, 's3', '**', '*.mp4'), recursive=True):
+            os.utime(path, (time.time() - 7200, time.time() - 7200))
+        user = await User.objects.acreate(username='uploader')
+        dataset = await Dataset.objects.aget(name='live.mp4')
+        stale = await ChunkedUpload.objects.acreate(dataset=dataset, created_by=user, name='a.mp4', size=100)
+        await ChunkedUpload.objects.filter(pk=stale.pk).aupdate(updated_at=timezone.now() - timedelta(hours=2))
+        self.make_file(stale.path)
+        resumable = await ChunkedUpload.objects.acreate(dataset=dataset, created_by=user, name='b.mp4', size=100)
+        self.make_file(resumable.path, old=False)
+
+        expected = {
+            'stored_files': 2, 'chunked_uploads': 1, 'local_files': 1, 'temp_files': 1, 's3_objects': 4,
+            'bytes': 60, 'errors': [], 'complete': True,
+        }
+        report = await tasks.avacuum(dry_run=True)
+        self.assertEqual({key: report[key] for key in expected}, expected)
+        self.assertEqual(await StoredFile.objects.acount(), 5)
+        self.assertTrue(all(os.path.exists(path) for path in stray_files + stray_objects + [stale.path]))
+
+        self.session.requests.clear()
+        report = await tasks.avacuum()
+        self.assertEqual({key: report[key] for key in expected}, expected)
+        self.assertEqual({pk async for pk in StoredFile.objects.values_list('pk', flat=True)}, {live.pk, live_s3.pk, 'f' * 32})
+        self.assertFalse(any(os.path.exists(path) for path in stray_files + stray_objects + [stale.path]))
+        self.assertTrue(all(os.path.exists(path) for path in fresh_files + [resumable.path]))
+        self.assertTrue(os.path.exists(os.path.join(self.temp_dir, live.path)))
+        self.assertTrue(os.path.exists(os.path.join(self.session.root, live_s3.bucket, live_s3.key)))
+        self.assertFalse(os.path.exists(os.path.join(self.session.root, orphan_s3.bucket, orphan_s3.key)))
+        self.assertFalse(os.path.exists(os.path.join(self.temp_dir, orphan.path)))
+        self.assertEqual([pk async for pk in ChunkedUpload.objects.values_list('pk', flat=True)], [resumable.pk])
+        # the listings are paged
+        self.assertEqual(self.session.requests.count(('list_objects_v2', 'dir/video_files/')), 2)
+
+        report = await tasks.avacuum(time_budget=-1)
+        self.assertFalse(report['complete'])
+
+    def test_command_reports_what_would_be_deleted(self):
+        self.make_file('tmp/crashed.mp4')
+        out = StringIO()
+        call_command('vacuum', '--dry-run', stdout=out)
+        report = json.loads(out.getvalue())
+        self.assertEqual((report['dry_run'], report['temp_files'], report['bytes']), (True, 1, 10))
+        self.assertTrue(os.path.exists(os.path.join(self.temp_dir, 'tmp', 'crashed.mp4')))
+
+
+class MediaTests(TransactionTestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        self.settings = override_settings(MEDIA_ROOT=self.temp_dir)
+        self.settings.enable()
+        self.addCleanup(self.settings.disable)
+
+    async def get(self, url, **headers):
+        response = await AsyncClient().get(url, headers=headers)
+        content = b''
+        if response.streaming:
+            content = b''.join([chunk async for chunk in response.streaming_content])
+        return response, content
+
+    async def test_ranges_are_served_with_immutable_caching(self):
+        content = os.urandom(1000)
+        stored_file = await StoredFile.store(File(BytesIO(content), name='video.mp4'), 'video_files')
+        url = stored_file.url
+
+        response, body = await self.get(url)
+        self.assertEqual((response.status_code, body), (200, content))
+        self.assertEqual(response['ETag'], f'"{stored_file.md5sum}"')
+        self.assertEqual(response['Content-Type'], 'video/mp4')
+        self.assertIn('immutable', response['Cache-Control'])
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+
+        for header, first, last in [('bytes=100-199', 100, 199), ('bytes=900-', 900, 999), ('bytes=-10', 990, 999), ('bytes=990-5000', 990, 999)]:
+            response, body = await self.get(url, Range=header)
+            self.assertEqual((response.status_code, body), (206, content[first:last + 1]), header)
+            self.assertEqual(response['Content-Range'], f'bytes {first}-{last}/1000')
+            self.assertEqual(response['Content-Length'], str(last - first + 1))
+
+        response, body = await self.get(url, Range='bytes=1000-')
+        self.assertEqual((response.status_code, response['Content-Range']), (416, 'bytes */1000'))
+        # the range of another version of the file is not sent
+        response, body = await self.get(url, Range='bytes=0-9', If_Range='"other"')
+        self.assertEqual((response.status_code, body), (200, content))
+        response, body = await self.get(url, If_None_Match=f'"{stored_file.md5sum}"')
+        self.assertEqual((response.status_code, body), (304, b''))
+
+        response, body = await self.get(url.replace(stored_file.md5sum, '0' * 32))
+        self.assertEqual(response.status_code, 404)
+        # only stored files are served
+        os.makedirs(os.path.join(self.temp_dir, 'tmp'), exist_ok=True)
+        with open(os.path.join(self.temp_dir, 'tmp', f'{stored_file.md5sum}.mp4'), 'wb') as f:
+            f.write(content)
+        response, body = await self.get(f'{settings.MEDIA_URL}tmp/{stored_file.md5sum}.mp4')
+        self.assertEqual(response.status_code, 404)
+
+    async def store_big_file(self):
+        content = os.urandom(4 * storage.FILE_RANGE_CHUNK_SIZE)
+        stored_file = await StoredFile.store(File(BytesIO(content), name='video.mp4'), 'video_files')
+        return stored_file, content
+
+    def assertStreamed(self, content, first, overwrite, read_rest):
+        """Check that the chunks after `first` are read from the file as they are sent, not buffered beforehand"""
+        self.assertEqual(first, content[100:100 + storage.FILE_RANGE_CHUNK_SIZE])
+        with open(overwrite, 'r+b') as f:
+            f.write(bytes(len(content)))
+        rest = read_rest()
+        self.assertEqual(rest, bytes(len(content) - 100 - len(first)))
+
+    def test_files_are_streamed_by_wsgi(self):
+        stored_file, content = async_to_sync(self.store_big_file)()
+        with warnings.catch_warnings():
+            warnings.simplefilter('error')
+            response = self.client.get(stored_file.url, headers={'Range': 'bytes=100-'})
+            self.assertEqual(response.status_code, 206)
+            chunks = iter(response.streaming_content)
+            self.assertStreamed(
+                content, next(chunks), os.path.join(self.temp_dir, stored_file.path), lambda: b''.join(chunks),
+            )
+
+    async def test_files_are_streamed_by_asgi(self):
+        stored_file, content = await self.store_big_file()
+        with warnings.catch_warnings():
+            warnings.simplefilter('error')
+            response = await AsyncClient().get(stored_file.url, headers={'Range': 'bytes=100-'})
+            self.assertEqual(response.status_code, 206)
+            chunks = aiter(response.streaming_content)
+            first = await anext(chunks)
+            loop = asyncio.get_running_loop()
+            # the rest is awaited from another thread, as this one runs the event loop
+            read_rest = lambda: asyncio.run_coroutine_threadsafe(join_chunks(chunks), loop).result()
+            await asyncio.to_thread(
+                self.assertStreamed, content, first, os.path.join(self.temp_dir, stored_file.path), read_rest,
+            )
+
+    @override_settings(MEDIA_X_ACCEL_REDIRECT='/protected-media/')
+    async def test_front_server_sends_the_file(self):
+        stored_file = await StoredFile.store(File(BytesIO(b'WEBVTT\n'), name='subs.vtt'), 'subs_files')
+        response, body = await self.get(stored_file.url, Range='bytes=0-1')
+        self.assertEqual((response.status_code, response.content), (200, b''))
+        self.assertEqual(response['X-Accel-Redirect'], f'/protected-media/{stored_file.path}')
+        self.assertEqual(response['Content-Type'], 'text/vtt')
+
+
+class DirectUploadTests(TransactionTestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        self.settings = override_settings(MEDIA_ROOT=self.temp_dir)
+        self.settings.enable()
+        self.addCleanup(self.settings.disable)
+        self.session = FakeS3Session(os.path.join(self.temp_dir, 's3'))
+        patch = mock.patch.object(views, 'make_aws_session', return_value=self.session)
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.credentials = json.dumps({'AccessKeyId': 'key', 'SecretAccessKey': 'secret', 'Expiration': '2099-01-01T00:00:00+00:00'})
+
+    def s3_path(self, key):
+        return os.path.join(self.session.root, 'bucket', key)
+
+    async def test_video_is_uploaded_straight_to_s3(self):
+        user = await User.objects.acreate(username='uploader')
+        datasets = [await Dataset.objects.acreate(name=f'dataset{ix}', created_by=user) for ix in range(2)]
+        for dataset in datasets:
+            await sync_to_async(assign_perm)('video_eval_app.manage_dataset', user, dataset)
+        profile = await sync_to_async(lambda: user.profile)()
+        dataset = datasets[0]
+        aws = {'credentials': self.credentials, 'location': 'bucket/dir'}
+
+        response = await self.async_client.post(reverse('direct_uploads', args=[profile.upload_token, dataset.id]), {'name': 'video.mp4'})
+        self.assertEqual(response.status_code, 400)
+        # refused before it is sent, instead of by S3 once it is
+        response = await self.async_client.post(
+            reverse('direct_uploads', args=[profile.upload_token, dataset.id]),
+            {'name': 'video.mp4', 'size': settings.S3_DIRECT_UPLOAD_MAX_SIZE + 1, **aws},
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('larger than the 5.0\xa0GB of a direct upload', response.json()['error'])
+        response = await self.async_client.post(
+            reverse('direct_uploads', args=[profile.upload_token, dataset.id]), {'name': 'video.mp4', 'size': 1000, **aws},
+        )
+        self.assertEqual(response.status_code, 201)
+        upload = response.json()
+        self.assertEqual(upload['url'], 'https://bucket.s3.amazonaws.com/')
+        self.assertEqual(upload['fields']['Content-Type'], 'video/mp4')
+        temp_key = upload['fields']['key']
+        self.assertTrue(temp_key.startswith('dir/tmp/uploads/'))
+        # the client POSTs the video to S3
+        content = os.urandom(1000)
+        os.makedirs(os.path.dirname(self.s3_path(temp_key)))
+        with open(self.s3_path(temp_key), 'wb') as f:
+            f.write(content)
+
+        upload_url = reverse('upload_video_api', args=[profile.upload_token, datasets[1].id])
+        response = await self.async_client.post(upload_url, {'direct_upload': upload['direct_upload'], **aws})
+        self.assertEqual((response.status_code, response.json()), (400, {'error': 'Invalid direct_upload'}))
+        upload_url = reverse('upload_video_api', args=[profile.upload_token, dataset.id])
+        response = await self.async_client.post(upload_url, {'direct_upload': upload['direct_upload'] + 'x', **aws})
+        self.assertEqual(response.status_code, 400)
+
+        with mock.patch.object(views.ffmpeg_queue, 'submit') as submit, override_settings(VIDEO_JOB_SHORT_BYTES=500):
+            response = await self.async_client.post(upload_url, {'direct_upload': upload['direct_upload'], 'cuts': '[[0, 1]]', **aws})
+        self.assertEqual(response.status_code, 200)
+        # sized on S3: too big to go ahead of the bulk uploads
+        submit.assert_called_once_with(tasks.run_video_job, mock.ANY, priority=VideoJob.Priority.BULK, owner=user.pk)
+        dataset_video = await DatasetVideo.objects.select_related('video').aget(pk=response.json()['dataset_video_id'])
+        video = dataset_video.video
+        md5sum = hashlib.md5(content).hexdigest()
+        self.assertEqual((video.md5sum, video.name, dataset_video.name), (md5sum, 'video.mp4', 'video.mp4'))
+        self.assertEqual((video.bucket, video.key), ('bucket', f'dir/video_files/{md5sum[0]}/{md5sum[1]}/{md5sum}.mp4'))
+        with open(self.s3_path(video.key), 'rb') as f:
+            self.assertEqual(f.read(), content)
+        # registered from its ETag, moved into place on S3, and never on this server
+        self.assertNotIn(('get_object', temp_key), self.session.requests)
+        self.assertFalse(os.path.exists(self.s3_path(temp_key)))
+        self.assertFalse(os.path.exists(os.path.join(self.temp_dir, 'video_files')))
+        job = await VideoJob.objects.aget(pk=response.json()['job_id'])
+        self.assertEqual(job.location, 'bucket/dir')
+
+    async def test_multipart_upload_is_hashed_from_s3(self):
+        self.session.multipart_etags = True
+        content = os.urandom(1000)
+        os.makedirs(os.path.dirname(self.s3_path('tmp/uploads/upload.mp4')))
+        with open(self.s3_path('tmp/uploads/upload.mp4'), 'wb') as f:
+            f.write(content)
+        stored_file = await StoredFile.store_s3_upload('tmp/uploads/upload.mp4', 'video.mp4', 'video_files', self.session, 'bucket')
+        self.assertIn(('get_object', 'tmp/uploads/upload.mp4'), self.session.requests)
+        self.assertEqual(stored_file.md5sum, hashlib.md5(content).hexdigest())
+        self.assertTrue(os.path.exists(self.s3_path(stored_file.key)))
+
+
+class FileIoLagTests(TransactionTestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        self.settings = override_settings(MEDIA_ROOT=self.temp_dir)
+        self.settings.enable()
+        self.addCleanup(self.settings.disable)
+
+    async def max_loop_lag(self, fill):
+        """The longest the event loop was held up by storing 3 concurrent uploads, of 32 MB each"""
+        names = []
+        for i in range(3):
+            names.append(os.path.join(self.temp_dir, f'{fill}{i}.mp4'))
+            with open(names[-1], 'wb') as f:
+                f.write(bytes([fill + i]) * 32 * 1024 * 1024)
+        lags = []
+        done = asyncio.Event()
+
+        async def ticker():
+            while not done.is_set():
+                before = time.monotonic()
+                await asyncio.sleep(0.001)
+                lags.append(time.monotonic() - before - 0.001)
+
+        async def store(name):
+            with open(name, 'rb') as f:
+                return await StoredFile.store(File(f, name=os.path.basename(name)), 'video_files')
+
+        ticker_task = asyncio.create_task(ticker())
+        await asyncio.gather(*[store(name) for name in names])
+        done.set()
+        await ticker_task
+        return max(lags)
+
+    async def test_stores_do_not_block_the_event_loop(self):
+        from . import models
+
+        async def run_inline(func, *args, **kwargs):
+            return func(*args, **kwargs)
+
+        with mock.patch.object(models, 'run_file_io', run_inline):
+            inline_lag = await self.max_loop_lag(0)
+        pool_lag = await self.max_loop_lag(10)
+        self.assertLess(pool_lag, inline_lag / 2)
+
+
+class CutDatasetVideoTransferTests(TransactionTestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        self.session = FakeS3Session(os.path.join(self.temp_dir, 's3'))
+
+    def put_s3_object(self, key, source):
+        path = os.path.join(self.session.root, 'bucket', key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        shutil.copyfile(source, path)
+        return os.path.getsize(path)
+
+    async def test_sources_are_downloaded_once(self):
+        video_name = os.path.join(self.temp_dir, 'video.mp4')
+        make_test_video(video_name)
+        audio_name = os.path.join(self.temp_dir, 'audio.m4a')
+        subprocess.run([
+            'ffmpeg', '-y', '-loglevel', 'error',
+            '-f', 'lavfi', '-i', 'sine=frequency=220:duration=12', audio_name,
+        ], check=True)
+        source_bytes = self.put_s3_object('video.mp4', video_name) + self.put_s3_object('audio.m4a', audio_name)
+
+        user = await User.objects.acreate(username='uploader')
+        dataset = await Dataset.objects.acreate(name='dataset', created_by=user)
+        video = await StoredFile.objects.acreate(md5sum='1' * 32, path='video_files/video.mp4', bucket='bucket', key='video.mp4')
+        audio = await StoredFile.objects.acreate(md5sum='2' * 32, path='audio_files/audio.m4a', bucket='bucket', key='audio.m4a')
+        cuts = [[start, start + 0.5] for start in range(0, 11)]
+        dataset_video = await DatasetVideo.objects.acreate(dataset=dataset, video=video, audio=audio, name='video', cuts=cuts)
+
+        with override_settings(MEDIA_ROOT=self.temp_dir):
+            await cut_dataset_video(dataset_video, self.session, None)
+
+        self.assertEqual(await dataset_video.segments.acount(), len(cuts))
+        # previously, both sources were downloaded again for each of the cuts
+        self.assertEqual(self.session.bytes_downloaded, source_bytes)
+        self.assertEqual(self.session.max_active_downloads, 2)
+
+    async def test_segments_are_uploaded_in_parallel(self):
+        video_name = os.path.join(self.temp_dir, 'video.mp4')
+        make_test_video(video_name, duration=4)
+        self.put_s3_object('video.mp4', video_name)
+        user = await User.objects.acreate(username='uploader')
+        dataset = await Dataset.objects.acreate(name='dataset', created_by=user)
+        video = await StoredFile.objects.acreate(md5sum='1' * 32, path='video_files/video.mp4', bucket='bucket', key='video.mp4')
+        cuts = [[start, start + 0.5] for start in range(0, 4)]
+        dataset_video = await DatasetVideo.objects.acreate(dataset=dataset, video=video, name='video', cuts=cuts)
+
+        with override_settings(MEDIA_ROOT=os.path.join(self.temp_dir, 'media'), FFMPEG_CONCURRENCY=1, S3_MAX_TRANSFERS=3):
+            await cut_dataset_video(dataset_video, self.session, 'bucket/out')
+
+        self.assertEqual(await StoredFile.objects.filter(segment_videos__dataset_video=dataset_video, bucket='bucket').acount(), len(cuts))
+        # the segments of a pass are uploaded at once, up to S3_MAX_TRANSFERS
+        self.assertEqual(self.session.max_active_uploads, 3)
+
+    @override_settings(FFMPEG_STREAM_TO_S3=True, S3_MULTIPART_PART_SIZE=16 * 1024)
+    async def test_cuts_are_streamed_to_s3(self):
+        video_name = os.path.join(self.temp_dir, 'video.mp4')
+        make_test_video(video_name, duration=4)
+        self.put_s3_object('video.mp4', video_name)
+        user = await User.objects.acreate(username='uploader')
+        dataset = await Dataset.objects.acreate(name='dataset', created_by=user)
+        video = await StoredFile.objects.acreate(md5sum='1' * 32, path='video_files/video.mp4', bucket='bucket', key='video.mp4')
+        cuts = [[0, 1.5], [2, 3.5]]
+        dataset_video = await DatasetVideo.objects.acreate(dataset=dataset, video=video, name='video', cuts=cuts)
+
+        media_root = os.path.join(self.temp_dir, 'media')
+        with override_settings(MEDIA_ROOT=media_root):
+            await cut_dataset_video(dataset_video, self.session, 'bucket/out')
+
+        segments = [segment async for segment in dataset_video.segments.select_related('video').order_by('start')]
+        self.assertEqual(len(segments), len(cuts))
+        for segment, (start, end) in zip(segments, cuts):
+            self.assertEqual(segment.video.bucket, 'bucket')
+            self.assertEqual(segment.video.key, f'out/{segment.video.path}')
+            s3_name = os.path.join(self.session.root, 'bucket', segment.video.key)
+            with open(s3_name, 'rb') as f:
+                self.assertEqual(hashlib.md5(f.read()).hexdigest(), segment.video.md5sum)
+            # fragmented MP4 starts after the B-frame delay, which an edit list would hide
+            probe = await tasks.probe_media(s3_name)
+            video_stream, = [stream for stream in probe['streams'] if stream['codec_type'] == 'video']
+            self.assertAlmostEqual(float(video_stream['duration']), end - start, delta=0.05)
+        self.assertGreater([request for request, _key in self.session.requests].count('upload_part'), len(cuts))
+        # nothing is left under the temporary keys, nor on local disk
+        self.assertEqual(os.listdir(os.path.join(self.session.root, 'bucket', 'out', 'tmp')), [])
+        self.assertFalse(os.path.exists(os.path.join(media_root, 'video_files')))
+        self.assertEqual(self.session.multipart_uploads, {})
+
+        # the fragmented MP4 is not reused for the same cuts written to files
+        other = await Dataset.objects.acreate(name='other', created_by=user)
+        other_video = await DatasetVideo.objects.acreate(dataset=other, video=video, name='video', cuts=cuts)
+        with override_settings(MEDIA_ROOT=media_root, FFMPEG_STREAM_TO_S3=False), \
+                mock.patch.object(tasks, 'cut_video_segments', wraps=tasks.cut_video_segments) as cut_video_segments:
+            await cut_dataset_video(other_video, self.session, 'bucket/out')
+        self.assertEqual(sum(len(call.args[2]) for call in cut_video_segments.call_args_list), len(cuts))
+        self.assertEqual(await CutResult.objects.acount(), 2 * len(cuts))
+
+
+@skipUnless(HAS_FFMPEG, "ffmpeg is not installed")
+class IncrementalRecutTests(TransactionTestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        self.settings = override_settings(MEDIA_ROOT=self.temp_dir)
+        self.settings.enable()
+        self.addCleanup(self.settings.disable)
+
+    async def cut(self, dataset_video):
+        with mock.patch.object(tasks, 'cut_video_segments', wraps=tasks.cut_video_segments) as cut_video_segments:
+            await cut_dataset_video(dataset_video, None, None)
+        return sum(len(call.args[2]) for call in cut_video_segments.call_args_list)
+
+    async def make_dataset_video(self, cuts, dataset_name='dataset'):
+        if not os.path.exists(os.path.join(self.temp_dir, 'video_files')):
+            os.makedirs(os.path.join(self.temp_dir, 'video_files'))
+            make_test_video(os.path.join(self.temp_dir, 'video_files', 'video.mp4'), duration=6)
+            os.makedirs(os.path.join(self.temp_dir, 'subs_files'))
+            with open(os.path.join(self.temp_dir, 'subs_files', 'subs.vtt'), 'w') as f:
+                f.write("WEBVTT\n\n00:00:00.500 --> 00:00:04.000\nHello\n")
+        user, _ = await User.objects.aget_or_create(username='uploader')
+        dataset = await Dataset.objects.acreate(name=dataset_name, created_by=user)
+        video, _ = await StoredFile.objects.aget_or_create(md5sum='1' * 32, path='video_files/video.mp4')
+        subtitles, _ = await StoredFile.objects.aget_or_create(md5sum='2' * 32, path='subs_files/subs.vtt')
+        return await DatasetVideo.objects.acreate(dataset=dataset, video=video, subtitles=subtitles, name='video', cuts=cuts)
+
+    async def test_only_changed_cuts_are_encoded(self):
+        dataset_video = await self.make_dataset_video([[0, 1], [1, 2], [2, 3], [3, 4]])
+        self.assertEqual(await self.cut(dataset_video), 4)
+        segments = {segment.start: segment async for segment in dataset_video.segments.all()}
+
+        dataset_video.cuts = [[0, 1], [1, 2.5], [3, 4]]
+        self.assertEqual(await self.cut(dataset_video), 1)
+        recut = {segment.start: segment async for segment in dataset_video.segments.all()}
+        self.assertEqual(sorted(recut), [0, 1, 3])
+        self.assertEqual(recut[0].pk, segments[0].pk)
+        self.assertEqual(recut[3].pk, segments[3].pk)
+        self.assertNotEqual(recut[1].pk, segments[1].pk)
+        self.assertEqual(recut[1].end, 2.5)
+
+        self.assertEqual(await self.cut(dataset_video), 0)
+        self.assertEqual(await dataset_video.segments.acount(), 3)
+
+    async def test_identical_cuts_are_reused_across_datasets(self):
+        first = await self.make_dataset_video([[0, 1], [2, 3]], 'first')
+        self.assertEqual(await self.cut(first), 2)
+        second = await self.make_dataset_video([[2, 3], [0, 1], [4, 5]], 'second')
+        self.assertEqual(await self.cut(second), 1)
+
+        first_videos = {segment.start: segment.video_id async for segment in first.segments.all()}
+        second_segments = {segment.start: segment async for segment in second.segments.all()}
+        self.assertEqual(sorted(second_segments), [0, 2, 4])
+        self.assertEqual(second_segments[0].video_id, first_videos[0])
+        self.assertEqual(second_segments[2].video_id, first_videos[2])
+        self.assertIsNotNone(second_segments[2].subtitles_id)
+
+    async def test_reused_cuts_are_moved_to_s3(self):
+        first = await self.make_dataset_video([[0, 1]], 'first')
+        self.assertEqual(await self.cut(first), 1)
+        second = await self.make_dataset_video([[0, 1]], 'second')
+        session = FakeS3Session(os.path.join(self.temp_dir, 's3'))
+        with mock.patch.object(tasks, 'cut_video_segments') as cut_video_segments:
+            await cut_dataset_video(second, session, 'bucket/dir')
+        cut_video_segments.assert_not_called()
+        segment = await second.segments.select_related('video').aget()
+        self.assertEqual(segment.video.bucket, 'bucket')
+        self.assertTrue(os.path.exists(os.path.join(session.root, 'bucket', segment.video.key)))
+
+
+@skipUnless(HAS_FFMPEG, "ffmpeg is not installed")
+@override_settings(CACHES=TEST_CACHES)
+class UploadVideoApiTests(TransactionTestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        self.settings = override_settings(MEDIA_ROOT=self.temp_dir)
+        self.settings.enable()
+        self.addCleanup(self.settings.disable)
+        self.video_name = os.path.join(self.temp_dir, 'source.mp4')
+        make_test_video(self.video_name, duration=2)
+
+    async def test_upload_returns_job_before_processing(self):
+        user = await User.objects.acreate(username='uploader')
+        dataset = await Dataset.objects.acreate(name='dataset', created_by=user)
+        await sync_to_async(assign_perm)('video_eval_app.manage_dataset', user, dataset)
+        profile = await sync_to_async(lambda: user.profile)()
+        with open(self.video_name, 'rb') as f:
+            upload = SimpleUploadedFile('video.mp4', f.read(), content_type='video/mp4')
+
+        with mock.patch.object(views.ffmpeg_queue, 'submit') as submit:
+            response = await self.async_client.post(
+                reverse('upload_video_api', args=[profile.upload_token, dataset.id]),
+                {'file': upload, 'cuts': '[[0, 1]]'},
+            )
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        # streamed to MEDIA_ROOT/tmp while hashed, then moved into place
+        with open(self.video_name, 'rb') as f:
+            md5sum = hashlib.md5(f.read()).hexdigest()
+        dataset_video = await DatasetVideo.objects.select_related('video').aget(pk=data['dataset_video_id'])
+        self.assertEqual(dataset_video.video.md5sum, md5sum)
+        self.assertTrue(os.path.exists(os.path.join(self.temp_dir, dataset_video.video.path)))
+        self.assertEqual(os.listdir(os.path.join(self.temp_dir, 'tmp')), [])
+        submit.assert_called_once_with(tasks.run_video_job, mock.ANY, priority=VideoJob.Priority.NORMAL, owner=user.pk)
+        self.assertEqual(str(submit.call_args.args[1]), data['job_id'])
+
+        response = await self.async_client.get(data['status_url'])
+        self.assertEqual(response.json()['status'], 'queued')
+
+        await tasks.run_video_job(data['job_id'])
+        response = await self.async_client.get(data['status_url'])
+        self.assertEqual(response.json()['status'], 'done')
+        dataset_video = await DatasetVideo.objects.aget(pk=data['dataset_video_id'])
+        self.assertTrue(dataset_video.is_cut)
+        self.assertEqual(await dataset_video.segments.acount(), 1)
+
+        # a second upload while the user's first one is still queued
+        await VideoJob.objects.filter(pk=data['job_id']).aupdate(status=VideoJob.Status.QUEUED)
+        with open(self.video_name, 'rb') as f:
+            upload = SimpleUploadedFile('other.mp4', f.read() + b'\0', content_type='video/mp4')
+        with override_settings(VIDEO_JOB_USER_QUEUE_LIMIT=1, VIDEO_JOB_RETRY_AFTER=30):
+            response = await self.async_client.post(
+                reverse('upload_video_api', args=[profile.upload_token, dataset.id]),
+                {'file': upload},
+            )
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response['Retry-After'], '30')
+        self.assertEqual(await DatasetVideo.objects.acount(), 1)
+
+    async def test_chunked_upload_survives_flaky_client(self):
+        user = await User.objects.acreate(username='uploader')
+        dataset = await Dataset.objects.acreate(name='dataset', created_by=user)
+        await sync_to_async(assign_perm)('video_eval_app.manage_dataset', user, dataset)
+        profile = await sync_to_async(lambda: user.profile)()
+        with open(self.video_name, 'rb') as f:
+            content = f.read()
+        size = len(content)
+        part = size // 5 + 1
+
+        response = await self.async_client.post(
+            reverse('chunked_uploads', args=[profile.upload_token, dataset.id]),
+            {'name': 'video.mp4', 'size': size},
+        )
+        self.assertEqual(response.status_code, 201)
+        upload = response.json()
+        self.assertEqual(upload['offset'], 0)
+
+        async def put(first, body, last=None):
+            last = first + len(body) - 1 if last is None else last
+            return await self.async_client.put(
+                upload['url'], body, content_type='application/octet-stream',
+                headers={'Content-Range': f'bytes {first}-{last}/{size}'},
+            )
+
+        attempts = 0
+        offset = 0
+        while offset < size:
+            attempts += 1
+            chunk = content[offset:offset + part]
+            if attempts == 2:
+                # the connection drops halfway through the part
+                response = await put(offset, chunk[:len(chunk) // 2], last=offset + len(chunk) - 1)
+            elif attempts == 3:
+                # the response to the first part was lost, so it is sent again
+                response = await put(0, content[:part])
+                self.assertEqual(response.status_code, 409)
+            elif attempts == 4:
+                # the next part is received by another process
+                forget_chunked_upload(upload['upload_id'])
+                response = await put(offset, chunk)
+            else:
+                response = await put(offset, chunk)
+            if response.status_code != 200:
+                response = await self.async_client.get(upload['url'])
+            offset = response.json()['offset']
+        self.assertEqual(offset, size)
+
+        with mock.patch.object(views.ffmpeg_queue, 'submit') as submit:
+            response = await self.async_client.post(
+                upload['finalize_url'], {'md5': hashlib.md5(content).hexdigest(), 'cuts': '[[0, 1]]'},
+            )
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        dataset_video = await DatasetVideo.objects.select_related('video').aget(pk=data['dataset_video_id'])
+        self.assertEqual(dataset_video.name, 'video.mp4')
+        self.assertEqual(dataset_video.video.md5sum, hashlib.md5(content).hexdigest())
+        with open(os.path.join(self.temp_dir, dataset_video.video.path), 'rb') as f:
+            self.assertEqual(f.read(), content)
+        self.assertEqual(os.listdir(os.path.join(self.temp_dir, 'tmp', 'uploads')), [])
+        self.assertFalse(await ChunkedUpload.objects.aexists())
+        submit.assert_called_once()
+
+        response = await self.async_client.get(upload['url'])
+        self.assertEqual(response.status_code, 404)
+
+    async def test_chunked_upload_part_sent_again_while_arriving(self):
+        user = await User.objects.acreate(username='uploader')
+        dataset = await Dataset.objects.acreate(name='dataset', created_by=user)
+        content = os.urandom(3000)
+        upload = await ChunkedUpload.objects.acreate(dataset=dataset, created_by=user, name='video.mp4', size=len(content))
+        reading = threading.Event()
+        resume = threading.Event()
+
+        class StalledStream(BytesIO):
+            def read(self, size=-1):
+                if self.tell():
+                    reading.set()
+                    resume.wait()
+                return super().read(min(size, 500))
+
+        # the first request stalls halfway through the part, and the client sends it again
+        stalled = asyncio.create_task(upload.aappend(0, StalledStream(content[:1000]), 1000))
+        await asyncio.to_thread(reading.wait)
+        retry = await ChunkedUpload.objects.aget(pk=upload.pk)
+        self.assertEqual(await retry.aappend(0, BytesIO(content[:1000]), 1000), 1000)
+        self.assertEqual(await retry.aappend(1000, BytesIO(content[1000:2000]), 1000), 1000)
+        resume.set()
+        self.assertIsNone(await stalled)
+
+        self.assertEqual(await retry.aappend(2000, BytesIO(content[2000:]), 1000), 1000)
+        video_file = await retry.aassemble()
+        self.assertEqual(video_file.md5sum, hashlib.md5(content).hexdigest())
+        with open(retry.path, 'rb') as f:
+            self.assertEqual(f.read(), content)
+        self.assertEqual(os.listdir(os.path.join(self.temp_dir, 'tmp', 'uploads')), [os.path.basename(retry.path)])
+        await retry.adiscard()
+
+    async def test_upload_by_md5_of_stored_file(self):
+        user = await User.objects.acreate(username='uploader')
+        other = await User.objects.acreate(username='other')
+        dataset = await Dataset.objects.acreate(name='dataset', created_by=user)
+        await sync_to_async(assign_perm)('video_eval_app.manage_dataset', user, dataset)
+        await sync_to_async(assign_perm)('video_eval_app.manage_dataset', other, dataset)
+        profile = await sync_to_async(lambda: user.profile)()
+        other_profile = await sync_to_async(lambda: other.profile)()
+        with open(self.video_name, 'rb') as f:
+            content = f.read()
+        md5sum = hashlib.md5(content).hexdigest()
+        exists_url = reverse('stored_file_exists', args=[profile.upload_token, dataset.id, md5sum])
+        upload_url = reverse('upload_video_api', args=[profile.upload_token, dataset.id])
+
+        response = await self.async_client.get(exists_url)
+        self.assertEqual(response.json(), {'md5': md5sum, 'exists': False})
+        response = await self.async_client.post(upload_url, {'file_md5': md5sum})
+        self.assertEqual(response.status_code, 404)
+
+        with mock.patch.object(views.ffmpeg_queue, 'submit') as submit:
+            await self.async_client.post(upload_url, {'file': SimpleUploadedFile('video.mp4', content)})
+            response = await self.async_client.get(exists_url)
+            self.assertEqual(response.json(), {'md5': md5sum, 'exists': True})
+            # reused in another dataset without sending it again, under another name
+            dataset2 = await Dataset.objects.acreate(name='dataset 2', created_by=user)
+            await sync_to_async(assign_perm)('video_eval_app.manage_dataset', user, dataset2)
+            with override_settings(VIDEO_JOB_SHORT_BYTES=len(content) - 1):
+                response = await self.async_client.post(
+                    reverse('upload_video_api', args=[profile.upload_token, dataset2.id]),
+                    {'file_md5': md5sum, 'name': 'again', 'cuts': '[[0, 1]]'},
+                )
+        self.assertEqual(response.status_code, 200)
+        # sized where it is stored, as if it had been sent again
+        self.assertEqual(submit.call_args.kwargs['priority'], VideoJob.Priority.BULK)
+        dataset_video = await DatasetVideo.objects.aget(pk=response.json()['dataset_video_id'])
+        self.assertEqual((dataset_video.video_id, dataset_video.name), (md5sum, 'again'))
+        self.assertEqual(await StoredFile.objects.acount(), 1)
+
+        # only known to the users of the datasets it is in
+        response = await self.async_client.get(reverse('stored_file_exists', args=[other_profile.upload_token, dataset.id, md5sum]))
+        self.assertEqual(response.json()['exists'], True)
+        dataset3 = await Dataset.objects.acreate(name='other dataset', created_by=other)
+        await sync_to_async(assign_perm)('video_eval_app.manage_dataset', other, dataset3)
+        response = await self.async_client.get(reverse('stored_file_exists', args=[other_profile.upload_token, dataset3.id, md5sum]))
+        self.assertEqual(response.json()['exists'], False)
+
+    async def test_web_form_upload_is_interactive(self):
+        user = await User.objects.acreate(username='uploader')
+        dataset = await Dataset.objects.acreate(name='dataset', created_by=user)
+        await sync_to_async(assign_perm)('video_eval_app.manage_dataset', user, dataset)
+        await self.async_client.aforce_login(user)
+        with open(self.video_name, 'rb') as f:
+            upload = SimpleUploadedFile('video.mp4', f.read(), content_type='video/mp4')
+
+        # the CSRF check is still made, once the upload handler is in place
+        csrf_client = AsyncClient(enforce_csrf_checks=True)
+        await csrf_client.aforce_login(user)
+        response = await csrf_client.post(reverse('dataset_videos_new', args=[dataset.id]), {'file': upload})
+        self.assertEqual(response.status_code, 403)
+        upload.seek(0)
+
+        with mock.patch.object(views.ffmpeg_queue, 'submit'):
+            response = await self.async_client.post(reverse('dataset_videos_new', args=[dataset.id]), {'file': upload})
+        self.assertRedirects(response, reverse('dataset_videos', args=[dataset.id]), fetch_redirect_response=False)
+        job = await VideoJob.objects.aget()
+        self.assertEqual(job.priority, VideoJob.Priority.INTERACTIVE)
+        self.assertEqual(os.listdir(os.path.join(self.temp_dir, 'tmp')), [])
+
+
+@skipUnless(HAS_FFMPEG, "ffmpeg is not installed")
+@override_settings(CACHES=TEST_CACHES)
+class VideoJobQueueTests(TransactionTestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        self.settings = override_settings(MEDIA_ROOT=self.temp_dir, VIDEO_JOB_POLL_INTERVAL=0.05)
+        self.settings.enable()
+        self.addCleanup(self.settings.disable)
+
+    async def make_job(self):
+        os.makedirs(os.path.join(self.temp_dir, 'video_files'), exist_ok=True)
+        make_test_video(os.path.join(self.temp_dir, 'video_files', 'video.mp4'), duration=2)
+        user = await User.objects.acreate(username='uploader')
+        dataset = await Dataset.objects.acreate(name='dataset', created_by=user)
+        video = await StoredFile.objects.acreate(md5sum='1' * 32, path='video_files/video.mp4')
+        dataset_video = await DatasetVideo.objects.acreate(dataset=dataset, video=video, name='video', cuts=[[0, 1]])
+        return await VideoJob.objects.acreate(dataset_video=dataset_video)
+
+    async def test_claims_are_exclusive_and_expired_leases_are_reclaimed(self):
+        job = await self.make_job()
+        first = await VideoJob.aclaim('first')
+        self.assertEqual((first.pk, first.attempts, first.status), (job.pk, 1, VideoJob.Status.RUNNING))
+        self.assertIsNone(await VideoJob.aclaim('second'))
+
+        # the first worker died
+        await VideoJob.objects.filter(pk=job.pk).aupdate(lease_expires_at=timezone.now() - timedelta(seconds=1))
+        second = await VideoJob.aclaim('second')
+        self.assertEqual((second.pk, second.attempts), (job.pk, 2))
+        self.assertFalse(await first.arenew_lease())
+        self.assertFalse(await first.afinish(VideoJob.Status.DONE))
+        self.assertTrue(await second.arenew_lease())
+
+        with override_settings(VIDEO_JOB_MAX_ATTEMPTS=2):
+            await VideoJob.objects.filter(pk=job.pk).aupdate(lease_expires_at=timezone.now() - timedelta(seconds=1))
+            self.assertIsNone(await VideoJob.aclaim('third'))
+            self.assertEqual(await VideoJob.afail_abandoned(), 1)
+        job = await VideoJob.objects.aget(pk=job.pk)
+        self.assertEqual(job.status, VideoJob.Status.FAILED)
+
+    async def test_claims_by_priority_then_fair_share(self):
+        job = await self.make_job()
+        users = [await User.objects.acreate(username=name) for name in 'abc']
+        make_job = partial(VideoJob.objects.acreate, dataset_video_id=job.dataset_video_id)
+        await job.adelete()
+        a1 = await make_job(created_by=users[0], priority=VideoJob.Priority.BULK)
+        a2 = await make_job(created_by=users[0], priority=VideoJob.Priority.BULK)
+        b1 = await make_job(created_by=users[1], priority=VideoJob.Priority.BULK)
+        c1 = await make_job(created_by=users[2], priority=VideoJob.Priority.INTERACTIVE)
+        claimed = [(await VideoJob.aclaim('worker')).pk for _ in range(4)]
+        self.assertEqual(claimed, [c1.pk, a1.pk, b1.pk, a2.pk])
+
+    async def test_stopped_worker_finishes_running_jobs(self):
+        job = await self.make_job()
+        stop_event = asyncio.Event()
+        worker = asyncio.create_task(tasks.work_video_jobs(stop_event, 1))
+        while (await VideoJob.objects.aget(pk=job.pk)).status == VideoJob.Status.QUEUED:
+            await asyncio.sleep(0.01)
+        stop_event.set()
+        await asyncio.wait_for(worker, 30)
+
+        job = await VideoJob.objects.select_related('dataset_video').aget(pk=job.pk)
+        self.assertEqual(job.status, VideoJob.Status.DONE)
+        self.assertIsNone(job.lease_expires_at)
+        self.assertTrue(job.dataset_video.is_cut)
+
+
+@skipUnless(HAS_FFMPEG, "ffmpeg is not installed")
+@override_settings(CACHES=TEST_CACHES)
+class VideoProgressTests(TransactionTestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        self.settings = override_settings(MEDIA_ROOT=self.temp_dir, VIDEO_PROGRESS_INTERVAL=0.01)
+        self.settings.enable()
+        self.addCleanup(self.settings.disable)
+
+    async def test_progress_is_streamed(self):
+        os.makedirs(os.path.join(self.temp_dir, 'video_files'))
+        make_test_video(os.path.join(self.temp_dir, 'video_files', 'video.mp4'), duration=4)
+        user = await User.objects.acreate(username='uploader')
+        dataset = await Dataset.objects.acreate(name='dataset', created_by=user)
+        await sync_to_async(assign_perm)('video_eval_app.manage_dataset', user, dataset)
+        video = await StoredFile.objects.acreate(md5sum='1' * 32, path='video_files/video.mp4')
+        dataset_video = await DatasetVideo.objects.acreate(dataset=dataset, video=video, name='video', cuts=[[0, 1], [2, 3.5]])
+
+        await tasks.cut_and_delocalize_video(dataset_video, None, None)
+        progress = tasks.get_progress([dataset_video.pk])[dataset_video.pk]
+        self.assertEqual(progress['status'], 'done')
+        self.assertEqual((progress['segments'], progress['segments_done']), (2, 2))
+
+        await self.async_client.aforce_login(user)
+        await DatasetVideo.objects.filter(pk=dataset_video.pk).aupdate(is_cut=False)
+        other = await Dataset.objects.acreate(name='other', created_by=user)
+        response = await self.async_client.get(reverse('datasets_progress'), {'dataset': [dataset.id, other.id]})
+        self.assertEqual(response.status_code, 403)
+        response = await self.async_client.get(reverse('datasets_progress'), {'dataset': dataset.id})
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        events = [event async for event in response.streaming_content]
+        self.assertEqual(len(events), 2)
+        data = json.loads(events[0].decode().removeprefix('data: '))
+        self.assertEqual(data['videos'][str(dataset_video.pk)]['status'], 'done')
+        self.assertEqual(data['datasets'][str(dataset.id)], {'status': 'done'})
+        self.assertTrue(events[1].startswith(b'event: end'))
+
+    async def make_processing_datasets(self):
+        user = await User.objects.acreate(username='uploader')
+        video = await StoredFile.objects.acreate(md5sum='1' * 32, path='video_files/video.mp4')
+        datasets = []
+        for ix in range(3):
+            dataset = await Dataset.objects.acreate(name=f'dataset{ix}', created_by=user)
+            await sync_to_async(assign_perm)('video_eval_app.manage_dataset', user, dataset)
+            dataset_video = await DatasetVideo.objects.acreate(dataset=dataset, video=video, name='video', cuts=[[0, 1]])
+            progress = tasks.VideoProgress(dataset_video)
+            progress.segments = 1
+            progress.save(force=True)
+            datasets.append(dataset)
+        return user, [dataset.id for dataset in datasets]
+
+    def assertFirstEventIsLive(self, first_event_seconds, data):
+        # sent as soon as it is known, not once the stream has ended
+        self.assertLess(first_event_seconds, settings.VIDEO_PROGRESS_STREAM_SECONDS)
+        data = json.loads(data.decode().removeprefix('data: '))
+        self.assertEqual(len(data['datasets']), 3)
+        self.assertEqual({progress['status'] for progress in data['datasets'].values()}, {'cutting'})
+
+    @override_settings(VIDEO_PROGRESS_STREAM_SECONDS=2)
+    def test_datasets_are_streamed_live_by_wsgi(self):
+        user, dataset_ids = async_to_sync(self.make_processing_datasets)()
+        self.client.force_login(user)
+        started = time.monotonic()
+        with warnings.catch_warnings():
+            warnings.simplefilter('error')
+            response = self.client.get(reverse('datasets_progress'), {'dataset': dataset_ids})
+            content = iter(response.streaming_content)
+            data = next(content)
+        self.assertFirstEventIsLive(time.monotonic() - started, data)
+        response.close()
+
+    @override_settings(VIDEO_PROGRESS_STREAM_SECONDS=2)
+    async def test_datasets_are_streamed_live_by_asgi(self):
+        user, dataset_ids = await self.make_processing_datasets()
+        await self.async_client.aforce_login(user)
+        started = time.monotonic()
+        with warnings.catch_warnings():
+            warnings.simplefilter('error')
+            response = await self.async_client.get(reverse('datasets_progress'), {'dataset': dataset_ids})
+            content = aiter(response.streaming_content)
+            data = await anext(content)
+        self.assertFirstEventIsLive(time.monotonic() - started, data)
+        await content.aclose()
+
+    @override_settings(VIDEO_PROGRESS_INTERVAL=0.5)
+    async def test_idle_asgi_stream_holds_no_thread(self):
+        user, dataset_ids = await self.make_processing_datasets()
+        await self.async_client.aforce_login(user)
+        running = []
+
+        class CountingExecutor(ThreadPoolExecutor):
+            def submit(self, fn, *args, **kwargs):
+                def run():
+                    running.append(fn)
+                    try:
+                        return fn(*args, **kwargs)
+                    finally:
+                        running.remove(fn)
+                return super().submit(run)
+
+        executor = CountingExecutor()
+        self.addCleanup(executor.shutdown)
+        asyncio.get_running_loop().set_default_executor(executor)
+        with mock.patch.object(storage, '_file_io_executor', executor):
+            response = await self.async_client.get(reverse('datasets_progress'), {'dataset': dataset_ids})
+            content = aiter(response.streaming_content)
+            await anext(content)
+            waiting = asyncio.create_task(anext(content))
+            await asyncio.sleep(0.2)
+            self.assertEqual(running, [])
+            waiting.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await waiting
+            await content.aclose()
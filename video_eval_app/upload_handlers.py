@@ -0,0 +1,143 @@
+import asyncio
+import hashlib
+import os
+import tempfile
+import threading
+from contextlib import asynccontextmanager
+
+from django.core.files import File, locks
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import TemporaryUploadedFile, UploadedFile
+from django.core.files.uploadhandler import FileUploadHandler
+
+
+class HashedUploadedFile(TemporaryUploadedFile):
+    """
+    An uploaded file written to MEDIA_ROOT/tmp (on the same filesystem as the
+    stored files, so it can be moved into place without copying), with the
+    md5 of its contents
+    """
+    def __init__(self, name, content_type, size, charset, content_type_extra=None):
+        temp_dir = default_storage.path('tmp')
+        os.makedirs(temp_dir, exist_ok=True)
+        _, ext = os.path.splitext(name)
+        file = tempfile.NamedTemporaryFile(suffix=".upload" + ext, dir=temp_dir)
+        UploadedFile.__init__(self, file, name, content_type, size, charset, content_type_extra)
+        self.md5 = hashlib.md5()
+
+    @property
+    def md5sum(self):
+        return self.md5.hexdigest()
+
+
+class HashingFileUploadHandler(FileUploadHandler):
+    """
+    Streams each uploaded file to disk as it arrives, hashing it on the way,
+    so that neither the whole file is held in memory nor is it copied again
+    to be stored. It has to be installed before the request body is read,
+    see `views.hashing_uploads`.
+    """
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        self.file = HashedUploadedFile(self.file_name, self.content_type, 0, self.charset, self.content_type_extra)
+
+    def receive_data_chunk(self, raw_data, start):
+        self.file.write(raw_data)
+        self.file.md5.update(raw_data)
+
+    def file_complete(self, file_size):
+        self.file.seek(0)
+        self.file.size = file_size
+        return self.file
+
+    def upload_interrupted(self):
+        if hasattr(self, "file"):
+            self.file.close()
+
+
+class HashedFile(File):
+    """
+    A file already on disk in MEDIA_ROOT/tmp, with a known md5, which
+    `store_file` moves into place like a `HashedUploadedFile`
+    """
+    def __init__(self, path, name, md5sum):
+        super().__init__(None, name)
+        self.path = path
+        self.size = os.path.getsize(path)
+        self.md5sum = md5sum
+
+    def temporary_file_path(self):
+        return self.path
+
+
+# md5 state of the chunked uploads received by this process, by id: (offset, md5)
+_chunked_hashes = {}
+_chunked_hashes_lock = threading.Lock()
+
+CHUNK_SIZE = 1024 * 1024
+
+def chunked_upload_md5(upload_id, path, offset):
+    """
+    The md5 of the first `offset` bytes of a chunked upload. It is kept up to date
+    as the parts arrive, the file is only read again when another process
+    received the previous ones.
+    """
+    with _chunked_hashes_lock:
+        state = _chunked_hashes.get(upload_id)
+    if state and state[0] == offset:
+        return state[1].copy()
+    md5 = hashlib.md5()
+    if offset:
+        with open(path, 'rb') as f:
+            remaining = offset
+            while remaining and (chunk := f.read(min(CHUNK_SIZE, remaining))):
+                md5.update(chunk)
+                remaining -= len(chunk)
+        if remaining:
+            raise RuntimeError(f"Chunked upload {upload_id} is missing {remaining} bytes")
+    return md5
+
+def receive_chunk(path, stream, length):
+    """
+    Write up to `length` bytes from `stream` to a file of its own, next to the
+    chunked upload at `path`. Returns its name and the number of bytes written.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    written = 0
+    with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), suffix='.put', delete=False) as f:
+        while written < length and (chunk := stream.read(min(CHUNK_SIZE, length - written))):
+            f.write(chunk)
+            written += len(chunk)
+    return f.name, written
+
+def append_chunk(upload_id, path, start, chunk_path):
+    """
+    Write the chunk received into `chunk_path` at `start` of `path`, dropping
+    anything after it, and hash it. `chunked_upload_lock` must be held.
+    """
+    md5 = chunked_upload_md5(upload_id, path, start)
+    with open(path, 'r+b') as f, open(chunk_path, 'rb') as r:
+        f.seek(start)
+        while chunk := r.read(CHUNK_SIZE):
+            f.write(chunk)
+            md5.update(chunk)
+        f.truncate()
+        offset = f.tell()
+    with _chunked_hashes_lock:
+        _chunked_hashes[upload_id] = (offset, md5)
+
+# How often to try again to lock a chunked upload, in seconds
+CHUNKED_UPLOAD_LOCK_POLL_INTERVAL = 0.05
+
+@asynccontextmanager
+async def chunked_upload_lock(path):
+    """Lock the chunked upload at `path` (creating it if needed), across processes"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'ab') as f:
+        while not locks.lock(f, locks.LOCK_EX | locks.LOCK_NB):
+            await asyncio.sleep(CHUNKED_UPLOAD_LOCK_POLL_INTERVAL)
+        yield
+
+def forget_chunked_upload(upload_id):
+    with _chunked_hashes_lock:
+        _chunked_hashes.pop(upload_id, None)
@@ -12,9 +12,11 @@ urlpatterns = [
     path("datasets/<int:dataset_id>/edit", views.dataset_edit, name="dataset_edit"),
     path("datasets/<int:dataset_id>/delete", views.delete_dataset, name="delete_dataset"),
     path("datasets/<int:dataset_id>/videos", views.dataset_videos, name="dataset_videos"),
+    path("datasets/progress", views.datasets_progress, name="datasets_progress"),
     path("datasets/<int:dataset_id>/videos/<int:dataset_video_id>/delete", views.delete_dataset_video, name="delete_dataset_video"),
     path("datasets/<int:dataset_id>/videos/new", views.dataset_video, name="dataset_videos_new"),
     path("datasets/<int:dataset_id>/videos/<int:dataset_video_id>", views.dataset_video, name="dataset_video"),
+    path("datasets/<int:dataset_id>/videos/direct_upload", views.dataset_video_direct_upload, name="dataset_video_direct_upload"),
     path("datasets/<int:dataset_id>/projects", views.dataset_projects, name="dataset_projects"),
     path("datasets/<int:dataset_id>/projects/<int:project_id>", views.dataset_project, name="dataset_project"),
     path("datasets/<int:dataset_id>/projects/<int:project_id>/delete", views.delete_project, name="delete_project"),
@@ -40,5 +42,11 @@ urlpatterns = [
     path("invitations/accept-invite/<str:key>", views.accept_invite, name="accept-invite"),
 
     path("upload_video/<uuid:user_token>/<int:dataset_id>", views.upload_video_api, name="upload_video_api"),
+    path("upload_video/<uuid:user_token>/<int:dataset_id>/files/<str:md5sum>", views.stored_file_exists, name="stored_file_exists"),
+    path("upload_video/<uuid:user_token>/<int:dataset_id>/direct_uploads", views.direct_uploads, name="direct_uploads"),
+    path("upload_video/<uuid:user_token>/<int:dataset_id>/uploads", views.chunked_uploads, name="chunked_uploads"),
+    path("upload_video/<uuid:user_token>/<int:dataset_id>/uploads/<uuid:upload_id>", views.chunked_upload, name="chunked_upload"),
+    path("upload_video/<uuid:user_token>/<int:dataset_id>/uploads/<uuid:upload_id>/finalize", views.chunked_upload_finalize, name="chunked_upload_finalize"),
+    path("jobs/<uuid:job_id>", views.video_job, name="video_job"),
     # path("turk_question", views.turk_question),
 ]
@@ -3,23 +3,32 @@ from icecream import ic # XXX: delete later
 
 from django.contrib.admin.options import TemplateResponse, messages
 
+import asyncio
 import json
+from functools import wraps
 from datetime import datetime
 from io import BytesIO, StringIO
 import os
 import hashlib
+import logging
 import random
+import re
+import time
 import csv
 
+from django.template.defaultfilters import filesizeformat
 from django.template.loader import render_to_string
 from django.core.files import File
+from django.core.files.storage import default_storage
 from django.conf import settings
 from django.shortcuts import HttpResponseRedirect, render, redirect
-from django.http import HttpResponse, JsonResponse, Http404
+from django.http import HttpResponse, HttpResponseNotAllowed, JsonResponse, Http404, StreamingHttpResponse
+from django.core import signing
+from django.core.handlers.asgi import ASGIRequest
 from django.core.paginator import Paginator
 from django.contrib.auth.decorators import login_required
 from django.urls import reverse
-from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.csrf import csrf_exempt, csrf_protect
 from django.views.decorators.http import require_POST, require_safe
 from django.db import transaction
 from django.db.utils import IntegrityError
@@ -40,15 +49,19 @@ from schema import SchemaError
 
 
 from .models import *
-from .tasks import get_assignments_from_mturk, post_project_to_mturk, cut_and_delocalize_video
+from .tasks import get_assignments_from_mturk, post_project_to_mturk, run_video_job, get_progress
 from .mturk import MTurk, make_aws_session
 from .utils import convert_answers, load_subtitles
 from .json_schemata import parse_hit_type, parse_credentials, parse_questions, parse_cuts, CredentialValidationError, JSONParseError
 from .async_queue import AsyncQueue
+from .upload_handlers import HashingFileUploadHandler
+from .storage import direct_upload_key, presign_upload, read_file_range, run_file_io
 
 
 Invitation = get_invitation_model()
 
+logger = logging.getLogger(__name__)
+
 
 ITEMS_PER_PAGE = 10
 
@@ -62,10 +75,44 @@ class JsonResponseWithNewline(JsonResponse):
         super().__init__(data, **kwargs)
         self.content += b"\n"
 
-ffmpeg_queue = AsyncQueue()
+def streaming_response(request, content, **kwargs):
+    """
+    A `StreamingHttpResponse` sending the iterator `content` as it comes, whether
+    served by WSGI or ASGI: Django buffers the whole of an async iterator served
+    by WSGI, and of a sync one served by ASGI, so under ASGI `content` is
+    iterated in a thread
+    """
+    if isinstance(request, ASGIRequest):
+        content = iterate_in_thread(content)
+    return StreamingHttpResponse(content, **kwargs)
+
+async def iterate_in_thread(iterator):
+    iterator = iter(iterator)
+    done = object()
+    try:
+        while (item := await sync_to_async(next, thread_sensitive=False)(iterator, done)) is not done:
+            yield item
+    finally:
+        if close := getattr(iterator, 'close', None):
+            await sync_to_async(close, thread_sensitive=False)()
+
+ffmpeg_queue = AsyncQueue(num_workers=settings.FFMPEG_CONCURRENCY, maxsize=settings.VIDEO_JOB_QUEUE_LIMIT)
 
 arender = sync_to_async(render)
 
+def hashing_uploads(view):
+    """
+    Stream the files uploaded to (async) `view` to disk with `HashingFileUploadHandler`.
+    The handlers must be set before the request body is read, which the CSRF
+    middleware would do: `view` has to check CSRF itself (`csrf_protect`), if needed.
+    """
+    @csrf_exempt
+    @wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        request.upload_handlers = [HashingFileUploadHandler(request)]
+        return await view(request, *args, **kwargs)
+    return wrapper
+
 @sync_to_async
 def auser_has_perm(request, perm, obj):
     return request.user.has_perm(perm, obj)
@@ -118,7 +165,16 @@ async def get_request_credentials(request):
     return credentials
 
 
-async def upload_video(request, dataset, credentials, user=None):
+async def upload_video(request, dataset, credentials, user=None, interactive=False, video_file=None, video=None):
+    file_user = user or request.user
+    direct_upload = None
+    if not (video or video_file) and (token := request.POST.get('direct_upload')):
+        # uploaded straight to S3, see `direct_upload_data`
+        direct_upload = load_direct_upload(token, dataset, file_user)
+    elif not video:
+        video_file = video_file or request.FILES["file"]
+    await VideoJob.acheck_capacity(file_user)
+
     location = credentials and credentials.pop('Location')
     session = None
     if location:
@@ -127,13 +183,18 @@ async def upload_video(request, dataset, credentials, user=None):
         else:
             raise NoCredentialsError("S3 location has been requested but no AWS credentials were supplied")
 
-    file_user = user or request.user
-    video = await StoredFile.store(request.FILES["file"], "video_files", session, location, created_by=file_user)
+    if direct_upload:
+        if not session or location != direct_upload['location']:
+            raise NoCredentialsError("The video was uploaded to S3: its location and AWS credentials are required")
+        video = await StoredFile.store_s3_upload(
+            direct_upload['key'], direct_upload['name'], "video_files", session, location, created_by=file_user,
+        )
+    video = video or await StoredFile.store(video_file, "video_files", session, location, created_by=file_user)
     audio = await StoredFile.store(request.FILES.get("audio"), "audio_files", session, location, created_by=file_user)
     if raw_subtitles_file := request.FILES.get('subtitles'):
         with raw_subtitles_file.open('rb') as r:
             raw_subs = r.read()
-        subs = load_subtitles(sub_contents=raw_subs)
+        subs = await run_file_io(load_subtitles, sub_contents=raw_subs)
         subs_base, _ = os.path.splitext(raw_subtitles_file.name)
         subs_name = f"{subs_base}.vtt"
         subs_file = File(file=BytesIO(subs.content.encode()), name=subs_name)
@@ -154,7 +215,7 @@ async def upload_video(request, dataset, credentials, user=None):
     else:
         cuts_data = None
 
-    name = request.POST.get('name', '') or request.FILES["file"].name
+    name = request.POST.get('name', '') or (video_file or video).name
     dataset_video, _created = await DatasetVideo.objects.aget_or_create(
         dataset=dataset,
         video=video,
@@ -163,8 +224,68 @@ async def upload_video(request, dataset, credentials, user=None):
         name=name,
         cuts=cuts_data,
     )
-    await ffmpeg_queue(cut_and_delocalize_video, dataset_video, session, location)
-    return dataset_video
+    # processed in the background (here, or by any `video_worker`), and followed through the job
+    # (a video added by its md5, or uploaded straight to S3, is sized where it is stored)
+    if interactive:
+        priority = VideoJob.Priority.INTERACTIVE
+    elif (video_file.size if video_file else await video.asize(session) or 0) <= settings.VIDEO_JOB_SHORT_BYTES:
+        priority = VideoJob.Priority.NORMAL
+    else:
+        priority = VideoJob.Priority.BULK
+    job = await VideoJob.objects.acreate(
+        dataset_video=dataset_video,
+        created_by=file_user,
+        priority=priority,
+        credentials=credentials if location else None,
+        location=location or '',
+    )
+    if settings.VIDEO_JOBS_IN_PROCESS:
+        try:
+            ffmpeg_queue.submit(run_video_job, job.pk, priority=job.priority, owner=file_user.pk)
+        except asyncio.QueueFull:
+            logger.warning(f"In-process queue is full, leaving {job!r} to the video workers")
+    return dataset_video, job
+
+
+DIRECT_UPLOAD_SALT = 'video_eval_app.direct_upload'
+
+async def direct_upload_data(request, dataset, user, credentials):
+    """
+    Let the video named `name` (a form field), of `size` bytes if given, be
+    uploaded straight to S3: the presigned POST `url` and `fields` to send it
+    with, and the `direct_upload` to pass instead of the file to `upload_video`
+    afterwards. A video too big for a presigned POST is refused before it is sent.
+    """
+    location = credentials and credentials.get('Location')
+    if not location:
+        raise NoCredentialsError("Direct uploads need AWS credentials and an S3 location")
+    if not (name := request.POST.get('name')):
+        raise ValueError("The video name is required")
+    if size := request.POST.get('size'):
+        try:
+            size = int(size)
+        except ValueError:
+            raise ValueError("Invalid video size")
+        if size > settings.S3_DIRECT_UPLOAD_MAX_SIZE:
+            raise ValueError(
+                f"The video is {filesizeformat(size)}, larger than the "
+                f"{filesizeformat(settings.S3_DIRECT_UPLOAD_MAX_SIZE)} of a direct upload"
+            )
+    session = make_aws_session({key: value for key, value in credentials.items() if key != 'Location'})
+    bucket, key = direct_upload_key(name, location)
+    post = await presign_upload(session, bucket, key, name)
+    token = signing.dumps({
+        'key': key, 'name': name, 'location': location, 'dataset': dataset.id, 'user': user.id,
+    }, salt=DIRECT_UPLOAD_SALT)
+    return {"url": post['url'], "fields": post['fields'], "direct_upload": token}
+
+def load_direct_upload(token, dataset, user):
+    """The upload signed by `direct_upload_data`, which has to be to `dataset` by `user`"""
+    # the upload may take as long as its presigned POST is valid
+    upload = signing.loads(token, salt=DIRECT_UPLOAD_SALT, max_age=2 * settings.S3_DIRECT_UPLOAD_EXPIRES)
+    if upload['dataset'] != dataset.id or upload['user'] != user.id:
+        raise signing.BadSignature("The direct upload is for another dataset")
+    return upload
 
 
 def bulk_remove_perm(perm, query, obj):
@@ -482,59 +603,198 @@ async def delete_project(request, dataset_id, project_id):
         **template_vars,
     })
 
+def upload_api(view):
+    """
+    Authenticate the API `view` by the upload token of its user, who has to be able to
+    upload to the dataset, and turn the errors into JSON responses.
+    `view` is called with the user and the dataset instead of their token and id.
+    """
+    @wraps(view)
+    async def wrapper(request, user_token, dataset_id, *args, **kwargs):
+        try:
+            # Get user by upload token
+            user_profile = await UserProfile.objects.select_related('user').aget(upload_token=user_token)
+            user = user_profile.user
+
+            # Get dataset and validate user has permission to upload
+            dataset = await Dataset.objects.aget(id=dataset_id)
+
+            # Check if user can manage dataset or any projects in the dataset
+            manage_dataset_perm = await sync_to_async(
+                lambda: dataset in get_objects_for_user(user, 'video_eval_app.manage_dataset')
+            )()
+            manage_project_perm = await sync_to_async(
+                lambda: dataset.projects.filter(
+                    id__in=get_objects_for_user(user, 'video_eval_app.manage_project').values_list('id', flat=True)
+                ).exists()
+            )()
+
+            if not (manage_dataset_perm or manage_project_perm):
+                return JsonResponseWithNewline({"error": "Permission denied: user cannot upload to this dataset"}, status=403)
+
+            return await view(request, user, dataset, *args, **kwargs)
+        except UserProfile.DoesNotExist:
+            return JsonResponseWithNewline({"error": "Invalid user token"}, status=403)
+        except Dataset.DoesNotExist:
+            return JsonResponseWithNewline({"error": "Invalid dataset ID"}, status=404)
+        except ChunkedUpload.DoesNotExist:
+            return JsonResponseWithNewline({"error": "Invalid upload ID"}, status=404)
+        except (JSONParseError, CredentialValidationError, NoCredentialsError) as x:
+            return JsonResponseWithNewline({"error": str(x)}, status=400)
+        except signing.BadSignature:
+            return JsonResponseWithNewline({"error": "Invalid direct_upload"}, status=400)
+        except IntegrityError as e:
+            return JsonResponseWithNewline({"error": "This video is already in this dataset"}, status=400)
+        except asyncio.QueueFull as x:
+            response = JsonResponseWithNewline({"error": str(x)}, status=429)
+            response['Retry-After'] = str(settings.VIDEO_JOB_RETRY_AFTER)
+            return response
+        except Exception as e:
+            if settings.DEBUG:
+                import traceback
+                return JsonResponseWithNewline({
+                    "error": str(e),
+                    "traceback": traceback.format_exc()
+                }, status=500)
+            else:
+                return JsonResponseWithNewline({"error": "An error occurred while uploading the video"}, status=500)
+    return wrapper
+
+async def get_api_credentials(request):
+    credentials = await get_request_credentials(request)
+
+    # Handle location parameter like the web interface does
+    location = request.POST.get('Location') or request.POST.get('location')
+    if location and credentials:
+        credentials['Location'] = location
+    return credentials
+
+async def upload_video_from_api(request, dataset, user, video_file=None, video=None):
+    credentials = await get_api_credentials(request)
+
+    # Pass the authenticated user to upload_video for file attribution
+    dataset_video, job = await upload_video(request, dataset, credentials, user, video_file=video_file, video=video)
+    return JsonResponseWithNewline({
+        "dataset_video_id": dataset_video.id,
+        "job_id": str(job.pk),
+        "status_url": request.build_absolute_uri(reverse('video_job', args=[job.pk])),
+    })
+
+@hashing_uploads
+@require_POST
+@upload_api
+async def upload_video_api(request, user, dataset):
+    video = None
+    if 'file' not in request.FILES and (md5sum := request.POST.get('file_md5')):
+        # see `stored_file_exists`
+        if not (video := await StoredFile.aget_reusable(md5sum, user, dataset)):
+            return JsonResponseWithNewline({"error": "Unknown file_md5, the file has to be uploaded"}, status=404)
+    return await upload_video_from_api(request, dataset, user, video=video)
+
+@require_safe
+@upload_api
+async def stored_file_exists(request, user, dataset, md5sum):
+    """
+    Whether the video with `md5sum` is stored already, so that it can be added to
+    the dataset by passing `file_md5` to `upload_video_api` instead of the file
+    """
+    video = await StoredFile.aget_reusable(md5sum, user, dataset)
+    return JsonResponseWithNewline({"md5": md5sum.lower(), "exists": video is not None})
+
 @csrf_exempt
 @require_POST
-async def upload_video_api(request, user_token, dataset_id):
+@upload_api
+async def direct_uploads(request, user, dataset):
+    """
+    Start an upload of the video `name` straight to S3 (the form fields `credentials`
+    and `location` are required): POST it, as `file`, to the returned `url` with the
+    returned `fields`, then pass `direct_upload` instead of the file to `upload_video_api`
+    """
+    credentials = await get_api_credentials(request)
     try:
-        # Get user by upload token
-        from .models import UserProfile
-        user_profile = await UserProfile.objects.select_related('user').aget(upload_token=user_token)
-        user = user_profile.user
-
-        # Get dataset and validate user has permission to upload
-        dataset = await Dataset.objects.aget(id=dataset_id)
-
-        # Check if user can manage dataset or any projects in the dataset
-        from guardian.shortcuts import get_objects_for_user
-        manage_dataset_perm = await sync_to_async(
-            lambda: dataset in get_objects_for_user(user, 'video_eval_app.manage_dataset')
-        )()
-        manage_project_perm = await sync_to_async(
-            lambda: dataset.projects.filter(
-                id__in=get_objects_for_user(user, 'video_eval_app.manage_project').values_list('id', flat=True)
-            ).exists()
-        )()
-
-        if not (manage_dataset_perm or manage_project_perm):
-            return JsonResponseWithNewline({"error": "Permission denied: user cannot upload to this dataset"}, status=403)
-
-        credentials = await get_request_credentials(request)
-
-        # Handle location parameter like the web interface does
-        location = request.POST.get('Location') or request.POST.get('location')
-        if location and credentials:
-            credentials['Location'] = location
-
-        # Pass the authenticated user to upload_video for file attribution
-        dataset_video = await upload_video(request, dataset, credentials, user)
-        return JsonResponseWithNewline({"dataset_video_id": dataset_video.id})
-    except UserProfile.DoesNotExist:
-        return JsonResponseWithNewline({"error": "Invalid user token"}, status=403)
-    except Dataset.DoesNotExist:
-        return JsonResponseWithNewline({"error": "Invalid dataset ID"}, status=404)
-    except (JSONParseError, CredentialValidationError) as x:
+        data = await direct_upload_data(request, dataset, user, credentials)
+    except ValueError as x:
         return JsonResponseWithNewline({"error": str(x)}, status=400)
-    except IntegrityError as e:
-        return JsonResponseWithNewline({"error": "This video is already in this dataset"}, status=400)
-    except Exception as e:
-        if settings.DEBUG:
-            import traceback
-            return JsonResponseWithNewline({
-                "error": str(e),
-                "traceback": traceback.format_exc()
-            }, status=500)
-        else:
-            return JsonResponseWithNewline({"error": "An error occurred while uploading the video"}, status=500)
+    return JsonResponseWithNewline(data, status=201)
+
+CONTENT_RANGE_RE = re.compile(r'bytes (\d+)-(\d+)/(\d+)$')
+
+@csrf_exempt
+@require_POST
+@upload_api
+async def chunked_uploads(request, user, dataset):
+    """
+    Start a resumable upload of a video of `size` bytes (form fields `name` and `size`):
+    its parts are then PUT to the returned `url` and it is finished by a POST to `finalize_url`
+    """
+    try:
+        size = int(request.POST['size'])
+        name = request.POST['name']
+    except (KeyError, ValueError):
+        return JsonResponseWithNewline({"error": "The video name and size are required"}, status=400)
+    if size <= 0:
+        return JsonResponseWithNewline({"error": "The video is empty"}, status=400)
+    # no point in receiving a video that could not be queued
+    await VideoJob.acheck_capacity(user)
+    upload = await ChunkedUpload.objects.acreate(dataset=dataset, created_by=user, name=name, size=size)
+    args = [request.resolver_match.kwargs['user_token'], dataset.id, upload.pk]
+    return JsonResponseWithNewline({
+        **upload.status_data(),
+        "url": request.build_absolute_uri(reverse('chunked_upload', args=args)),
+        "finalize_url": request.build_absolute_uri(reverse('chunked_upload_finalize', args=args)),
+    }, status=201)
+
+@csrf_exempt
+@upload_api
+async def chunked_upload(request, user, dataset, upload_id):
+    """
+    GET the offset to resume an upload from, or PUT its next part, at that offset,
+    with a `Content-Range: bytes <first>-<last>/<size>` header.
+    A part cut short is kept up to where it ended.
+    """
+    upload = await ChunkedUpload.objects.aget(pk=upload_id, dataset=dataset, created_by=user)
+    if request.method in {"GET", "HEAD"}:
+        return JsonResponseWithNewline(upload.status_data())
+    if request.method != "PUT":
+        return HttpResponseNotAllowed(["GET", "HEAD", "PUT"])
+
+    match = CONTENT_RANGE_RE.match(request.headers.get('Content-Range', ''))
+    if not match:
+        return JsonResponseWithNewline({"error": "A Content-Range: bytes <first>-<last>/<size> header is required"}, status=400)
+    first, last, size = map(int, match.groups())
+    if size != upload.size or last < first or last >= size:
+        return JsonResponseWithNewline({"error": "Invalid Content-Range", **upload.status_data()}, status=416)
+    written = await upload.aappend(first, request, last - first + 1)
+    if written is None:
+        # a part sent again, or out of order: the client resumes from the offset
+        await upload.arefresh_from_db(fields=['offset'])
+        return JsonResponseWithNewline({"error": "The part does not start at the offset", **upload.status_data()}, status=409)
+    return JsonResponseWithNewline(upload.status_data())
+
+@hashing_uploads
+@require_POST
+@upload_api
+async def chunked_upload_finalize(request, user, dataset, upload_id):
+    """
+    Add the completely uploaded video to the dataset, with the other fields of
+    `upload_video_api`, and `md5` optionally to check it against
+    """
+    upload = await ChunkedUpload.objects.aget(pk=upload_id, dataset=dataset, created_by=user)
+    if not upload.complete:
+        return JsonResponseWithNewline({"error": "The upload is incomplete", **upload.status_data()}, status=409)
+    video_file = await upload.aassemble()
+    if (md5sum := request.POST.get('md5')) and md5sum.lower() != video_file.md5sum:
+        await upload.adiscard()
+        return JsonResponseWithNewline({"error": "The uploaded video does not match its md5"}, status=400)
+    try:
+        response = await upload_video_from_api(request, dataset, user, video_file=video_file)
+    except BaseException:
+        # the upload can be finalized again, unless the parts have been moved into place
+        if not os.path.exists(upload.path):
+            await upload.adiscard()
+        raise
+    await upload.adiscard()
+    return response
 
 @login_required
 @require_safe
@@ -560,7 +820,9 @@ def dataset_videos(request, dataset_id):
         **template_vars,
     })
 
+@hashing_uploads
 @login_required
+@csrf_protect
 async def dataset_video(request, dataset_id, dataset_video_id=None):
     dataset, _project, template_vars = await aget_menu_data(request, dataset_id)
     manage_dataset_perm = dataset_id in template_vars['manage_dataset_ids']
@@ -589,15 +851,19 @@ async def dataset_video(request, dataset_id, dataset_video_id=None):
             'editable': manage_dataset_perm,
             'dataset_video': dataset_video,
             'page': page,
+            'direct_upload': bool(request.credentials and request.credentials.get('Location')),
             **template_vars,
         })
     elif request.method == 'POST':
         try:
-            await upload_video(request, dataset, request.credentials)
+            await upload_video(request, dataset, request.credentials, interactive=True)
             return redirect('dataset_videos', dataset_id=dataset.id)
         except Exception as e:
             logger.error(f"Failed to upload video for dataset {dataset_id}: {str(e)}")
-            messages.error(request, "Failed to upload video. Please try again.")
+            if isinstance(e, asyncio.QueueFull):
+                messages.error(request, f"{e}. Please try again later.")
+            else:
+                messages.error(request, "Failed to upload video. Please try again.")
             # Re-render the form with error message
             dataset_video = DatasetVideo(dataset=dataset)
             return await arender(request, 'dataset_video.html', {
@@ -607,6 +873,218 @@ async def dataset_video(request, dataset_id, dataset_video_id=None):
                 **template_vars,
             })
 
+@login_required
+@require_POST
+async def dataset_video_direct_upload(request, dataset_id):
+    """Start an upload of a video straight to S3 for `dataset_video` (with the credentials of the cookie)"""
+    dataset, _project, template_vars = await aget_menu_data(request, dataset_id)
+    manage_dataset_perm = dataset_id in template_vars['manage_dataset_ids']
+    managed_projects = dataset.projects.filter(id__in=template_vars['manage_project_ids'])
+    if not (manage_dataset_perm or await managed_projects.aexists()):
+        return JsonResponseWithNewline({"error": "Forbidden"}, status=403)
+    user = await request.auser()
+    try:
+        data = await direct_upload_data(request, dataset, user, request.credentials and dict(request.credentials))
+    except (NoCredentialsError, ValueError) as x:
+        return JsonResponseWithNewline({"error": str(x)}, status=400)
+    return JsonResponseWithNewline(data, status=201)
+
+def summarize_progress(videos_progress):
+    """Progress of a whole dataset, from that of its videos being processed"""
+    cutting = [progress for progress in videos_progress if progress['status'] == 'cutting']
+    etas = [progress['eta'] for progress in cutting if progress['eta'] is not None]
+    return {
+        'status': 'cutting' if cutting else 'storing',
+        'segments': sum(progress['segments'] for progress in cutting),
+        'segments_done': sum(progress['segments_done'] for progress in cutting),
+        'speed': sum(progress['speed'] for progress in cutting),
+        'eta': max(etas, default=None),
+        'updated_at': max((progress['updated_at'] for progress in videos_progress), default=None),
+    }
+
+@sync_to_async
+def get_followed_dataset_ids(user, dataset_ids):
+    """Those of `dataset_ids` that `user` manages, or manages projects of"""
+    followed = set(
+        get_objects_for_user(user, 'video_eval_app.manage_dataset')
+            .filter(id__in=dataset_ids)
+            .values_list('id', flat=True)
+    )
+    followed.update(
+        get_objects_for_user(user, 'video_eval_app.manage_project')
+            .filter(dataset_id__in=dataset_ids)
+            .values_list('dataset_id', flat=True)
+    )
+    return followed
+
+def progress_event(pending, dataset_ids, progress):
+    """
+    The event of the `progress` of the `pending` dataset videos (their dataset
+    ids, by id) of `dataset_ids`, once the finished ones are dropped from `pending`
+    """
+    for pk, video_progress in progress.items():
+        if video_progress['status'] in {'done', 'failed'}:
+            del pending[pk]
+    # a dataset is done once none of its videos are pending
+    datasets_progress = {dataset_id: [] for dataset_id in pending.values()}
+    for pk, video_progress in progress.items():
+        if pk in pending:
+            datasets_progress[pending[pk]].append(video_progress)
+    data = {
+        'videos': progress,
+        'datasets': {
+            dataset_id: summarize_progress(datasets_progress[dataset_id])
+            if dataset_id in datasets_progress else {'status': 'done'}
+            for dataset_id in dataset_ids
+        },
+    }
+    return f"data: {json.dumps(data)}\n\n"
+
+PROGRESS_END_EVENT = "event: end\ndata: {}\n\n"
+
+def progress_events(pending):
+    """
+    The progress events of the `pending` dataset videos (their dataset ids, by id),
+    until they are all done or `VIDEO_PROGRESS_STREAM_SECONDS` have passed
+    """
+    dataset_ids = set(pending.values())
+    deadline = time.monotonic() + settings.VIDEO_PROGRESS_STREAM_SECONDS
+    last_progress = None
+    while pending and time.monotonic() < deadline:
+        progress = get_progress(pending)
+        if progress != last_progress:
+            yield progress_event(pending, dataset_ids, progress)
+            last_progress = progress
+        time.sleep(settings.VIDEO_PROGRESS_INTERVAL)
+    if not pending:
+        yield PROGRESS_END_EVENT
+
+async def aprogress_events(pending):
+    """`progress_events` for ASGI, which holds no thread between the events"""
+    dataset_ids = set(pending.values())
+    deadline = time.monotonic() + settings.VIDEO_PROGRESS_STREAM_SECONDS
+    last_progress = None
+    while pending and time.monotonic() < deadline:
+        progress = await run_file_io(get_progress, list(pending))
+        if progress != last_progress:
+            yield progress_event(pending, dataset_ids, progress)
+            last_progress = progress
+        await asyncio.sleep(settings.VIDEO_PROGRESS_INTERVAL)
+    if not pending:
+        yield PROGRESS_END_EVENT
+
+@login_required
+@require_safe
+async def datasets_progress(request):
+    """
+    Server-sent events with the progress of the videos being processed of the
+    datasets `dataset` (repeated), in a single stream for the whole page
+    """
+    try:
+        dataset_ids = {int(dataset_id) for dataset_id in request.GET.getlist('dataset')}
+    except ValueError:
+        return HttpResponse('Invalid dataset', status=400)
+    if not dataset_ids or await get_followed_dataset_ids(await request.auser(), dataset_ids) != dataset_ids:
+        return HttpResponse('Forbidden', status=403)
+    # the database is only queried once, the progress comes from the cache
+    pending = {
+        pk: dataset_id async for pk, dataset_id in
+        DatasetVideo.objects.filter(dataset_id__in=dataset_ids, is_cut=False).values_list('pk', 'dataset_id')
+    }
+    if isinstance(request, ASGIRequest):
+        events = aprogress_events(pending)
+    else:
+        events = progress_events(pending)
+    response = StreamingHttpResponse(events, content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+@require_safe
+async def video_job(request, job_id):
+    """Status of a video processing job; the job id is unguessable, like the upload token"""
+    try:
+        job = await VideoJob.objects.aget(pk=job_id)
+    except VideoJob.DoesNotExist:
+        return JsonResponseWithNewline({"error": "Invalid job ID"}, status=404)
+    return JsonResponseWithNewline(job.status_data())
+
+RANGE_RE = re.compile(r'bytes=(\d*)-(\d*)$')
+
+def parse_range(header, size):
+    """
+    The `(first, last)` bytes of a single range `header` of a file of `size`,
+    or `None` to send all of it (as for a header with several ranges).
+    Raises ValueError if the range is unsatisfiable.
+    """
+    match = RANGE_RE.match(header.replace(' ', ''))
+    if not match or match.groups() == ('', ''):
+        return None
+    first, last = match.groups()
+    if not first:
+        # the last bytes
+        if int(last) == 0 or size == 0:
+            raise ValueError(header)
+        return max(0, size - int(last)), size - 1
+    first, last = int(first), min(int(last), size - 1) if last else size - 1
+    if first >= size:
+        raise ValueError(header)
+    if last < first:
+        return None
+    return first, last
+
+# stored file paths are content-addressed (see `md5_file_name`), so they can be cached forever
+MEDIA_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+@require_safe
+async def media(request, path):
+    """
+    Serve the stored file at `path` in MEDIA_ROOT, or the byte range requested
+    (so that seeking in a video only fetches what is watched), or leave it to
+    the front web server, see `MEDIA_X_ACCEL_REDIRECT`
+    """
+    md5sum, ext = os.path.splitext(os.path.basename(path))
+    stored_file = await StoredFile.objects.filter(pk=md5sum, path=path, bucket='').afirst()
+    if not stored_file:
+        raise Http404(path)
+    name = default_storage.path(path)
+    try:
+        size = (await run_file_io(os.stat, name)).st_size
+    except FileNotFoundError:
+        raise Http404(path)
+
+    etag = f'"{stored_file.md5sum}"'
+    headers = {
+        'ETag': etag,
+        'Cache-Control': MEDIA_CACHE_CONTROL,
+        'Accept-Ranges': 'bytes',
+    }
+    if etag in request.headers.get('If-None-Match', ''):
+        return HttpResponse(status=304, headers=headers)
+    headers['Content-Type'] = CONTENT_TYPES.get(ext.lower(), 'application/octet-stream')
+    if settings.MEDIA_X_ACCEL_REDIRECT:
+        return HttpResponse(headers={**headers, 'X-Accel-Redirect': settings.MEDIA_X_ACCEL_REDIRECT + path})
+    if settings.MEDIA_X_SENDFILE:
+        return HttpResponse(headers={**headers, 'X-Sendfile': name})
+
+    byte_range = None
+    if request.headers.get('If-Range', etag) == etag:
+        try:
+            byte_range = parse_range(request.headers.get('Range', ''), size)
+        except ValueError:
+            return HttpResponse(status=416, headers={**headers, 'Content-Range': f'bytes */{size}'})
+    status = 200
+    first, last = 0, size - 1
+    if byte_range:
+        status = 206
+        first, last = byte_range
+        headers['Content-Range'] = f'bytes {first}-{last}/{size}'
+    length = last - first + 1
+    headers['Content-Length'] = str(length)
+    if request.method == 'HEAD':
+        return HttpResponse(status=status, headers=headers)
+    return streaming_response(request, read_file_range(name, first, length), status=status, headers=headers)
+
 @login_required
 @require_safe
 def dataset_projects(request, dataset_id):
@@ -12,6 +12,7 @@ https://docs.djangoproject.com/en/5.0/ref/settings/
 
 from pathlib import Path
 import importlib
+import os
 from django.contrib.messages import constants as messages
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -97,6 +98,18 @@ DATABASES = {
 }
 
 
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # see VIDEO_PROGRESS_INTERVAL
+    'video_progress': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': BASE_DIR / 'cache' / 'video_progress',
+    },
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/5.0/ref/settings/#auth-password-validators
 
@@ -152,6 +165,13 @@ MESSAGE_TAGS = {
 
 MEDIA_ROOT = BASE_DIR / 'media'
 MEDIA_URL = '/media/'
+# Media files (the stored files not in S3) are sent by `views.media`, or,
+# without copying them through the app, by the front web server:
+# MEDIA_X_ACCEL_REDIRECT is the prefix of an nginx `internal` location aliasing
+# MEDIA_ROOT (e.g. '/protected-media/'), MEDIA_X_SENDFILE sends the X-Sendfile
+# header of Apache's mod_xsendfile (or lighttpd)
+MEDIA_X_ACCEL_REDIRECT = None
+MEDIA_X_SENDFILE = False
 
 EXTERNAL_LIST_FORMATS = {
     # 'tsv': { 'name': 'TSV', 'ext': 'tsv', 'mime': 'text/tab-separated-values', 'opts': { 'dialect': 'excel-tab' } },
@@ -181,7 +201,8 @@ Q_CLUSTER = {
 }
 
 _MB = 1024 * 1024
-FILE_UPLOAD_MAX_MEMORY_SIZE = 1024 * _MB
+# uploaded videos are always streamed to disk (see HashingFileUploadHandler)
+FILE_UPLOAD_MAX_MEMORY_SIZE = 10 * _MB
 
 INTERNAL_IPS = [
     '127.0.0.1',
@@ -192,9 +213,33 @@ UNIQUE_ID = 'change_me'
 MTURK_SANDBOX = True
 CREDENTIALS_COOKIE_NAME = 'video_eval_aws_credentials'
 
+# Files bigger than S3_MULTIPART_THRESHOLD are uploaded to and downloaded
+# from S3 in parts of S3_MULTIPART_PART_SIZE (at least 5 MB), up to
+# S3_TRANSFER_CONCURRENCY parts of a file at once
+S3_MULTIPART_THRESHOLD = 16 * _MB
+S3_MULTIPART_PART_SIZE = 16 * _MB
+S3_TRANSFER_CONCURRENCY = 8
+# At most S3_MAX_TRANSFERS files are transferred at once (per event loop, i.e.
+# per web or `video_worker` process), sharing S3_MAX_BANDWIDTH bytes per
+# second (None for unlimited)
+S3_MAX_TRANSFERS = 8
+S3_MAX_BANDWIDTH = None
+# Connections kept alive by each shared S3 client, i.e. per set of AWS
+# credentials and event loop; enough for all the parts being transferred
+S3_MAX_POOL_CONNECTIONS = S3_MAX_TRANSFERS * S3_TRANSFER_CONCURRENCY
+# Deleted files are removed from S3 by DeleteObjects requests of up to 1000
+# keys, S3_DELETE_CONCURRENCY requests at once
+S3_DELETE_CONCURRENCY = 4
+
+# Videos can be uploaded by the browser (or an API client) straight to S3, by a
+# presigned POST of up to S3_DIRECT_UPLOAD_MAX_SIZE (5 GB at most, which the
+# server-side copy into place is limited to), valid for S3_DIRECT_UPLOAD_EXPIRES seconds
+S3_DIRECT_UPLOAD_MAX_SIZE = 5 * 1024 * _MB
+S3_DIRECT_UPLOAD_EXPIRES = 6 * 60 * 60
+
 S3_CORS_RULES = [{
     'AllowedHeaders': ['Authorization'],
-    'AllowedMethods': ['GET', 'PUT'],
+    'AllowedMethods': ['GET', 'PUT', 'POST'],
     'AllowedOrigins': ['*'],
     'ExposeHeaders': ['ETag', 'x-amz-request-id'],
     'MaxAgeSeconds': 3000
@@ -206,6 +251,86 @@ SQLITE3_BUSY_TIMEOUT = 2000
 # FFmpeg processing timeout in seconds
 FFMPEG_TIMEOUT = 600  # 10 minutes
 
+# Maximum number of segments written by a single ffmpeg run;
+# None cuts all segments of a video in one pass (decoding the source once)
+FFMPEG_MAX_OUTPUTS_PER_PASS = None
+
+# "input": seek the source to the cut start (keyframe seek, then accurate trim);
+# "output": decode and discard everything before the cut start
+FFMPEG_SEEK_MODE = "input"
+
+# Cut H.264/AAC MP4 sources by re-encoding only up to the first keyframe
+# of each cut and stream-copying the rest; other sources are re-encoded
+FFMPEG_SMART_CUT = False
+
+# Maximum number of ffmpeg processes running at once on this host, across
+# the cuts of a video, across videos and across the web and `video_worker`
+# processes; also the number of videos processed at once
+FFMPEG_CONCURRENCY = max(1, (os.cpu_count() or 1) // 4)
+# Total number of threads of the ffmpeg processes, split evenly among the
+# FFMPEG_CONCURRENCY slots
+FFMPEG_THREADS = os.cpu_count() or 1
+# Lock files of the FFMPEG_CONCURRENCY slots, shared by the processes of the host
+FFMPEG_SLOTS_DIR = BASE_DIR / 'cache' / 'ffmpeg_slots'
+
+# When uploading to S3, have ffmpeg write each cut as fragmented MP4 to a
+# pipe, streamed into an S3 multipart upload (in parts of S3_MULTIPART_PART_SIZE),
+# so that segments never touch local disk; cuts are then re-encoded one by
+# one, even with FFMPEG_SMART_CUT
+FFMPEG_STREAM_TO_S3 = False
+
+# Uploaded videos are processed by `VideoJob`s, leased to a worker for
+# VIDEO_JOB_LEASE seconds and renewed every VIDEO_JOB_HEARTBEAT seconds;
+# a job whose lease expires (e.g. its worker died) is claimed again by
+# another worker, at most VIDEO_JOB_MAX_ATTEMPTS times in total
+VIDEO_JOB_LEASE = 120
+VIDEO_JOB_HEARTBEAT = 30
+VIDEO_JOB_MAX_ATTEMPTS = 3
+# How often idle `video_worker` processes look for new jobs, in seconds
+VIDEO_JOB_POLL_INTERVAL = 2
+# Also run the jobs in the web process, right after their video is uploaded
+VIDEO_JOBS_IN_PROCESS = True
+# Uploads are refused (HTTP 429, retry after VIDEO_JOB_RETRY_AFTER seconds)
+# while this many video jobs are queued, or this many for the uploading user
+VIDEO_JOB_QUEUE_LIMIT = 1000
+VIDEO_JOB_USER_QUEUE_LIMIT = 200
+VIDEO_JOB_RETRY_AFTER = 60
+# Videos uploaded through the API up to this size are processed ahead of
+# bigger ones (bulk ingest); videos uploaded through the web form go first
+VIDEO_JOB_SHORT_BYTES = 100 * _MB
+
+# Progress of the video jobs is kept in the `video_progress` cache, which
+# must be shared by the web and `video_worker` processes (a file based cache
+# is, on one host or a shared filesystem; otherwise use e.g. Redis); it is
+# updated, and pushed to the browsers, every VIDEO_PROGRESS_INTERVAL seconds
+VIDEO_PROGRESS_INTERVAL = 1
+# Progress streams are closed after this many seconds (and browsers reconnect)
+VIDEO_PROGRESS_STREAM_SECONDS = 300
+
+# Directory of the local cache of files downloaded from S3 (keyed by md5sum);
+# None puts it in MEDIA_ROOT/cache, on the same filesystem as MEDIA_ROOT/tmp
+LOCAL_CACHE_DIR = None
+# Size budget of the local cache, least recently used files are evicted
+# first; 0 disables the cache
+LOCAL_CACHE_MAX_BYTES = 10 * 1024 * _MB
+
+# The daily vacuum (see `tasks.vacuum`) deletes the stored files nothing
+# references, and the files, S3 objects and chunked uploads no database row
+# accounts for, once they are VACUUM_GRACE_PERIOD seconds old (files being
+# written are spared); a run stops after VACUUM_TIME_BUDGET seconds, and
+# leaves the rest to the next one
+VACUUM_GRACE_PERIOD = 24 * 60 * 60
+VACUUM_TIME_BUDGET = 15 * 60
+# The S3 locations (`bucket/dir`) the vacuum sweeps, with the AWS credentials
+# (as stored in the credentials cookie) allowed to list and delete their
+# objects; without credentials, only local files are swept
+VACUUM_S3_LOCATIONS = []
+VACUUM_AWS_CREDENTIALS = None
+
+# Threads running the blocking file I/O (hashing, copying, subtitles) of
+# uploads and video processing, off the event loop
+FILE_IO_THREADS = 4
+
 
 if importlib.util.find_spec("django_extensions"):
     INSTALLED_APPS.append('django_extensions')
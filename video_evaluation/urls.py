@@ -17,8 +17,8 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import include, path
 from django.conf import settings
-from django.conf.urls.static import static
 
+from video_eval_app.views import media
 from .views import CookieDeletingLogoutView
 
 
@@ -26,11 +26,10 @@ urlpatterns = [
     path("admin/", admin.site.urls),
     path("accounts/logout/", CookieDeletingLogoutView.as_view(), name="logout"),
     path("accounts/", include("django.contrib.auth.urls")),
+    path(f"{settings.MEDIA_URL.lstrip('/')}<path:path>", media, name="media"),
     path("", include("video_eval_app.urls")),
 ]
 if settings.DEBUG:
-    urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
-
     import importlib
 
     if importlib.util.find_spec('django_browser_reload'):